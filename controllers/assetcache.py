@@ -0,0 +1,197 @@
+from controllers import assetlookup, assetstream
+from controllers.assetlookup import AssetLocation
+from collections import OrderedDict
+import dbsetup
+import threading
+import time
+import os
+
+
+class CachedAsset():
+    # everything we need to answer an /asset request from memory
+    data = None
+    etag = None
+    last_modified = None
+    mimetype = None
+    loaded = None
+
+    def __init__(self, **kwargs):
+        self.data = kwargs.get('data', None)
+        self.etag = kwargs.get('etag', None)
+        self.last_modified = kwargs.get('last_modified', None)
+        self.mimetype = kwargs.get('mimetype', None)
+        self.loaded = time.time()
+
+
+class AssetByteCache():
+    # Segmented LRU of asset bytes with a byte budget per worker.
+    #
+    # New entries go into the probation segment, a hit there promotes
+    # the entry to the protected segment (at most _protected_ratio of the
+    # budget). Evictions come from the cold end of probation first, so a
+    # burst of one-off downloads can't flush the hot assets.
+    #
+    # An asset is only read into memory the second time it misses
+    # (_ghosts remembers recent misses), the first miss is streamed from
+    # disk as usual.
+    _probation = None
+    _protected = None
+    _ghosts = None
+    _lock = None
+    _max_bytes = None
+    _max_item_bytes = None
+    _protected_ratio = None
+    _max_age = None
+    _max_ghosts = None
+    _probation_bytes = 0
+    _protected_bytes = 0
+
+    def __init__(self, **kwargs):
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._ghosts = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = kwargs.get('max_bytes', dbsetup.Configuration.ASSET_CACHE_BYTES)
+        self._max_item_bytes = kwargs.get('max_item_bytes', dbsetup.Configuration.ASSET_CACHE_MAX_ITEM_BYTES)
+        self._protected_ratio = kwargs.get('protected_ratio', 0.8)
+        self._max_age = kwargs.get('max_age', dbsetup.Configuration.ASSET_INDEX_MAX_AGE)
+        self._max_ghosts = kwargs.get('max_ghosts', 4096)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._probation) + len(self._protected),
+                    'bytes': self._probation_bytes + self._protected_bytes,
+                    'max_bytes': self._max_bytes}
+
+    def get(self, asset_id: int) -> CachedAsset:
+        with self._lock:
+            ca = self._protected.get(asset_id, None)
+            if ca is not None:
+                if self.expired(ca):
+                    self.drop(asset_id)
+                else:
+                    self._protected.move_to_end(asset_id)
+                    self.hits += 1
+                    return ca
+            else:
+                ca = self._probation.pop(asset_id, None)
+                if ca is not None:
+                    self._probation_bytes -= len(ca.data)
+                    if not self.expired(ca):
+                        self.promote(asset_id, ca)
+                        self.hits += 1
+                        return ca
+
+            self.misses += 1
+            return None
+
+    def expired(self, ca: CachedAsset) -> bool:
+        # entries are re-read now and then in case another
+        # worker deactivated the asset
+        return self._max_age is not None and time.time() - ca.loaded > self._max_age
+
+    def promote(self, asset_id: int, ca: CachedAsset) -> None:
+        self._protected[asset_id] = ca
+        self._protected_bytes += len(ca.data)
+        # protected overflow gets demoted to the hot end of probation
+        while self._protected_bytes > self._max_bytes * self._protected_ratio and len(self._protected) > 1:
+            demoted_id, demoted = self._protected.popitem(last=False)
+            self._protected_bytes -= len(demoted.data)
+            self._probation[demoted_id] = demoted
+            self._probation_bytes += len(demoted.data)
+        self.evict()
+
+    def evict(self) -> None:
+        while self._probation_bytes + self._protected_bytes > self._max_bytes:
+            if len(self._probation) > 0:
+                evicted_id, evicted = self._probation.popitem(last=False)
+                self._probation_bytes -= len(evicted.data)
+            elif len(self._protected) > 0:
+                evicted_id, evicted = self._protected.popitem(last=False)
+                self._protected_bytes -= len(evicted.data)
+            else:
+                break
+            self.evictions += 1
+
+    def should_load(self, asset_id: int) -> bool:
+        # True if we've missed on this asset recently, i.e. it's worth keeping
+        with self._lock:
+            if self._ghosts.pop(asset_id, None) is not None:
+                return True
+            self._ghosts[asset_id] = True
+            if len(self._ghosts) > self._max_ghosts:
+                self._ghosts.popitem(last=False)
+            return False
+
+    def put(self, asset_id: int, ca: CachedAsset) -> None:
+        if len(ca.data) > self._max_item_bytes or len(ca.data) > self._max_bytes:
+            return
+        with self._lock:
+            self.drop(asset_id)
+            self._probation[asset_id] = ca
+            self._probation_bytes += len(ca.data)
+            self.evict()
+
+    def load(self, asset_id: int, path_and_name: str) -> CachedAsset:
+        # read the asset into memory and cache it, None if it's too big to keep
+        st = os.stat(path_and_name)
+        if st.st_size > self._max_item_bytes:
+            return None
+        with open(path_and_name, 'rb') as fp:
+            data = fp.read()
+        etag, last_modified = assetstream.file_validators(path_and_name, st)
+        ca = CachedAsset(data=data, etag=etag, last_modified=last_modified,
+                         mimetype=assetstream.mimetype_for(path_and_name))
+        self.put(asset_id, ca)
+        return ca
+
+    def drop(self, asset_id: int) -> bool:
+        ca = self._probation.pop(asset_id, None)
+        if ca is not None:
+            self._probation_bytes -= len(ca.data)
+            return True
+        ca = self._protected.pop(asset_id, None)
+        if ca is not None:
+            self._protected_bytes -= len(ca.data)
+            return True
+        return False
+
+    def invalidate(self, asset_id=None) -> None:
+        # drops the entry and any resized derivatives of it, which are
+        # cached under (key, width, height)
+        with self._lock:
+            if asset_id is None:
+                self._probation.clear()
+                self._protected.clear()
+                self._ghosts.clear()
+                self._probation_bytes = 0
+                self._protected_bytes = 0
+                self.invalidations += 1
+                return
+
+            keys = [asset_id]
+            for segment in (self._probation, self._protected):
+                keys.extend(k for k in segment if isinstance(k, tuple) and k[0] == asset_id)
+            for key in keys:
+                if self.drop(key):
+                    self.invalidations += 1
+                self._ghosts.pop(key, None)
+
+
+asset_cache = AssetByteCache()
+
+
+def cache_key(loc: AssetLocation, size=None):
+    # Entries are keyed by where the bytes are stored, not by asset id,
+    # so assets sharing a content-addressed blob share one entry (resized
+    # derivatives are (path, width, height)). Callers check loc.active
+    # first, so a deactivated asset is refused without dropping bytes
+    # another asset may still be using.
+    path = assetlookup.path_and_name(loc)
+    return path if size is None else (path, size[0], size[1])
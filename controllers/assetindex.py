@@ -0,0 +1,200 @@
+from models import photogame
+import dbsetup
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from random import sample
+from array import array
+import threading
+import time
+
+
+class CampaignAssets():
+    # The active asset ids for a single campaign.
+    # _ids is densely packed so we can pick assets by position,
+    # _pos maps an asset id back to its slot so removing an
+    # asset is O(1) (we move the last id into the hole)
+    _ids = None
+    _pos = None
+    _loaded = None
+
+    def __init__(self, asset_ids=None):
+        self._ids = array('l')
+        self._pos = {}
+        self._loaded = time.time()
+        if asset_ids is not None:
+            for asset_id in asset_ids:
+                self.add(asset_id)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, asset_id: int) -> bool:
+        return asset_id in self._pos
+
+    def is_stale(self, max_age: float) -> bool:
+        return max_age is not None and time.time() - self._loaded > max_age
+
+    def add(self, asset_id: int) -> None:
+        if asset_id in self._pos:
+            return
+        self._pos[asset_id] = len(self._ids)
+        self._ids.append(asset_id)
+
+    def remove(self, asset_id: int) -> None:
+        idx = self._pos.pop(asset_id, None)
+        if idx is None:
+            return
+        last_id = self._ids.pop()
+        if idx < len(self._ids):
+            self._ids[idx] = last_id
+            self._pos[last_id] = idx
+
+    def sample(self, ballot_size: int) -> list:
+        # random.sample() over a range only touches ballot_size
+        # positions, so this doesn't depend on the campaign size
+        assert(len(self._ids) >= ballot_size)
+        return [self._ids[idx] for idx in sample(range(len(self._ids)), ballot_size)]
+
+    def sample_ballots(self, ballot_size: int, n: int) -> list:
+        # n ballots from one random.sample() over the campaign, so the
+        # ballots in a batch don't repeat assets (as long as the campaign
+        # has enough of them, otherwise we go round again)
+        assert(len(self._ids) >= ballot_size)
+        per_pass = len(self._ids) // ballot_size
+        ballots = []
+        while len(ballots) < n:
+            k = min(n - len(ballots), per_pass)
+            picks = sample(range(len(self._ids)), k * ballot_size)
+            for b in range(k):
+                ballots.append([self._ids[idx] for idx in picks[b * ballot_size:(b + 1) * ballot_size]])
+        return ballots
+
+
+class AssetIndex():
+    # Process-local index of active assets per campaign. A campaign
+    # is read from the DB the first time it's asked for (or when it
+    # gets older than _max_age, to pick up changes made by other
+    # processes), after that ballots are drawn from memory.
+    _campaigns = None
+    _lock = None
+    _max_age = None
+
+    def __init__(self, **kwargs):
+        self._campaigns = {}
+        self._lock = threading.Lock()
+        self._max_age = kwargs.get('max_age', dbsetup.Configuration.ASSET_INDEX_MAX_AGE)
+
+    def load_campaign(self, session, campaign_id: int) -> CampaignAssets:
+        try:
+            q = session.query(photogame.PhotoGameAsset.id, photogame.PhotoGameAsset.filepath, photogame.PhotoGameAsset.filename).\
+                filter(photogame.PhotoGameAsset.campaign_id == campaign_id).\
+                filter(photogame.PhotoGameAsset.active == 1)
+            rows = q.all()
+        except Exception as e:
+            raise
+        return self.install(campaign_id, rows)
+
+    def install(self, campaign_id: int, rows: list) -> CampaignAssets:
+        # rows of (asset_id, filepath, filename) for the campaign's active
+        # assets, however they were read (widget_async reads them itself)
+        ca = CampaignAssets([row[0] for row in rows])
+        with self._lock:
+            self._campaigns[campaign_id] = ca
+        for listener in campaign_listeners:
+            listener(campaign_id, rows)
+        return ca
+
+    def cached(self, campaign_id: int) -> CampaignAssets:
+        # the campaign's assets if we hold a current copy, otherwise None
+        ca = self._campaigns.get(campaign_id, None)
+        if ca is None or ca.is_stale(self._max_age):
+            return None
+        return ca
+
+    def campaign_assets(self, session, campaign_id: int) -> CampaignAssets:
+        ca = self.cached(campaign_id)
+        if ca is None:
+            ca = self.load_campaign(session, campaign_id)
+        return ca
+
+    def ballot(self, session, campaign_id: int, ballot_size: int) -> list:
+        return self.sample(self.campaign_assets(session, campaign_id), ballot_size)
+
+    def ballots(self, session, campaign_id: int, ballot_size: int, n: int) -> list:
+        return self.sample_ballots(self.campaign_assets(session, campaign_id), ballot_size, n)
+
+    def sample(self, ca: CampaignAssets, ballot_size: int) -> list:
+        with self._lock:
+            return ca.sample(ballot_size)
+
+    def sample_ballots(self, ca: CampaignAssets, ballot_size: int, n: int) -> list:
+        with self._lock:
+            return ca.sample_ballots(ballot_size, n)
+
+    def asset_changed(self, campaign_id: int, asset_id: int, active: bool) -> None:
+        with self._lock:
+            ca = self._campaigns.get(campaign_id, None)
+            if ca is None:
+                return  # not loaded yet, we'll see it when the campaign is read
+            if active:
+                ca.add(asset_id)
+            else:
+                ca.remove(asset_id)
+
+    def invalidate(self, campaign_id=None) -> None:
+        with self._lock:
+            if campaign_id is None:
+                self._campaigns.clear()
+            else:
+                self._campaigns.pop(campaign_id, None)
+
+
+asset_index = AssetIndex()
+
+# other caches keyed on assets register here to hear about committed
+# changes, called as listener(campaign_id, asset_id, active)
+change_listeners = []
+
+# ... and about campaigns being (re)loaded, called as
+# listener(campaign_id, [(asset_id, filepath, filename), ...])
+campaign_listeners = []
+
+
+#
+# Keep the index current as assets are added, (de)activated or deleted.
+# Changes are noted at flush time but only applied once the transaction
+# commits, so a rollback can't leave phantom asset ids in a ballot.
+#
+@event.listens_for(photogame.PhotoGameAsset, 'after_insert')
+@event.listens_for(photogame.PhotoGameAsset, 'after_update')
+def track_asset_change(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    active = target.active is None or target.active != 0
+    session.info.setdefault('asset_changes', []).append((target.campaign_id, target.id, active))
+
+
+@event.listens_for(photogame.PhotoGameAsset, 'after_delete')
+def track_asset_delete(mapper, connection, target):
+    # a deleted asset leaves the index just like a deactivated one
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('asset_changes', []).append((target.campaign_id, target.id, False))
+
+
+@event.listens_for(dbsetup.Session, 'after_commit')
+def apply_asset_changes(session):
+    changes = session.info.pop('asset_changes', None)
+    if changes is None:
+        return
+    for campaign_id, asset_id, active in changes:
+        asset_index.asset_changed(campaign_id, asset_id, active)
+        for listener in change_listeners:
+            listener(campaign_id, asset_id, active)
+
+
+@event.listens_for(dbsetup.Session, 'after_rollback')
+def discard_asset_changes(session):
+    session.info.pop('asset_changes', None)
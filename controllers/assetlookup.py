@@ -0,0 +1,110 @@
+from models import photogame
+from controllers import assetindex
+from collections import namedtuple
+from PIL import Image
+import dbsetup
+import threading
+import time
+import sys
+import os
+
+# dimensions is the original's (width, height), None until someone asks
+AssetLocation = namedtuple('AssetLocation', ['filepath', 'filename', 'active', 'campaign_id', 'loaded', 'dimensions'])
+
+
+class AssetLocations():
+    # asset_id -> AssetLocation, so serving an asset we've seen before
+    # needs no SQL. Where an asset is stored never changes once it's
+    # created, only the active flag does (and we hear about that through
+    # the asset index's change listeners, or by re-reading entries older
+    # than _max_age in case another worker changed it). Directory names are
+    # shared by up to 1000 assets, so they're interned to keep this small.
+    # An image's dimensions live in its entry, so they're dropped with it.
+    _locations = None
+    _lock = None
+    _max_age = None
+
+    def __init__(self, **kwargs):
+        self._locations = {}
+        self._lock = threading.Lock()
+        self._max_age = kwargs.get('max_age', dbsetup.Configuration.ASSET_INDEX_MAX_AGE)
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def get(self, asset_id: int) -> AssetLocation:
+        loc = self._locations.get(asset_id, None)
+        if loc is not None and self._max_age is not None and time.time() - loc.loaded > self._max_age:
+            return None
+        return loc
+
+    def store(self, asset_id: int, filepath: str, filename: str, active: bool, campaign_id: int) -> AssetLocation:
+        with self._lock:
+            old = self._locations.get(asset_id, None)
+            dimensions = None
+            if old is not None and old.filepath == filepath and old.filename == filename:
+                dimensions = old.dimensions  # same file, re-reading it doesn't change its size
+            loc = AssetLocation(sys.intern(filepath), filename, active, campaign_id, time.time(), dimensions)
+            self._locations[asset_id] = loc
+        return loc
+
+    def lookup(self, session, asset_id: int) -> AssetLocation:
+        # fill on miss, None if there's no such asset
+        loc = self.get(asset_id)
+        if loc is not None:
+            return loc
+
+        try:
+            q = session.query(photogame.PhotoGameAsset.filepath, photogame.PhotoGameAsset.filename,
+                              photogame.PhotoGameAsset.active, photogame.PhotoGameAsset.campaign_id).\
+                filter(photogame.PhotoGameAsset.id == asset_id)
+            row = q.one_or_none()
+        except Exception as e:
+            raise
+
+        if row is None:
+            return None
+        return self.store(asset_id, row[0], row[1], row[2] == 1, row[3])
+
+    def warm_campaign(self, campaign_id: int, rows: list) -> None:
+        # rows of (asset_id, filepath, filename) for the campaign's active assets
+        for asset_id, filepath, filename in rows:
+            self.store(asset_id, filepath, filename, True, campaign_id)
+
+    def asset_changed(self, campaign_id: int, asset_id: int, active: bool) -> None:
+        with self._lock:
+            loc = self._locations.get(asset_id, None)
+            if loc is not None and loc.active != active:
+                self._locations[asset_id] = loc._replace(active=active)
+
+    def dimensions(self, asset_id: int, loc: AssetLocation) -> (int, int):
+        # (width, height) of the original, Pillow only reads the image
+        # header to get these. None if the file can't be read.
+        if loc.dimensions is not None:
+            return loc.dimensions
+        try:
+            with Image.open(path_and_name(loc)) as img:
+                size = img.size
+        except (OSError, IOError):
+            return None
+        with self._lock:
+            current = self._locations.get(asset_id, None)
+            if current is not None and current.filepath == loc.filepath and current.filename == loc.filename:
+                self._locations[asset_id] = current._replace(dimensions=size)
+        return size
+
+    def invalidate(self, asset_id=None) -> None:
+        with self._lock:
+            if asset_id is None:
+                self._locations.clear()
+            else:
+                self._locations.pop(asset_id, None)
+
+
+def path_and_name(loc: AssetLocation) -> str:
+    return os.path.normpath(loc.filepath + '/' + loc.filename)
+
+
+asset_locations = AssetLocations()
+assetindex.change_listeners.append(asset_locations.asset_changed)
+assetindex.campaign_listeners.append(asset_locations.warm_campaign)
@@ -0,0 +1,152 @@
+from flask import Response, request
+from flask_api import status
+from werkzeug.wsgi import wrap_file
+from datetime import datetime
+import os
+
+# content types for the extensions we store assets under
+MIME_TYPES = {'JPG': 'image/jpeg',
+              'JPEG': 'image/jpeg',
+              'PNG': 'image/png',
+              'GIF': 'image/gif',
+              'BMP': 'image/bmp',
+              'TIF': 'image/tiff',
+              'TIFF': 'image/tiff'}
+
+
+def mimetype_for(filename: str) -> str:
+    extension = filename.rpartition('.')[2].upper()
+    return MIME_TYPES.get(extension, 'application/octet-stream')
+
+
+class FileRange():
+    # iterates over [start, start+length) of an open file in chunks,
+    # so a range request never holds more than chunk_size in memory
+    _fp = None
+    _start = None
+    _length = None
+    _chunk_size = None
+
+    def __init__(self, fp, start: int, length: int, chunk_size=65536):
+        self._fp = fp
+        self._start = start
+        self._length = length
+        self._chunk_size = chunk_size
+
+    def __iter__(self):
+        self._fp.seek(self._start)
+        remaining = self._length
+        while remaining > 0:
+            data = self._fp.read(min(self._chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self._fp.close()
+
+
+# assets never change once written, so caches can keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def file_validators(path_and_name: str, st) -> (str, datetime):
+    # Asset files are named by a uuid that's never reused, the size and
+    # mtime are only there to catch a file rewritten in place
+    stem = os.path.basename(path_and_name).rpartition('.')[0]
+    etag = '{0}-{1:x}-{2:x}'.format(stem, st.st_size, int(st.st_mtime))
+    last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+    return etag, last_modified
+
+
+def not_modified(etag: str, last_modified: datetime) -> bool:
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def requested_range(size: int, etag: str, last_modified: datetime):
+    # returns None to send the whole file, (start, stop) for a single
+    # satisfiable range, or False if the range can't be satisfied.
+    # Multiple ranges aren't worth the trouble for images, we just
+    # send the whole file as the RFC allows.
+    rng = request.range
+    if rng is None or rng.units != 'bytes' or len(rng.ranges) != 1:
+        return None
+    if 'If-Range' in request.headers:
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        if if_range.date is not None and if_range.date != last_modified:
+            return None
+    byte_range = rng.range_for_length(size)
+    if byte_range is None:
+        return False
+    return byte_range
+
+
+def set_cache_headers(rsp: Response, etag: str, last_modified: datetime, immutable: bool) -> None:
+    rsp.set_etag(etag)
+    rsp.last_modified = last_modified
+    rsp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else 'no-cache'
+
+
+def send_asset(size: int, etag: str, last_modified: datetime, mimetype: str, immutable: bool, full_body, range_body) -> Response:
+    # Builds the response for an asset, whether it comes from disk or
+    # memory. full_body() returns the whole body, range_body(start, length)
+    # just that slice; neither is called for a 304 or 416.
+    if not_modified(etag, last_modified):
+        rsp = Response(status=status.HTTP_304_NOT_MODIFIED)
+        set_cache_headers(rsp, etag, last_modified, immutable)
+        return rsp
+
+    byte_range = requested_range(size, etag, last_modified)
+    if byte_range is False:
+        rsp = Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        rsp.headers['Content-Range'] = 'bytes */{0}'.format(size)
+        rsp.headers['Accept-Ranges'] = 'bytes'
+        return rsp
+
+    if byte_range is None:
+        rsp = Response(full_body(), status=status.HTTP_200_OK, mimetype=mimetype, direct_passthrough=True)
+        rsp.content_length = size
+    else:
+        start, stop = byte_range
+        rsp = Response(range_body(start, stop - start), status=status.HTTP_206_PARTIAL_CONTENT, mimetype=mimetype, direct_passthrough=True)
+        rsp.content_length = stop - start
+        rsp.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)
+
+    rsp.headers['Accept-Ranges'] = 'bytes'
+    set_cache_headers(rsp, etag, last_modified, immutable)
+    return rsp
+
+
+def stream_file(path_and_name: str, mimetype=None, immutable=False) -> Response:
+    # Stream a file from disk without reading it into memory. A full
+    # response goes through the server's wsgi.file_wrapper (sendfile
+    # under gunicorn), a range is read in chunks. Conditional requests
+    # that still match get a 304 without the file being opened.
+    if mimetype is None:
+        mimetype = mimetype_for(path_and_name)
+
+    st = os.stat(path_and_name)
+    etag, last_modified = file_validators(path_and_name, st)
+
+    def full_body():
+        return wrap_file(request.environ, open(path_and_name, 'rb'))
+
+    def range_body(start, length):
+        return FileRange(open(path_and_name, 'rb'), start, length)
+
+    return send_asset(st.st_size, etag, last_modified, mimetype, immutable, full_body, range_body)
+
+
+def send_bytes(data: bytes, etag: str, last_modified: datetime, mimetype: str, immutable=True) -> Response:
+    # same as stream_file() for an asset we already hold in memory
+    return send_asset(len(data), etag, last_modified, mimetype, immutable,
+                      lambda: [data],
+                      lambda start, length: [data[start:start + length]])
@@ -0,0 +1,278 @@
+from models import photogame
+from controllers import gameusers, pairing, derivatives
+from controllers.assetindex import asset_index
+from controllers.assetlookup import asset_locations, AssetLocation
+from controllers.pairing import pairing_index
+from controllers.gameusers import game_user_cache
+from controllers.photomgr import PhotoGameMgr
+from controllers.usertoken import UserToken, user_tokens
+from sqlalchemy import select, func
+from sqlalchemy.engine.url import make_url
+from datetime import datetime
+import aiomysql
+import aiomysql.sa
+import asyncio
+import dbsetup
+
+#
+# asyncio counterparts of the PhotoGameMgr calls behind /photogame and
+# /vote, for widget_async.py. They use the same schema (models.photogame's
+# tables, run as SQLAlchemy core statements through aiomysql.sa) and the
+# same process-wide caches as the Flask app: campaign windows, asset
+# indexes, asset locations and gameuser ids. A miss is read with the async
+# driver and handed to the cache's own store()/install(), so a hit never
+# checks out a connection.
+#
+# None of this goes through dbsetup.Session, so its after_commit hooks
+# don't fire; once a vote commits we do what they would have (cache new
+# gameuser ids, tell the pairing index about the votes) ourselves.
+#
+
+
+async def create_engine(**kwargs):
+    # an aiomysql pool on the database dbsetup.engine points at
+    url = make_url(dbsetup.connection_string(None))
+    return await aiomysql.sa.create_engine(host=url.host, port=url.port or 3306,
+                                           user=url.username, password=url.password or '',
+                                           db=url.database, charset='utf8', autocommit=False,
+                                           minsize=kwargs.get('minsize', 1),
+                                           maxsize=kwargs.get('maxsize', dbsetup.Configuration.ASYNC_DB_POOL_SIZE),
+                                           pool_recycle=dbsetup.Configuration.DB_POOL_RECYCLE,
+                                           loop=kwargs.get('loop', None))
+
+
+class AsyncPhotoGameMgr():
+    _engine = None
+    _pm = None
+
+    def __init__(self, **kwargs):
+        self._engine = kwargs.get('engine', None)
+        self._pm = PhotoGameMgr()
+
+    async def query_one(self, conn, stmt):
+        # first row of stmt, on conn or (if it's None) a pooled connection
+        if conn is None:
+            async with self._engine.acquire() as conn:
+                return await self.query_one(conn, stmt)
+        result = await conn.execute(stmt)
+        return await result.first()
+
+    async def query_all(self, conn, stmt) -> list:
+        if conn is None:
+            async with self._engine.acquire() as conn:
+                return await self.query_all(conn, stmt)
+        result = await conn.execute(stmt)
+        return await result.fetchall()
+
+    async def campaign_window(self, campaign_id: int, conn=None) -> photogame.CampaignWindow:
+        entry = photogame.campaign_cache.get(campaign_id)
+        if entry is not None:
+            return entry[1]
+
+        c = photogame.Campaign.__table__
+        row = await self.query_one(conn, select([c.c.id, c.c.client_id, c.c.active, c.c.start_date, c.c.end_date]).
+                                   where(c.c.id == campaign_id))
+        cw = photogame.CampaignWindow(campaign=row) if row is not None else None
+        photogame.campaign_cache.store(campaign_id, cw)
+        return cw
+
+    async def find_campaign(self, campaign_id: int) -> photogame.CampaignWindow:
+        # the campaign if it's active right now, otherwise None
+        cw = await self.campaign_window(campaign_id)
+        if cw is None or not cw.is_active(datetime.now()):
+            return None
+        return cw
+
+    async def location(self, asset_id: int, conn=None) -> AssetLocation:
+        loc = asset_locations.get(asset_id)
+        if loc is not None:
+            return loc
+
+        a = photogame.PhotoGameAsset.__table__
+        row = await self.query_one(conn, select([a.c.filepath, a.c.filename, a.c.active, a.c.campaign_id]).
+                                   where(a.c.id == asset_id))
+        if row is None:
+            return None
+        return asset_locations.store(asset_id, row[0], row[1], row[2] == 1, row[3])
+
+    async def campaign_assets(self, campaign_id: int):
+        # (index, the campaign's entry in it), read with one query on a miss
+        a = photogame.PhotoGameAsset.__table__
+        if pairing.adaptive_pairing_enabled():
+            index = pairing_index
+            t = photogame.PhotoGameTally.__table__
+            stmt = select([a.c.id, func.coalesce(t.c.appearances, 0), func.coalesce(t.c.wins, 0)]).\
+                select_from(a.outerjoin(t, t.c.asset_id == a.c.id))
+        else:
+            index = asset_index
+            stmt = select([a.c.id, a.c.filepath, a.c.filename])
+
+        entry = index.cached(campaign_id)
+        if entry is None:
+            rows = await self.query_all(None, stmt.where(a.c.campaign_id == campaign_id).where(a.c.active == 1))
+            entry = index.install(campaign_id, [tuple(row) for row in rows])
+        return index, entry
+
+    async def get_photogame_assets(self, campaign_id: int) -> list:
+        # asset ids of a ballot (of 2) for the campaign, [] if it isn't running
+        if await self.find_campaign(campaign_id) is None:
+            return []
+        index, entry = await self.campaign_assets(campaign_id)
+        if len(entry) < 2:
+            return []
+        return index.sample(entry, 2)
+
+    async def get_photogame_ballots(self, campaign_id: int, n: int, size=None) -> list:
+        # same as PhotoGameMgr.get_photogame_ballots(), reading image headers
+        # for the sizes off the event loop
+        ballots = []
+        if await self.find_campaign(campaign_id) is None:
+            return ballots
+        index, entry = await self.campaign_assets(campaign_id)
+        if len(entry) < 2:
+            return ballots
+
+        loop = asyncio.get_event_loop()
+        for bl in index.sample_ballots(entry, 2, n):
+            assets = []
+            for asset_id in bl:
+                loc = await self.location(asset_id)
+                dims = await loop.run_in_executor(None, asset_locations.dimensions, asset_id, loc) if loc is not None else None
+                if dims is not None and size is not None:
+                    dims = derivatives.fitted_size(dims, size)
+                assets.append({'asset_id': asset_id,
+                               'width': dims[0] if dims is not None else None,
+                               'height': dims[1] if dims is not None else None})
+            ballots.append({'token': user_tokens.issue_ballot(campaign_id, bl), 'assets': assets})
+        return ballots
+
+    async def client_for_asset(self, asset_id: int, conn=None) -> int:
+        loc = await self.location(asset_id, conn)
+        if loc is None:
+            return None
+        cw = await self.campaign_window(loc.campaign_id, conn)
+        return cw.client_id if cw is not None else None
+
+    async def validate_votes(self, votes: list) -> bool:
+        # see PhotoGameMgr.validate_votes()
+        if not isinstance(votes, list) or len(votes) == 0:
+            return False
+        for vote in votes:
+            if not isinstance(vote, dict):
+                return False
+            if not isinstance(vote.get('asset_id', None), int) or not isinstance(vote.get('rank', None), int):
+                return False
+            loc = await self.location(vote['asset_id'])
+            if loc is None or not loc.active:
+                return False
+        return True
+
+    async def token_user(self, token: UserToken, client_user_id: str, asset_id: int) -> int:
+        client_id = None
+        if client_user_id is not None:
+            client_id = await self.client_for_asset(asset_id)
+        return token.gu_id if token.vouches_for(client_user_id, client_id) else None
+
+    async def user_token(self, token: UserToken, client_user_id: str, asset_id: int, gu_id: int) -> UserToken:
+        if gu_id is None or await self.token_user(token, client_user_id, asset_id) == gu_id:
+            return token
+        client_id = None
+        if client_user_id is not None:
+            client_id = await self.client_for_asset(asset_id)
+        return user_tokens.for_user(token, gu_id, client_id, client_user_id)
+
+    async def find_ii_user(self, conn, ii_user_id: str, remembered: list) -> int:
+        key = gameusers.ii_key(ii_user_id)
+        gu_id = game_user_cache.get(key)
+        if gu_id is not None:
+            return gu_id
+
+        gu = photogame.GameUser.__table__
+        row = await self.query_one(conn, select([gu.c.id]).where(gu.c.ii_userid == ii_user_id).order_by(gu.c.id).limit(1))
+        if row is None:
+            return None
+        remembered.append((key, row[0]))
+        return row[0]
+
+    async def find_client_user(self, conn, client_user_id: str, ii_user_id: str, asset_id: int, remembered: list) -> int:
+        # see PhotoGameMgr.find_client_user(), the loser of a race to
+        # create the user reads the winner's row
+        client_id = await self.client_for_asset(asset_id, conn)
+        key = gameusers.client_key(client_id, client_user_id)
+        gu_id = game_user_cache.get(key)
+        if gu_id is not None:
+            return gu_id
+
+        gu = photogame.GameUser.__table__
+        q = select([gu.c.id]).where(gu.c.client_id == client_id).where(gu.c.client_userid == client_user_id)
+        row = await self.query_one(conn, q)
+        if row is not None:
+            gu_id = row[0]
+        else:
+            savepoint = await conn.begin_nested()
+            try:
+                result = await conn.execute(gu.insert().values(client_id=client_id, client_userid=client_user_id, ii_userid=ii_user_id))
+                await savepoint.commit()
+                gu_id = result.lastrowid
+            except aiomysql.IntegrityError:
+                await savepoint.rollback()
+                gu_id = (await self.query_one(conn, q.with_for_update()))[0]
+
+        remembered.append((key, gu_id))
+        return gu_id
+
+    async def record_votes(self, conn, rows: list) -> None:
+        # PhotoGameTally.record_votes() on our connection
+        tbl = photogame.PhotoGameTally.__table__
+        totals = photogame.PhotoGameTally.vote_totals(rows)
+        for asset_id in sorted(totals):
+            appearances, wins, rank_sum = totals[asset_id]
+            upd = photogame.PhotoGameTally.increment(asset_id, appearances, wins, rank_sum)
+            result = await conn.execute(upd)
+            if result.rowcount > 0:
+                continue
+
+            loc = await self.location(asset_id, conn)
+            savepoint = await conn.begin_nested()
+            try:
+                await conn.execute(tbl.insert().values(asset_id=asset_id, campaign_id=loc.campaign_id,
+                                                       appearances=appearances, wins=wins, rank_sum=rank_sum))
+                await savepoint.commit()
+            except aiomysql.IntegrityError:
+                await savepoint.rollback()
+                await conn.execute(upd)
+
+    async def tally_results(self, client_user_id: str, ii_user_id: str, votes: list, grp_guid=None, token=None) -> int:
+        # the user (if their token doesn't already vouch for them), the
+        # pgresult rows and the tallies in one transaction
+        if grp_guid is None:
+            grp_guid = self._pm.new_group_guid()
+        asset_id = votes[0]['asset_id']
+
+        gu_id = None
+        if token is not None:
+            gu_id = await self.token_user(token, client_user_id, asset_id)
+
+        remembered = []
+        async with self._engine.acquire() as conn:
+            async with conn.begin():
+                if gu_id is None:
+                    if client_user_id is not None:
+                        gu_id = await self.find_client_user(conn, client_user_id, ii_user_id, asset_id, remembered)
+                    else:
+                        gu_id = await self.find_ii_user(conn, ii_user_id, remembered)
+                rows = self._pm.vote_rows(grp_guid, gu_id, votes)
+                await conn.execute(photogame.PhotoGameResult.__table__.insert().values(rows))
+                await self.record_votes(conn, rows)
+
+        # committed, now what the Session after_commit hooks would do
+        for key, remembered_id in remembered:
+            game_user_cache.put(key, remembered_id)
+        if pairing.adaptive_pairing_enabled():
+            committed = []
+            for row in rows:
+                loc = await self.location(row['asset_id'])
+                if loc is not None:
+                    committed.append((loc.campaign_id, row['asset_id'], row['rank']))
+            pairing_index.votes_committed(committed)
+        return gu_id
@@ -0,0 +1,326 @@
+from models import photogame
+from logsetup import logger
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from sqlalchemy import select, func
+import dbsetup
+import argparse
+import json
+import time
+import sys
+import os
+
+#
+# Bulk asset ingestion
+#
+# Loads a directory (or a manifest listing one image path per line) into a
+# campaign. Image files are hashed and copied into the content-addressed
+# blob store (see PhotoGameBlob) by a thread pool, so an image that's
+# already stored, in this campaign or any other, isn't written again. Each
+# batch's pgblob references are taken with a handful of statements and
+# its pgasset rows go in as one multi-row INSERT. While a batch's rows are
+# inserted the next batch is already being written.
+#
+# Each batch is journalled to a state file around its INSERT, so a run
+# that's interrupted can simply be started again: images in a committed
+# batch are skipped, and a batch caught mid INSERT is looked for in
+# pgasset (it went in all or nothing, after the campaign's highest asset
+# id at the time). Run one ingest per campaign at a time. A blob written
+# for a batch that never committed stays in the store unreferenced, and
+# is picked up again if the same image is ingested later.
+#
+# Rows are inserted with core statements, so running widget processes
+# see the new assets when their asset index is next re-read
+# (ASSET_INDEX_MAX_AGE).
+#
+#   python -m controllers.bulkingest 42 /data/onboarding/acme/
+#   python -m controllers.bulkingest 42 acme.manifest --workers 32
+#
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+def list_sources(source: str) -> list:
+    # a directory is walked for images (sorted, so a rerun sees the same
+    # order), anything else is a manifest with relative paths resolved
+    # against the manifest's directory
+    if os.path.isdir(source):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                    found.append(os.path.join(dirpath, filename))
+        return found
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, 'r') as fp:
+        return [os.path.join(base, line.strip()) for line in fp if line.strip() != '' and not line.startswith('#')]
+
+
+def source_extension(path: str) -> str:
+    # 'IMG_0001.jpeg' -> 'JPEG', create_asset() names files with upper case extensions
+    ext = os.path.splitext(path)[1].lstrip('.').upper()
+    return ext if ext != '' else 'JPG'
+
+
+class IngestState():
+    # the images already ingested into a campaign, as a journal of json
+    # lines: {"batch": n, "after_id": id}, then a line per image, then
+    # {"committed": n} once the batch's INSERT has committed. A batch
+    # without its committed line was cut short, whether its rows made it
+    # is for BulkIngest.resolve() to find out.
+    _filename = None
+    _done = None
+    _unconfirmed = None
+    _after_id = None
+    _torn = False   # the last line was cut short, start a new one before appending
+
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._done = set()
+        self._unconfirmed = []
+        try:
+            with open(filename, 'r') as fp:
+                for line in fp:
+                    self._torn = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption we're resuming from
+                    if 'batch' in entry:
+                        self._unconfirmed = []
+                        self._after_id = entry.get('after_id', None)
+                    elif 'committed' in entry:
+                        self._done.update(row['source'] for row in self._unconfirmed)
+                        self._unconfirmed = []
+                    elif 'source' in entry:
+                        self._unconfirmed.append(entry)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def __contains__(self, source: str) -> bool:
+        return source in self._done
+
+    def unconfirmed(self) -> list:
+        return list(self._unconfirmed)
+
+    def after_id(self) -> int:
+        # the campaign's highest asset id before the unconfirmed batch
+        return self._after_id
+
+    def append(self, entries: list) -> None:
+        with open(self._filename, 'a') as fp:
+            if self._torn:
+                fp.write('\n')
+                self._torn = False
+            for entry in entries:
+                fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def begin(self, rows: list, after_id: int) -> None:
+        # before the rows are inserted
+        self._unconfirmed = [{'source': row['source'], 'sha256': row['sha256']} for row in rows]
+        self._after_id = after_id
+        self.append([{'batch': len(rows), 'after_id': after_id}] + self._unconfirmed)
+
+    def commit(self) -> None:
+        # ... and once they're committed
+        self.append([{'committed': len(self._unconfirmed)}])
+        self._done.update(row['source'] for row in self._unconfirmed)
+        self._unconfirmed = []
+
+    def discard(self) -> None:
+        # the batch never made it, a new batch marker drops it on the next load too
+        self.append([{'batch': 0}])
+        self._unconfirmed = []
+
+
+class IngestStats():
+    files = 0
+    bytes = 0
+    failed = 0
+    skipped = 0
+    _start = None
+
+    def __init__(self):
+        self._start = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def files_per_second(self) -> float:
+        elapsed = self.elapsed()
+        return self.files / elapsed if elapsed > 0 else 0.0
+
+    def report(self) -> str:
+        elapsed = self.elapsed()
+        return '{0} files ({1:.1f} MB) in {2:.1f}s, {3:.1f} files/s, {4:.1f} MB/s, {5} failed, {6} already ingested'.format(
+            self.files, self.bytes / (1024 * 1024), elapsed, self.files_per_second(),
+            self.bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0, self.failed, self.skipped)
+
+
+class BulkIngest():
+    _campaign_id = None
+    _state = None
+    _engine = None
+    _mnt_point = None
+    _workers = None
+    _batch = None
+
+    def __init__(self, **kwargs):
+        self._campaign_id = kwargs.get('campaign_id', None)
+        self._state = kwargs.get('state', None)
+        self._engine = kwargs.get('engine', dbsetup.engine)
+        self._mnt_point = kwargs.get('mnt_point', None)
+        self._workers = kwargs.get('workers', dbsetup.Configuration.BULK_INGEST_WORKERS)
+        self._batch = kwargs.get('batch', dbsetup.Configuration.BULK_INGEST_BATCH)
+        if self._mnt_point is None:
+            self._mnt_point = dbsetup.image_store(dbsetup.determine_environment(None))
+
+    def copy_file(self, source: str) -> dict:
+        # runs on the pool: the blob for source, None if it couldn't be copied
+        try:
+            with open(source, 'rb') as fp:
+                img = fp.read()
+            sha256 = photogame.PhotoGameBlob.content_hash(img)
+            filepath, filename = photogame.PhotoGameBlob.location(sha256, source_extension(source), self._mnt_point)
+            photogame.PhotoGameAsset().store_blob_file(os.path.join(filepath, filename), img)
+            return {'source': source, 'sha256': sha256, 'filepath': filepath, 'filename': filename, 'size': len(img)}
+        except Exception as e:
+            logger.exception(msg="[bulkingest] error copying {0}".format(source))
+            return None
+
+    def last_asset_id(self, conn) -> int:
+        tbl = photogame.PhotoGameAsset.__table__
+        return conn.execute(select([func.coalesce(func.max(tbl.c.id), 0)]).where(tbl.c.campaign_id == self._campaign_id)).scalar()
+
+    def acquire_blobs(self, conn, rows: list) -> dict:
+        # PhotoGameBlob.acquire() for a whole batch: sha256 -> (blob id,
+        # filepath, filename), with a reference taken for every row. Blobs
+        # stored before keep their location (their extension may differ).
+        # Another ingest inserting the same new blob at the same moment
+        # fails the batch, a rerun picks it up.
+        tbl = photogame.PhotoGameBlob.__table__
+        counts = Counter(row['sha256'] for row in rows)
+        q = select([tbl.c.sha256, tbl.c.id, tbl.c.filepath, tbl.c.filename]).where(tbl.c.sha256.in_(list(counts)))
+        blobs = {r[0]: (r[1], r[2], r[3]) for r in conn.execute(q.with_for_update())}
+
+        by_count = {}
+        for sha256, blob in blobs.items():
+            by_count.setdefault(counts[sha256], []).append(blob[0])
+        for n, blob_ids in by_count.items():
+            conn.execute(tbl.update().where(tbl.c.id.in_(blob_ids)).values(refcount=tbl.c.refcount + n))
+
+        new_blobs = {}
+        for row in rows:
+            if row['sha256'] not in blobs and row['sha256'] not in new_blobs:
+                new_blobs[row['sha256']] = {'sha256': row['sha256'], 'filepath': row['filepath'], 'filename': row['filename'],
+                                            'size': row['size'], 'refcount': counts[row['sha256']]}
+        if len(new_blobs) > 0:
+            conn.execute(tbl.insert(), list(new_blobs.values()))
+            blobs.update({r[0]: (r[1], r[2], r[3]) for r in conn.execute(q.where(tbl.c.sha256.in_(list(new_blobs))))})
+        return blobs
+
+    def insert_rows(self, conn, rows: list, blobs: dict) -> None:
+        tbl = photogame.PhotoGameAsset.__table__
+        assets = []
+        for row in rows:
+            blob_id, filepath, filename = blobs[row['sha256']]
+            path_and_name = os.path.join(filepath, filename)
+            if not os.path.exists(path_and_name):
+                # released and deleted since our worker looked, we hold its lock now
+                with open(row['source'], 'rb') as fp:
+                    photogame.PhotoGameAsset().store_blob_file(path_and_name, fp.read())
+            assets.append({'campaign_id': self._campaign_id, 'filepath': filepath, 'filename': filename,
+                           'blob_id': blob_id, 'active': 1})
+        conn.execute(tbl.insert(), assets)
+
+    def commit_batch(self, futures: list, stats: IngestStats) -> None:
+        rows = []
+        for future in futures:
+            row = future.result()
+            if row is None:
+                stats.failed += 1  # not recorded, so the next run tries it again
+            else:
+                rows.append(row)
+        if len(rows) == 0:
+            return
+        with self._engine.begin() as conn:
+            self._state.begin(rows, self.last_asset_id(conn))
+            self.insert_rows(conn, rows, self.acquire_blobs(conn, rows))
+        self._state.commit()
+        stats.files += len(rows)
+        stats.bytes += sum(row['size'] for row in rows)
+
+    def resolve(self) -> None:
+        # the batch an interrupted run was inserting: it committed if the
+        # campaign has assets newer than the ones it had before the batch
+        if len(self._state.unconfirmed()) == 0:
+            return
+        with self._engine.connect() as conn:
+            committed = self.last_asset_id(conn) > (self._state.after_id() or 0)
+        if committed:
+            self._state.commit()
+        else:
+            self._state.discard()
+
+    def run(self, sources: list, progress=None) -> IngestStats:
+        self.resolve()
+        stats = IngestStats()
+        pending = [source for source in sources if source not in self._state]
+        stats.skipped = len(sources) - len(pending)
+
+        # batch n is inserted while batch n+1 is being written
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            in_flight = None
+            for i in range(0, len(pending), self._batch):
+                futures = [pool.submit(self.copy_file, source) for source in pending[i:i + self._batch]]
+                if in_flight is not None:
+                    self.commit_batch(in_flight, stats)
+                    if progress is not None:
+                        progress(stats)
+                in_flight = futures
+            if in_flight is not None:
+                self.commit_batch(in_flight, stats)
+        return stats
+
+
+def campaign_exists(campaign_id: int) -> bool:
+    session = dbsetup.Session()
+    try:
+        return session.query(photogame.Campaign).get(campaign_id) is not None
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add a directory (or manifest) of images to a campaign')
+    parser.add_argument('campaign_id', type=int)
+    parser.add_argument('source', help='a directory of images, or a file listing one image path per line')
+    parser.add_argument('--workers', type=int, default=dbsetup.Configuration.BULK_INGEST_WORKERS, help='threads writing files')
+    parser.add_argument('--batch', type=int, default=dbsetup.Configuration.BULK_INGEST_BATCH, help='rows per INSERT')
+    parser.add_argument('--state', default=None, help='resume file (default: bulkingest_<campaign_id>.state)')
+    parser.add_argument('--mnt-point', default=None, help='image store to write to (default: this environment\'s)')
+    args = parser.parse_args()
+
+    if not campaign_exists(args.campaign_id):
+        print('campaign {0} not found'.format(args.campaign_id))
+        return 1
+
+    state = IngestState(args.state or 'bulkingest_{0}.state'.format(args.campaign_id))
+    sources = list_sources(args.source)
+    print('campaign {0}: {1} images, {2} already ingested'.format(args.campaign_id, len(sources), len(state)))
+
+    ingest = BulkIngest(campaign_id=args.campaign_id, state=state, workers=args.workers, batch=args.batch, mnt_point=args.mnt_point)
+    stats = ingest.run(sources, progress=lambda s: print(s.report()))
+    print(stats.report())
+    return 0 if stats.failed == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+from controllers.assetlookup import AssetLocation
+from PIL import Image
+from contextlib import contextmanager
+import dbsetup
+import threading
+import errno
+import os
+
+# Pillow's save() format names for our stored extensions
+PIL_FORMATS = {'JPG': 'JPEG',
+               'JPEG': 'JPEG',
+               'PNG': 'PNG',
+               'GIF': 'GIF',
+               'BMP': 'BMP',
+               'TIF': 'TIFF',
+               'TIFF': 'TIFF'}
+
+
+def requested_size(args: dict) -> (int, int):
+    # ?w=120&h=120 -> (120, 120), None if no resize was asked for.
+    # Sizes are rounded up to DERIVATIVE_SIZE_STEP and capped, so we
+    # end up with a handful of derivatives per asset, not one per
+    # distinct query string. Raises ValueError for garbage.
+    w = args.get('w', None)
+    h = args.get('h', None)
+    if w is None and h is None:
+        return None
+
+    step = dbsetup.Configuration.DERIVATIVE_SIZE_STEP
+    max_dim = dbsetup.Configuration.DERIVATIVE_MAX_DIMENSION
+    size = []
+    for dim in (w, h):
+        dim = int(dim) if dim is not None else max_dim
+        if dim <= 0:
+            raise ValueError('invalid dimension')
+        size.append(min(((dim + step - 1) // step) * step, max_dim))
+    return size[0], size[1]
+
+
+def fitted_size(size: (int, int), box: (int, int)) -> (int, int):
+    # the size resize() will produce for an image of size, the same
+    # arithmetic Image.thumbnail() uses
+    x, y = size
+    if x > box[0]:
+        y = int(max(y * box[0] / x, 1))
+        x = int(box[0])
+    if y > box[1]:
+        x = int(max(x * box[1] / y, 1))
+        y = int(box[1])
+    return x, y
+
+
+def derivative_dir(loc: AssetLocation) -> str:
+    # derivatives mirror the original's <mnt>/ddd/ddd/ddd sub path under
+    # <mnt>/derivatives, so they're sharded the same way as the originals
+    mnt_point = dbsetup.image_store(dbsetup.determine_environment(None))
+    if mnt_point is not None:
+        sub_path = os.path.relpath(loc.filepath, mnt_point)
+        if not sub_path.startswith('..'):
+            return os.path.normpath(mnt_point + '/derivatives/' + sub_path)
+    return os.path.normpath(loc.filepath + '/derivatives')
+
+
+def derivative_filename(loc: AssetLocation, width: int, height: int) -> str:
+    stem, dot, extension = loc.filename.rpartition('.')
+    return os.path.normpath('{0}/{1}_{2}x{3}.{4}'.format(derivative_dir(loc), stem, width, height, extension))
+
+
+class SingleFlight():
+    # one lock per key, held while the key's derivative is being made;
+    # a burst of requests for it waits and then finds the file on disk
+    _locks = None
+    _lock = None
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.get(key, None)
+            if entry is None:
+                entry = [threading.Lock(), 0]
+                self._locks[key] = entry
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+_single_flight = SingleFlight()
+
+
+def resize(src_filename: str, dst_filename: str, width: int, height: int) -> None:
+    # fit the image inside width x height keeping its aspect ratio. The
+    # result is written to a temp file and renamed into place, so other
+    # workers never see a partial derivative
+    extension = dst_filename.rpartition('.')[2].upper()
+    pil_format = PIL_FORMATS.get(extension, 'JPEG')
+
+    src = Image.open(src_filename)
+    try:
+        img = src
+        img.thumbnail((width, height), Image.LANCZOS)
+        if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        tmp_filename = '{0}.{1}.tmp'.format(dst_filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(dst_filename))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if pil_format == 'JPEG':
+            img.save(tmp_filename, pil_format, quality=dbsetup.Configuration.DERIVATIVE_JPEG_QUALITY, optimize=True)
+        else:
+            img.save(tmp_filename, pil_format)
+        os.replace(tmp_filename, dst_filename)
+    finally:
+        src.close()
+
+
+def derivative(loc: AssetLocation, width: int, height: int) -> str:
+    # path of the width x height derivative of the asset, made on first use
+    dst_filename = derivative_filename(loc, width, height)
+    if os.path.exists(dst_filename):
+        return dst_filename
+
+    with _single_flight.hold(dst_filename):
+        if not os.path.exists(dst_filename):
+            resize(os.path.normpath(loc.filepath + '/' + loc.filename), dst_filename, width, height)
+    return dst_filename
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from sqlalchemy import event
+import dbsetup
+import threading
+
+
+class GameUserCache():
+    # LRU of (client_id, client_userid) -> gameuser.id and
+    # ii_userid -> gameuser.id, so a returning voter costs no SQL.
+    # A gameuser row never changes who it belongs to, so entries never
+    # go stale; ids are only cached once the row is committed (see
+    # remember() below), a rolled back user never makes it in here.
+    _entries = None
+    _lock = None
+    _max_entries = None
+
+    def __init__(self, **kwargs):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = kwargs.get('max_entries', dbsetup.Configuration.GAME_USER_CACHE_MAX_ENTRIES)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def get(self, key) -> int:
+        with self._lock:
+            gu_id = self._entries.get(key, None)
+            if gu_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return gu_id
+
+    def put(self, key, gu_id: int) -> None:
+        with self._lock:
+            self._entries[key] = gu_id
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None) -> None:
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+game_user_cache = GameUserCache()
+
+
+def client_key(client_id: int, client_userid: str) -> tuple:
+    return 'client', client_id, client_userid
+
+
+def ii_key(ii_userid: str) -> tuple:
+    return 'ii', ii_userid
+
+
+def remember(session, key, gu_id: int) -> None:
+    # cache key -> gu_id once the session commits
+    session.info.setdefault('game_users', []).append((key, gu_id))
+
+
+@event.listens_for(dbsetup.Session, 'after_commit')
+def apply_game_users(session):
+    for key, gu_id in session.info.pop('game_users', []):
+        game_user_cache.put(key, gu_id)
+
+
+@event.listens_for(dbsetup.Session, 'after_rollback')
+def discard_game_users(session):
+    session.info.pop('game_users', None)
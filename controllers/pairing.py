@@ -0,0 +1,322 @@
+from models import photogame
+from controllers import assetindex
+from sqlalchemy import event, func
+from random import random
+import dbsetup
+import threading
+import math
+import time
+
+#
+# Adaptive pairing
+#
+# Uniformly random ballots spend most votes on assets whose place is
+# already clear while others are hardly ever shown. With ADAPTIVE_PAIRING=1
+# ballots are drawn from a PairingIndex instead of the asset index:
+#
+#   - the first asset is drawn with probability proportional to how
+#     uncertain its score is (the standard error of its smoothed win rate,
+#     so assets with few appearances come up more often)
+#   - each other asset is the one, out of a few more drawn the same way,
+#     whose score is closest to the first's, as close pairs tell us the
+#     most about the ranking
+#
+# Weights live in a Fenwick tree, so drawing an asset and updating its
+# weight are both O(log n) however big the campaign gets.
+#
+
+
+class FenwickTree():
+    # prefix sums over a growable list of non-negative weights
+    _tree = None
+    _weights = None
+
+    def __init__(self, weights=None):
+        self._weights = list(weights) if weights is not None else []
+        self._tree = [0.0] + self._weights
+        n = len(self._tree)
+        for idx in range(1, n):  # O(n) build
+            parent = idx + (idx & -idx)
+            if parent < n:
+                self._tree[parent] += self._tree[idx]
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def weight(self, idx: int) -> float:
+        return self._weights[idx]
+
+    def prefix(self, idx: int) -> float:
+        # sum of weights [0, idx)
+        total = 0.0
+        while idx > 0:
+            total += self._tree[idx]
+            idx -= idx & -idx
+        return total
+
+    def total(self) -> float:
+        return self.prefix(len(self._weights))
+
+    def set(self, idx: int, weight: float) -> None:
+        delta = weight - self._weights[idx]
+        self._weights[idx] = weight
+        idx += 1
+        while idx < len(self._tree):
+            self._tree[idx] += delta
+            idx += idx & -idx
+
+    def append(self, weight: float) -> int:
+        idx = len(self._tree)
+        self._tree.append(weight + self.prefix(idx - 1) - self.prefix(idx - (idx & -idx)))
+        self._weights.append(weight)
+        return idx - 1
+
+    def find(self, u: float) -> int:
+        # the index whose cumulative weight range holds u
+        idx = 0
+        step = 1 << (len(self._tree).bit_length())
+        while step > 0:
+            nxt = idx + step
+            if nxt < len(self._tree) and self._tree[nxt] <= u:
+                idx = nxt
+                u -= self._tree[nxt]
+            step >>= 1
+        return min(idx, len(self._weights) - 1)
+
+
+def uncertainty(appearances: int, wins: int) -> float:
+    # standard error of the asset's win rate, smoothed with one win
+    # and one loss so new assets don't start at 0 or 1
+    p = (wins + 1) / (appearances + 2)
+    return math.sqrt(p * (1 - p) / (appearances + 2))
+
+
+class CampaignPairing():
+    # per asset slot: id, appearances and wins (from pgtally plus the
+    # votes this worker has committed since), ballots it's been served on
+    # that haven't been voted on yet, active flag; weights in a Fenwick tree
+    _ids = None
+    _pos = None
+    _appearances = None
+    _wins = None
+    _shown = None
+    _active = None
+    _weights = None
+    _loaded = None
+    _count = 0
+
+    def __init__(self, rows=None):
+        # rows of (asset_id, appearances, wins)
+        rows = rows or []
+        self._ids = [row[0] for row in rows]
+        self._pos = {asset_id: idx for idx, asset_id in enumerate(self._ids)}
+        self._appearances = [row[1] for row in rows]
+        self._wins = [row[2] for row in rows]
+        self._shown = [0] * len(rows)
+        self._active = [True] * len(rows)
+        self._count = len(rows)
+        self._weights = FenwickTree(uncertainty(row[1], row[2]) for row in rows)
+        self._loaded = time.time()
+
+    def __contains__(self, asset_id: int) -> bool:
+        idx = self._pos.get(asset_id, None)
+        return idx is not None and self._active[idx]
+
+    def __len__(self) -> int:
+        # active assets
+        return self._count
+
+    def is_stale(self, max_age: float) -> bool:
+        return max_age is not None and time.time() - self._loaded > max_age
+
+    def score(self, idx: int) -> float:
+        return (self._wins[idx] + 1) / (self._appearances[idx] + 2)
+
+    def reweight(self, idx: int) -> None:
+        # a served ballot counts as an appearance until its vote comes in,
+        # which keeps one worker from handing out the same pair in a burst
+        if self._active[idx]:
+            self._weights.set(idx, uncertainty(self._appearances[idx] + self._shown[idx], self._wins[idx]))
+        else:
+            self._weights.set(idx, 0.0)
+
+    def add(self, asset_id: int) -> None:
+        idx = self._pos.get(asset_id, None)
+        if idx is None:
+            idx = self._weights.append(0.0)
+            self._pos[asset_id] = idx
+            self._ids.append(asset_id)
+            self._appearances.append(0)
+            self._wins.append(0)
+            self._shown.append(0)
+            self._active.append(False)
+        if not self._active[idx]:
+            self._active[idx] = True
+            self._count += 1
+        self.reweight(idx)
+
+    def remove(self, asset_id: int) -> None:
+        idx = self._pos.get(asset_id, None)
+        if idx is not None and self._active[idx]:
+            self._active[idx] = False
+            self._count -= 1
+            self.reweight(idx)
+
+    def record(self, asset_id: int, won: bool) -> None:
+        # a committed vote for the asset
+        idx = self._pos.get(asset_id, None)
+        if idx is not None:
+            self._appearances[idx] += 1
+            self._wins[idx] += 1 if won else 0
+            self._shown[idx] = max(0, self._shown[idx] - 1)
+            self.reweight(idx)
+
+    def draw(self, exclude: set) -> int:
+        # a slot drawn by weight that isn't in exclude, None if we can't find one
+        total = self._weights.total()
+        for attempt in range(8):
+            if total <= 0.0:
+                break
+            idx = self._weights.find(random() * total)
+            if self._active[idx] and self._weights.weight(idx) > 0.0 and idx not in exclude:
+                return idx
+        # (nearly) everything left is excluded, fall back to a scan
+        candidates = [idx for idx in range(len(self._ids)) if self._active[idx] and idx not in exclude]
+        return candidates[int(random() * len(candidates))] if len(candidates) > 0 else None
+
+    def sample(self, ballot_size: int, candidates: int) -> list:
+        first = self.draw(set())
+        assert(first is not None)
+        chosen = [first]
+        target = self.score(first)
+        while len(chosen) < ballot_size:
+            exclude = set(chosen)
+            best = None
+            for c in range(candidates):
+                idx = self.draw(exclude)
+                if idx is None:
+                    break
+                if best is None or abs(self.score(idx) - target) < abs(self.score(best) - target):
+                    best = idx
+            assert(best is not None)
+            chosen.append(best)
+
+        for idx in chosen:
+            self._shown[idx] += 1
+            self.reweight(idx)
+        return [self._ids[idx] for idx in chosen]
+
+
+class PairingIndex():
+    # The adaptive counterpart of assetindex.AssetIndex, one
+    # CampaignPairing per campaign, re-read from pgtally every _max_age
+    # seconds to pick up the votes other workers have tallied.
+    _campaigns = None
+    _lock = None
+    _max_age = None
+    _candidates = None
+
+    def __init__(self, **kwargs):
+        self._campaigns = {}
+        self._lock = threading.Lock()
+        self._max_age = kwargs.get('max_age', dbsetup.Configuration.ASSET_INDEX_MAX_AGE)
+        self._candidates = kwargs.get('candidates', dbsetup.Configuration.ADAPTIVE_PAIRING_CANDIDATES)
+
+    def load_campaign(self, session, campaign_id: int) -> CampaignPairing:
+        try:
+            a = photogame.PhotoGameAsset
+            t = photogame.PhotoGameTally
+            q = session.query(a.id, func.coalesce(t.appearances, 0), func.coalesce(t.wins, 0)).\
+                outerjoin(t, t.asset_id == a.id).\
+                filter(a.campaign_id == campaign_id).\
+                filter(a.active == 1)
+            rows = q.all()
+        except Exception as e:
+            raise
+        return self.install(campaign_id, rows)
+
+    def install(self, campaign_id: int, rows: list) -> CampaignPairing:
+        # rows of (asset_id, appearances, wins) for the campaign's active assets
+        cp = CampaignPairing(rows)
+        with self._lock:
+            self._campaigns[campaign_id] = cp
+        return cp
+
+    def cached(self, campaign_id: int) -> CampaignPairing:
+        cp = self._campaigns.get(campaign_id, None)
+        if cp is None or cp.is_stale(self._max_age):
+            return None
+        return cp
+
+    def campaign_pairing(self, session, campaign_id: int) -> CampaignPairing:
+        cp = self.cached(campaign_id)
+        if cp is None:
+            cp = self.load_campaign(session, campaign_id)
+        return cp
+
+    def ballot(self, session, campaign_id: int, ballot_size: int) -> list:
+        return self.sample(self.campaign_pairing(session, campaign_id), ballot_size)
+
+    def ballots(self, session, campaign_id: int, ballot_size: int, n: int) -> list:
+        return self.sample_ballots(self.campaign_pairing(session, campaign_id), ballot_size, n)
+
+    def sample(self, cp: CampaignPairing, ballot_size: int) -> list:
+        with self._lock:
+            return cp.sample(ballot_size, self._candidates)
+
+    def sample_ballots(self, cp: CampaignPairing, ballot_size: int, n: int) -> list:
+        with self._lock:
+            return [cp.sample(ballot_size, self._candidates) for b in range(n)]
+
+    def asset_changed(self, campaign_id: int, asset_id: int, active: bool) -> None:
+        with self._lock:
+            cp = self._campaigns.get(campaign_id, None)
+            if cp is None:
+                return
+            if active:
+                cp.add(asset_id)
+            else:
+                cp.remove(asset_id)
+
+    def votes_committed(self, votes: list) -> None:
+        # votes of (campaign_id, asset_id, rank)
+        with self._lock:
+            for campaign_id, asset_id, rank in votes:
+                cp = self._campaigns.get(campaign_id, None)
+                if cp is not None:
+                    cp.record(asset_id, rank == 1)
+
+    def invalidate(self, campaign_id=None) -> None:
+        with self._lock:
+            if campaign_id is None:
+                self._campaigns.clear()
+            else:
+                self._campaigns.pop(campaign_id, None)
+
+
+def adaptive_pairing_enabled() -> bool:
+    return dbsetup.Configuration.ADAPTIVE_PAIRING
+
+
+pairing_index = PairingIndex()
+assetindex.change_listeners.append(pairing_index.asset_changed)
+
+
+def note_votes(session, rows: list, campaign_for_asset) -> None:
+    # pgresult rows being inserted, handed to the pairing index once
+    # the session commits
+    if adaptive_pairing_enabled():
+        votes = session.info.setdefault('pairing_votes', [])
+        votes.extend((campaign_for_asset(row['asset_id']), row['asset_id'], row['rank']) for row in rows)
+
+
+@event.listens_for(dbsetup.Session, 'after_commit')
+def apply_pairing_votes(session):
+    votes = session.info.pop('pairing_votes', None)
+    if votes is not None:
+        pairing_index.votes_committed(votes)
+
+
+@event.listens_for(dbsetup.Session, 'after_rollback')
+def discard_pairing_votes(session):
+    session.info.pop('pairing_votes', None)
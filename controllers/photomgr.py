@@ -1,29 +1,20 @@
 from models import photogame
-from random import randint, shuffle
-import os
+from controllers.assetindex import asset_index
+from controllers.assetlookup import asset_locations
+from controllers import gameusers, derivatives, pairing
+from controllers.pairing import pairing_index
+from controllers.gameusers import game_user_cache
+from controllers.usertoken import UserToken, user_tokens
+from sqlalchemy import exc
+import dbsetup
 import uuid
 
 class PhotoImageAsset():
-    _binary_image = None
-    _extension = None
+    # a ballot entry, the image itself is streamed from disk by /asset
     _asset_id = None
 
     def __init__(self, **kwargs):
-        if len(kwargs) == 0:
-            return
-        pga = kwargs.get('pga', None)
-        if pga is not None:
-            self._asset_id = pga.id
-            self._extension = pga.filename[-3:]
-            load_image = kwargs.get('load_image', False)
-            if load_image:
-                try:
-                    ft = open(os.path.normpath(pga.filepath + '/' + pga.filename), 'rb')
-                    self._binary_image = ft.read()
-                except Exception as e:
-                    raise
-                finally:
-                    ft.close()
+        self._asset_id = kwargs.get('asset_id', None)
 
 class PhotoGameMgr():
 
@@ -32,90 +23,157 @@ class PhotoGameMgr():
             return
 
     def find_ii_user(self, session, user_id: str) -> int:
+        key = gameusers.ii_key(user_id)
+        gu_id = game_user_cache.get(key)
+        if gu_id is not None:
+            return gu_id
+
         try:
-            q = session.query(photogame.GameUser).filter(photogame.GameUser.ii_userid == user_id)
-            gu = q.one_or_none()
-            if gu is not None:
-                return gu.id
+            q = session.query(photogame.GameUser.id).\
+                filter(photogame.GameUser.ii_userid == user_id).\
+                order_by(photogame.GameUser.id)
+            row = q.first()
+            if row is not None:
+                gameusers.remember(session, key, row[0])
+                return row[0]
 
         except Exception as e:
             raise
 
     def find_client_and_campaign_from_asset(self, session, asset_id: int) -> (int, int):
         try:
-            q = session.query(photogame.Campaign).\
-                join(photogame.PhotoGameAsset, photogame.PhotoGameAsset.campaign_id == photogame.Campaign.id).\
-                filter(photogame.PhotoGameAsset.id == asset_id)
-            c = q.one_or_none()
-            return c.client_id, c.id
+            loc = asset_locations.lookup(session, asset_id)
+            cw = photogame.campaign_cache.lookup(session, loc.campaign_id)
+            return cw.client_id, cw.id
         except Exception as e:
             raise
 
     def find_client_user(self, session, user_id: str, ii_user_id: str, asset_id: int) -> int:
+        # (client_id, client_userid) is unique, so two first votes racing
+        # each other can't both create the user: the loser's INSERT fails
+        # inside its savepoint and it reads the winner's row instead
         try:
-            q = session.query(photogame.GameUser).filter(photogame.GameUser.client_userid == user_id)
-            gu = q.one_or_none()
-            if gu is not None:
-                return gu.id
-
-            # if we have a client user_id and it's not in our DB, we need
-            # to create a record for it
             client_id, campaign_id = self.find_client_and_campaign_from_asset(session, asset_id)
-
-            # now we can create a user
-            gu = photogame.GameUser(client_id=client_id, client_user_id=user_id, ii_user_id=ii_user_id)
-            session.add(gu)
-            session.commit()
-            return gu.id
+            key = gameusers.client_key(client_id, user_id)
+            gu_id = game_user_cache.get(key)
+            if gu_id is not None:
+                return gu_id
+
+            q = session.query(photogame.GameUser.id).\
+                filter(photogame.GameUser.client_id == client_id).\
+                filter(photogame.GameUser.client_userid == user_id)
+            row = q.one_or_none()
+            if row is None:
+                # if we have a client user_id and it's not in our DB, we need
+                # to create a record for it. flush() gets us the id without
+                # committing, the caller commits it along with the votes
+                try:
+                    with session.begin_nested():
+                        gu = photogame.GameUser(client_id=client_id, client_user_id=user_id, ii_user_id=ii_user_id)
+                        session.add(gu)
+                        session.flush()
+                    gameusers.remember(session, key, gu.id)
+                    return gu.id
+                except exc.IntegrityError:
+                    # a locking read sees the other transaction's committed row
+                    row = q.with_for_update().one()
+
+            gameusers.remember(session, key, row[0])
+            return row[0]
 
         except Exception as e:
             raise
 
-    def tally_results(self, session, client_user_id: str, ii_user_id: str, votes: list):
-        grp_guid = str(uuid.uuid1()).upper().translate({ord(c): None for c in '-'})
+    def new_group_guid(self) -> str:
+        return str(uuid.uuid1()).upper().translate({ord(c): None for c in '-'})
 
+    def resolve_user(self, session, client_user_id: str, ii_user_id: str, asset_id: int) -> int:
         # lookup the user_id provided and get the FK
+        if client_user_id is not None:
+            return self.find_client_user(session, client_user_id, ii_user_id, asset_id)
+        return self.find_ii_user(session, ii_user_id)
+
+    def vote_rows(self, grp_guid: str, gu_id: int, votes: list) -> list:
+        return [{'group_guid': grp_guid, 'asset_id': vote['asset_id'], 'rank': vote['rank'], 'user_id': gu_id} for vote in votes]
+
+    def insert_votes(self, session, rows: list) -> None:
+        # one multi-row INSERT for any number of ballots, and the
+        # per-asset tallies updated in the same transaction
+        if len(rows) > 0:
+            campaign_for_asset = lambda asset_id: asset_locations.lookup(session, asset_id).campaign_id
+            session.execute(photogame.PhotoGameResult.__table__.insert(), rows)
+            photogame.PhotoGameTally.record_votes(session, rows, campaign_for_asset)
+            pairing.note_votes(session, rows, campaign_for_asset)
+
+    def campaign_leaders(self, session, campaign_id: int, n: int) -> list:
+        # the campaign's top n assets by wins, from the running tallies
+        leaders = []
+        for t in photogame.PhotoGameTally.top_assets(session, campaign_id, n):
+            leaders.append({'asset_id': t.asset_id,
+                            'appearances': t.appearances,
+                            'wins': t.wins,
+                            'win_rate': t.wins / t.appearances if t.appearances > 0 else 0.0,
+                            'average_rank': t.rank_sum / t.appearances if t.appearances > 0 else 0.0})
+        return leaders
+
+    def tally_results(self, session, client_user_id: str, ii_user_id: str, votes: list, grp_guid=None, token=None) -> int:
+        # Resolves the user (unless their token already tells us who they
+        # are) and inserts all the votes as one multi-row INSERT. Nothing
+        # is committed here, the caller commits the user (if we had to
+        # create one) and the votes in a single transaction.
+        if grp_guid is None:
+            grp_guid = self.new_group_guid()
+
         gu_id = None
-        asset_id = votes[0]['asset_id']
+        if token is not None:
+            gu_id = self.token_user(session, token, client_user_id, votes[0]['asset_id'])
+        if gu_id is None:
+            gu_id = self.resolve_user(session, client_user_id, ii_user_id, votes[0]['asset_id'])
+        self.insert_votes(session, self.vote_rows(grp_guid, gu_id, votes))
+        return gu_id
+
+    def token_user(self, session, token: UserToken, client_user_id: str, asset_id: int) -> int:
+        # the gameuser.id the voter's token vouches for, None if it doesn't
+        # cover this client_user_id on this asset's client
+        client_id = None
+        if client_user_id is not None:
+            client_id, campaign_id = self.find_client_and_campaign_from_asset(session, asset_id)
+        return token.gu_id if token.vouches_for(client_user_id, client_id) else None
+
+    def user_token(self, session, token: UserToken, client_user_id: str, asset_id: int, gu_id: int) -> UserToken:
+        # the token to hand back after a vote by gameuser gu_id
+        if gu_id is None or self.token_user(session, token, client_user_id, asset_id) == gu_id:
+            return token
+        client_id = None
         if client_user_id is not None:
-            gu_id = self.find_client_user(session, client_user_id, ii_user_id, asset_id)
-        else:
-            gu_id = self.find_ii_user(session, ii_user_id)
+            client_id, campaign_id = self.find_client_and_campaign_from_asset(session, asset_id)
+        return user_tokens.for_user(token, gu_id, client_id, client_user_id)
 
+    def validate_votes(self, session, votes: list) -> bool:
+        # what the DB would otherwise tell us (via FK errors) when the
+        # vote is written, for when it's written later (see votejournal)
+        if not isinstance(votes, list) or len(votes) == 0:
+            return False
         for vote in votes:
-            pgr = photogame.PhotoGameResult(group_guid=grp_guid, asset_id=vote['asset_id'], rank=vote['rank'], user_id=gu_id)
-            session.add(pgr)
-        session.commit()
-        return
+            if not isinstance(vote, dict):
+                return False
+            if not isinstance(vote.get('asset_id', None), int) or not isinstance(vote.get('rank', None), int):
+                return False
+            loc = asset_locations.lookup(session, vote['asset_id'])
+            if loc is None or not loc.active:
+                return False
+        return True
 
     def campaign_ballot(self, session, campaign_id: int, ballot_size: int) -> list:
-
+        # the asset index holds the active asset ids for the campaign,
+        # so only the first ballot for a campaign touches the DB
         try:
-            q = session.query(photogame.PhotoGameAsset).\
-                filter(photogame.PhotoGameAsset.campaign_id == campaign_id).\
-                filter(photogame.PhotoGameAsset.active == 1)
-            asset_list = q.all()
-
-            # from the asset list we need to create a random ballot
-            assert(len(asset_list) >= ballot_size)
-            shuffle(asset_list)
-            return asset_list[:ballot_size]
+            if pairing.adaptive_pairing_enabled():
+                return pairing_index.ballot(session, campaign_id, ballot_size)
+            return asset_index.ballot(session, campaign_id, ballot_size)
         except Exception as e:
             raise e
 
-    def read_asset(self, session, asset_id: int) -> bytes:
-        # get the filename information from the PhotoGameAsset record
-        try:
-            asset = session.query(photogame.PhotoGameAsset).get(asset_id)
-            if asset is None:
-                return None
-            ft = open(os.path.normpath(asset.filepath + '/' + asset.filename), 'rb')
-            image = ft.read()
-            ft.close()
-            return image
-        except Exception as e:
-            raise
-
     def get_photogame_assets(self, session, campaign_id: int, ii_user_id: str) -> list:
 
         pl = []
@@ -131,16 +189,43 @@ class PhotoGameMgr():
 
         # we have a group of photos (ballot_size=2), but these are just
         # asset ids, we need to get the images and return them
-        for pga in bl:
-            pi = PhotoImageAsset(pga=pga, load_image=False)
+        for asset_id in bl:
+            pi = PhotoImageAsset(asset_id=asset_id)
             pl.append(pi)
 
         return pl
 
-    def user_id_from_cookie(self, session, cookies: dict) -> str:
-        # read the ii_user_id from the cookie (if present)
-        ii_user_id = cookies.get('user_id', None)
-        if ii_user_id is None:
-            ii_user_id = str(uuid.uuid1())
-
-        return ii_user_id
\ No newline at end of file
+    def get_photogame_ballots(self, session, campaign_id: int, n: int, size=None) -> list:
+        # n ballots for the campaign in one go, each with a signed token and
+        # the width/height of its assets (or of the size derivative, if a
+        # resized image was asked for)
+        ballots = []
+        o_campaign = photogame.Campaign.find_campaign(session, campaign_id)
+        if o_campaign is None:
+            return ballots  # no active campaign
+
+        index = pairing_index if pairing.adaptive_pairing_enabled() else asset_index
+        for bl in index.ballots(session, campaign_id, ballot_size=2, n=n):
+            assets = []
+            for asset_id in bl:
+                loc = asset_locations.lookup(session, asset_id)
+                dims = asset_locations.dimensions(asset_id, loc) if loc is not None else None
+                if dims is not None and size is not None:
+                    dims = derivatives.fitted_size(dims, size)
+                assets.append({'asset_id': asset_id,
+                               'width': dims[0] if dims is not None else None,
+                               'height': dims[1] if dims is not None else None})
+            ballots.append({'token': user_tokens.issue_ballot(campaign_id, bl), 'assets': assets})
+
+        return ballots
+
+    def ballot_matches(self, ballot_token: str, votes: list) -> bool:
+        # the votes are for exactly the assets of a ballot we handed out
+        ballot = user_tokens.verify_ballot(ballot_token, dbsetup.Configuration.BALLOT_TOKEN_MAX_AGE)
+        if ballot is None:
+            return False
+        campaign_id, asset_ids = ballot
+        try:
+            return sorted(asset_ids) == sorted(vote['asset_id'] for vote in votes)
+        except (TypeError, KeyError):
+            return False
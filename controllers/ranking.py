@@ -0,0 +1,246 @@
+from models import photogame
+from controllers.derivatives import SingleFlight
+from sqlalchemy import select
+import numpy as np
+import dbsetup
+import threading
+import argparse
+import time
+
+#
+# Pairwise rankings
+#
+# Every ballot is turned into (winner, loser) pairs: the asset ranked
+# first beats each of the others on the ballot (with ballot_size=2 that's
+# one pair per ballot). Pairs are kept as two NumPy index arrays and the
+# fits are done with whole-array operations, so a campaign with millions
+# of votes fits in seconds.
+#
+
+
+def ballots_to_pairs(group_codes: np.ndarray, asset_ids: np.ndarray, ranks: np.ndarray) -> (np.ndarray, np.ndarray):
+    # rows of (ballot, asset, rank) -> winner asset ids, loser asset ids
+    if len(group_codes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    order = np.lexsort((ranks, group_codes))
+    groups = group_codes[order]
+    assets = asset_ids[order]
+    rnks = ranks[order]
+
+    # first row of each ballot (after sorting) is its winner
+    first = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    first_pos = np.maximum.accumulate(np.where(first, np.arange(len(groups)), 0))
+
+    # ties with the winner aren't a preference either way
+    losers = ~first & (rnks != rnks[first_pos])
+    return assets[first_pos[losers]], assets[losers]
+
+
+class RankingModel():
+    # Bradley-Terry strengths (fit with Hunter's MM algorithm) and batch
+    # Elo ratings over a growing set of (winner, loser) pairs. Asset ids
+    # are mapped to dense indexes so everything is an array operation.
+    _index = None           # asset_id -> dense index
+    asset_ids = None        # dense index -> asset_id
+    winners = None          # dense indexes
+    losers = None
+    strength = None         # Bradley-Terry, geometric mean 1
+    elo = None
+    last_result_id = 0      # highest pgresult.id included
+    fitted = None           # time of the last (re)fit
+
+    def __init__(self, **kwargs):
+        self._index = {}
+        self.asset_ids = np.zeros(0, dtype=np.int64)
+        self.winners = np.zeros(0, dtype=np.int64)
+        self.losers = np.zeros(0, dtype=np.int64)
+        self.strength = np.ones(0)
+        self.elo = np.zeros(0)
+        self._prior = kwargs.get('prior', 1.0)  # virtual games against an average asset
+        self._tol = kwargs.get('tol', 1e-6)
+        self._max_iter = kwargs.get('max_iter', 500)
+        self._elo_k = kwargs.get('elo_k', 32.0)
+        self._elo_epochs = kwargs.get('elo_epochs', 20)
+
+    def __len__(self) -> int:
+        return len(self.winners)
+
+    def dense(self, asset_ids: np.ndarray) -> np.ndarray:
+        # map asset ids to dense indexes, adding new assets as needed
+        new_ids = [a for a in np.unique(asset_ids).tolist() if a not in self._index]
+        if len(new_ids) > 0:
+            for a in new_ids:
+                self._index[a] = len(self._index)
+            self.asset_ids = np.concatenate([self.asset_ids, np.array(new_ids, dtype=np.int64)])
+            self.strength = np.concatenate([self.strength, np.ones(len(new_ids))])
+            self.elo = np.concatenate([self.elo, np.zeros(len(new_ids))])
+        lookup = self._index
+        return np.fromiter((lookup[a] for a in asset_ids.tolist()), dtype=np.int64, count=len(asset_ids))
+
+    def add_pairs(self, winner_ids: np.ndarray, loser_ids: np.ndarray) -> None:
+        self.winners = np.concatenate([self.winners, self.dense(winner_ids)])
+        self.losers = np.concatenate([self.losers, self.dense(loser_ids)])
+
+    def fit_bradley_terry(self, max_iter=None) -> int:
+        # MM iterations, warm started from the current strengths
+        n = len(self.asset_ids)
+        if n == 0:
+            return 0
+        w, l = self.winners, self.losers
+        wins = np.bincount(w, minlength=n) + self._prior
+        p = self.strength
+        iterations = 0
+        for iterations in range(1, (max_iter or self._max_iter) + 1):
+            inv = 1.0 / (p[w] + p[l])
+            denom = np.bincount(w, weights=inv, minlength=n) + np.bincount(l, weights=inv, minlength=n)
+            denom += 2.0 * self._prior / (p + 1.0)
+            p_new = wins / denom
+            p_new /= np.exp(np.mean(np.log(p_new)))
+            delta = np.max(np.abs(np.log(p_new) - np.log(p)))
+            p = p_new
+            if delta < self._tol:
+                break
+        self.strength = p
+        return iterations
+
+    def fit_elo(self, epochs=None) -> None:
+        # batch Elo: every epoch applies all games at once from the same
+        # ratings, scaled by how many games each asset played
+        n = len(self.asset_ids)
+        if n == 0:
+            return
+        w, l = self.winners, self.losers
+        games = np.bincount(w, minlength=n) + np.bincount(l, minlength=n)
+        scale = 1.0 / np.maximum(games, 1)
+        r = self.elo
+        for epoch in range(epochs or self._elo_epochs):
+            expected = 1.0 / (1.0 + 10.0 ** ((r[l] - r[w]) / 400.0))
+            surprise = 1.0 - expected
+            r = r + (np.bincount(w, weights=surprise, minlength=n) - np.bincount(l, weights=surprise, minlength=n)) * scale * self._elo_k
+            r -= np.mean(r)
+        self.elo = r
+
+    def fit(self, max_iter=None) -> None:
+        self.fit_bradley_terry(max_iter)
+        self.fit_elo()
+        self.fitted = time.time()
+
+    def scores(self, method='bt') -> np.ndarray:
+        if method == 'elo':
+            return self.elo + 1500.0
+        return np.log(self.strength)
+
+    def top(self, n: int, method='bt') -> list:
+        scores = self.scores(method)
+        if len(scores) == 0:
+            return []
+        n = min(n, len(scores))
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best])]
+        games = np.bincount(self.winners, minlength=len(scores)) + np.bincount(self.losers, minlength=len(scores))
+        return [{'asset_id': int(self.asset_ids[i]), 'score': float(scores[i]), 'comparisons': int(games[i])} for i in best]
+
+
+def load_results(session, campaign_id: int, after_id=0) -> (np.ndarray, np.ndarray, np.ndarray, int):
+    # the campaign's votes with pgresult.id > after_id as arrays of
+    # (ballot code, asset id, rank), plus the highest id seen
+    r = photogame.PhotoGameResult.__table__
+    a = photogame.PhotoGameAsset.__table__
+    q = select([r.c.id, r.c.group_guid, r.c.asset_id, r.c.rank]).\
+        select_from(r.join(a, a.c.id == r.c.asset_id)).\
+        where(a.c.campaign_id == campaign_id).\
+        where(r.c.id > after_id)
+    rows = session.execute(q).fetchall()
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), after_id
+
+    ids, guids, asset_ids, ranks = zip(*rows)
+    guid_codes = np.unique(np.array(guids), return_inverse=True)[1]
+    return guid_codes, np.array(asset_ids, dtype=np.int64), np.array(ranks, dtype=np.int64), max(ids)
+
+
+def update_model(session, model: RankingModel, campaign_id: int, max_iter=None) -> int:
+    # add the votes since the model was last updated and refit, starting
+    # from the previous fit. Returns the number of new pairs.
+    group_codes, asset_ids, ranks, last_id = load_results(session, campaign_id, model.last_result_id)
+    winner_ids, loser_ids = ballots_to_pairs(group_codes, asset_ids, ranks)
+    model.add_pairs(winner_ids, loser_ids)
+    model.last_result_id = last_id
+    if len(winner_ids) > 0 or model.fitted is None:
+        model.fit(max_iter)
+    return len(winner_ids)
+
+
+class RankingCache():
+    # one model per campaign, brought up to date with the new votes at
+    # most every _refresh seconds. A model is rebuilt from scratch every
+    # _rebuild seconds, which also picks up ballots that committed out
+    # of pgresult.id order. _lock only guards _models, the loading and
+    # fitting is done holding just the campaign's own lock, so a slow
+    # campaign doesn't hold up the others.
+    _models = None
+    _lock = None
+    _updates = None     # SingleFlight, one update per campaign at a time
+    _refresh = None
+    _rebuild = None
+
+    def __init__(self, **kwargs):
+        self._models = {}
+        self._lock = threading.Lock()
+        self._updates = SingleFlight()
+        self._refresh = kwargs.get('refresh', dbsetup.Configuration.RANKING_REFRESH)
+        self._rebuild = kwargs.get('rebuild', dbsetup.Configuration.RANKING_REBUILD)
+
+    def model(self, session, campaign_id: int) -> RankingModel:
+        with self._updates.hold(campaign_id):
+            with self._lock:
+                entry = self._models.get(campaign_id, None)
+                now = time.time()
+                if entry is None or now - entry[1] > self._rebuild:
+                    entry = [RankingModel(), now, 0.0]
+                    self._models[campaign_id] = entry
+                model = entry[0]
+                stale = now - entry[2] > self._refresh
+
+            # whoever waited on us finds the model fresh and returns it
+            if stale:
+                update_model(session, model, campaign_id, max_iter=None if model.fitted is None else 50)
+                entry[2] = now
+            return model
+
+    def invalidate(self, campaign_id=None) -> None:
+        with self._lock:
+            if campaign_id is None:
+                self._models.clear()
+            else:
+                self._models.pop(campaign_id, None)
+
+
+ranking_cache = RankingCache()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank a campaign\'s assets from its pairwise votes')
+    parser.add_argument('campaign_id', type=int)
+    parser.add_argument('--method', choices=['bt', 'elo'], default='bt', help='Bradley-Terry (default) or Elo')
+    parser.add_argument('--top', type=int, default=20, help='how many assets to show')
+    args = parser.parse_args()
+
+    session = dbsetup.Session()
+    try:
+        ts = time.time()
+        model = RankingModel()
+        pairs = update_model(session, model, args.campaign_id)
+        te = time.time()
+    finally:
+        session.close()
+
+    print('campaign {0}: {1} assets, {2} comparisons, fitted in {3:.2f}s'.format(args.campaign_id, len(model.asset_ids), pairs, te - ts))
+    for place, entry in enumerate(model.top(args.top, args.method), 1):
+        print('{0:>4}  asset {1:>10}  score {2:>10.4f}  comparisons {3}'.format(place, entry['asset_id'], entry['score'], entry['comparisons']))
+
+
+if __name__ == '__main__':
+    main()
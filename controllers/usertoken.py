@@ -0,0 +1,182 @@
+import hashlib
+import secrets
+import base64
+import hmac
+import uuid
+import time
+import os
+
+#
+# User tokens
+#
+# The widget's user cookie used to be a bare uuid1 (the ii_user_id), so
+# every vote had to find the matching gameuser row again. Once we know the
+# voter's gameuser.id we now hand out a signed token instead:
+#
+#   1.<ii_user_id>.<gameuser id>.<client id>.<client user hash>.<signature>
+#
+# The signature is a truncated HMAC-SHA256 of everything before it, so a
+# valid token can be trusted without touching the DB. The client user hash
+# ties the gameuser id to the client_userid it was resolved for (the cookie
+# is shared by every client's widget, and a client may pass a different
+# user_id), and the client id to the client whose assets were voted on.
+#
+# The HMAC key is USER_TOKEN_SECRET. Without it, the first worker to need
+# a key generates a random one into USER_TOKEN_SECRET_FILE and every other
+# worker on the host reads it from there, so it survives restarts. Several
+# hosts behind one load balancer must share USER_TOKEN_SECRET. The old
+# hardcoded Flask SECRET_KEY is in the source, anyone could forge tokens
+# with it, so it's refused.
+#
+
+TOKEN_VERSION = '1'
+TOKEN_COOKIE = 'ii_token'
+LEGACY_COOKIE = 'user_id'   # bare ii_user_id, still accepted
+SIGNATURE_BYTES = 16
+INSECURE_SECRETS = {'iiwebwidget3177e39'}
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def client_user_hash(client_user_id: str) -> str:
+    # short, stable stand-in for the client's user id ('' for none)
+    if client_user_id is None:
+        return ''
+    return b64(hashlib.sha256(str(client_user_id).encode('utf-8')).digest()[:6])
+
+
+class UserToken():
+    ii_user_id = None
+    gu_id = None            # gameuser.id, None until we've resolved the user
+    client_id = None        # client the gameuser belongs to (None for ii users)
+    client_user_hash = ''
+
+    def __init__(self, **kwargs):
+        self.ii_user_id = kwargs.get('ii_user_id', None)
+        self.gu_id = kwargs.get('gu_id', None)
+        self.client_id = kwargs.get('client_id', None)
+        self.client_user_hash = kwargs.get('client_user_hash', '')
+
+    def vouches_for(self, client_user_id: str, client_id: int) -> bool:
+        # True if gu_id is the voter's gameuser for this client_user_id/client
+        if self.gu_id is None or self.client_user_hash != client_user_hash(client_user_id):
+            return False
+        return client_user_id is None or self.client_id == client_id
+
+
+class UserTokens():
+    _secret = None
+    _secret_file = None
+
+    def __init__(self, **kwargs):
+        self._secret_file = kwargs.get('secret_file', os.environ.get('USER_TOKEN_SECRET_FILE', '/var/tmp/widget-token-secret'))
+        secret = kwargs.get('secret', os.environ.get('USER_TOKEN_SECRET', None))
+        if secret is not None:
+            self.set_secret(secret)
+
+    def set_secret(self, secret: str) -> None:
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        if len(secret) == 0 or secret.decode('utf-8', 'replace') in INSECURE_SECRETS:
+            raise ValueError('refusing to sign user tokens with an empty or published secret, set USER_TOKEN_SECRET')
+        self._secret = secret
+
+    def key(self) -> bytes:
+        if self._secret is None:
+            self.set_secret(self.shared_secret())
+        return self._secret
+
+    def shared_secret(self) -> str:
+        # the host's generated secret, creating it if we're first. It's
+        # written to a temp file and linked into place, so nobody ever
+        # reads a partial secret and every worker ends up with the same one
+        try:
+            with open(self._secret_file, 'r') as fp:
+                return fp.read().strip()
+        except FileNotFoundError:
+            pass
+
+        tmp = '{0}.{1}.tmp'.format(self._secret_file, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(secrets.token_urlsafe(32) + '\n')
+            os.link(tmp, self._secret_file)
+        except FileExistsError:
+            pass    # another worker won
+        finally:
+            os.remove(tmp)
+        with open(self._secret_file, 'r') as fp:
+            return fp.read().strip()
+
+    def signature(self, payload: str) -> str:
+        return b64(hmac.new(self.key(), payload.encode('utf-8'), hashlib.sha256).digest()[:SIGNATURE_BYTES])
+
+    def issue(self, token: UserToken) -> str:
+        payload = '.'.join([TOKEN_VERSION, token.ii_user_id,
+                            str(token.gu_id or 0), str(token.client_id or 0), token.client_user_hash])
+        return payload + '.' + self.signature(payload)
+
+    def verify(self, value: str) -> UserToken:
+        # the token's contents, None if it isn't one of ours
+        if value is None:
+            return None
+        payload, dot, sig = value.rpartition('.')
+        fields = payload.split('.')
+        if len(fields) != 5 or fields[0] != TOKEN_VERSION:
+            return None
+        if not hmac.compare_digest(sig, self.signature(payload)):
+            return None
+        try:
+            gu_id = int(fields[2])
+            client_id = int(fields[3])
+        except ValueError:
+            return None
+        return UserToken(ii_user_id=fields[1], gu_id=gu_id or None, client_id=client_id or None,
+                         client_user_hash=fields[4])
+
+    def from_cookies(self, cookies: dict) -> UserToken:
+        # our signed token if there's a valid one, otherwise the legacy
+        # bare ii_user_id cookie, otherwise a brand new ii user
+        token = self.verify(cookies.get(TOKEN_COOKIE, None))
+        if token is not None:
+            return token
+
+        ii_user_id = cookies.get(LEGACY_COOKIE, None)
+        if ii_user_id is None or len(ii_user_id) > 48 or '.' in ii_user_id:
+            ii_user_id = str(uuid.uuid1())
+        return UserToken(ii_user_id=ii_user_id)
+
+    def issue_ballot(self, campaign_id: int, asset_ids: list) -> str:
+        # b1.<campaign id>.<asset id>-<asset id>.<issued>.<signature>, lets
+        # /vote check a ballot really is one we handed out
+        payload = '.'.join(['b1', str(campaign_id), '-'.join(str(asset_id) for asset_id in asset_ids),
+                            str(int(time.time()))])
+        return payload + '.' + self.signature(payload)
+
+    def verify_ballot(self, value: str, max_age: int) -> (int, list):
+        # (campaign_id, asset_ids) of a ballot token, None if it's not
+        # one of ours or it's older than max_age seconds
+        if not isinstance(value, str):
+            return None
+        payload, dot, sig = value.rpartition('.')
+        fields = payload.split('.')
+        if len(fields) != 4 or fields[0] != 'b1':
+            return None
+        if not hmac.compare_digest(sig, self.signature(payload)):
+            return None
+        try:
+            if time.time() - int(fields[3]) > max_age:
+                return None
+            return int(fields[1]), [int(asset_id) for asset_id in fields[2].split('-')]
+        except ValueError:
+            return None
+
+    def for_user(self, token: UserToken, gu_id: int, client_id: int, client_user_id: str) -> UserToken:
+        return UserToken(ii_user_id=token.ii_user_id, gu_id=gu_id, client_id=client_id,
+                         client_user_hash=client_user_hash(client_user_id))
+
+
+user_tokens = UserTokens()
@@ -0,0 +1,403 @@
+from models import photogame
+from controllers import photomgr
+from logsetup import logger
+from sqlalchemy import exc
+import dbsetup
+import threading
+import atexit
+import json
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, journal recovery needs flock()
+    fcntl = None
+
+#
+# Write-behind voting
+#
+# With VOTE_WRITE_BEHIND=1, /vote validates the ballot, appends it to a
+# local journal and answers right away. A background thread writes the
+# journalled ballots to pgresult in batches.
+#
+# Each worker journals into its own segment files (votes_<owner>_<n>.journal)
+# and holds an flock() on votes_<owner>.lock for as long as it runs. The
+# owner is the worker's pid, or <pid>-<n> if another worker holds that
+# pid's lock (it adopted an earlier process that had the same pid and is
+# still replaying its segments). A segment is deleted once every ballot in
+# it is committed. When a worker starts it looks for segments whose lock
+# nobody holds (i.e. the worker died), takes over the lock and replays
+# them. Every ballot carries its group_guid, and ballots whose guid is
+# already in pgresult are skipped, so a crash between the DB commit and
+# the segment delete doesn't double count.
+#
+# Appends are flushed to the OS before /vote answers, which is enough to
+# survive the worker dying. Surviving the host crashing (or losing power)
+# needs VOTE_JOURNAL_FSYNC=1, an fsync() per ballot; with the default of 0
+# ballots that were already acknowledged can be lost that way.
+#
+
+
+class JournalSegment():
+    path = None
+    outstanding = 0     # ballots in this segment not yet committed
+    closed = False      # no more appends, delete once outstanding hits 0
+
+    def __init__(self, path: str, closed=False):
+        self.path = path
+        self.closed = closed
+
+
+class JournalEntry():
+    guid = None
+    client_user_id = None
+    ii_user_id = None
+    votes = None
+    gu_id = None        # from the voter's token, saves resolving the user
+    segment = None
+    attempts = 0
+
+    def __init__(self, **kwargs):
+        self.guid = kwargs.get('guid', None)
+        self.client_user_id = kwargs.get('client_user_id', None)
+        self.ii_user_id = kwargs.get('ii_user_id', None)
+        self.votes = kwargs.get('votes', None)
+        self.gu_id = kwargs.get('gu_id', None)
+        self.segment = kwargs.get('segment', None)
+
+    def to_json(self) -> str:
+        return json.dumps({'guid': self.guid, 'client_user_id': self.client_user_id,
+                           'ii_user_id': self.ii_user_id, 'votes': self.votes, 'gu_id': self.gu_id},
+                          separators=(',', ':'))
+
+
+class VoteJournal():
+    _journal_dir = None
+    _fsync = None
+    _segment_bytes = None
+    _batch_size = None
+    _flush_interval = None
+    _max_attempts = None
+    _backoff = False    # the last flush stopped at a bad ballot
+
+    def __init__(self, **kwargs):
+        self._journal_dir = kwargs.get('journal_dir', os.environ.get('VOTE_JOURNAL_DIR', '/var/tmp/widget-votes'))
+        self._fsync = kwargs.get('fsync', os.environ.get('VOTE_JOURNAL_FSYNC', '0') == '1')
+        self._segment_bytes = kwargs.get('segment_bytes', 4 * 1024 * 1024)
+        self._batch_size = kwargs.get('batch_size', 500)
+        self._flush_interval = kwargs.get('flush_interval', 0.25)
+        self._max_attempts = kwargs.get('max_attempts', 5)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._pid = None
+        self._owner = None
+        self._flusher = None
+        self._fp = None
+        self._segment = None
+        self._segment_no = 0
+        self._pending = []
+        self._lock_files = []
+        self._adopted = []
+        self.accepted = 0
+        self.flushed = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'accepted': self.accepted, 'flushed': self.flushed, 'replayed': self.replayed,
+                    'rejected': self.rejected, 'duplicates': self.duplicates, 'failures': self.failures,
+                    'pending': len(self._pending)}
+
+    def is_started(self) -> bool:
+        return self._flusher is not None and self._pid == os.getpid()
+
+    def start(self) -> None:
+        # called in each worker (after the fork), replays whatever
+        # dead workers left behind, then starts the flusher
+        with self._lock:
+            if self.is_started():
+                return
+            self._pid = os.getpid()
+            self._pending = []
+            self._stop.clear()
+            os.makedirs(self._journal_dir, exist_ok=True)
+            self._owner = self.claim_owner()
+
+        self.recover()
+        with self._lock:
+            self.open_segment()
+        self._flusher = threading.Thread(target=self.flusher, name='vote-journal-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.stop)
+
+    def owner(self) -> str:
+        return self._owner
+
+    def claim_owner(self) -> str:
+        # our pid, unless its lock is held by a worker that adopted an
+        # earlier process with the same pid, then the first free <pid>-<n>
+        pid = os.getpid()
+        owner = str(pid)
+        n = 0
+        while not self.hold_lock(owner):
+            n += 1
+            if n > 1000:
+                raise RuntimeError('no free vote journal owner for pid {0} in {1}'.format(pid, self._journal_dir))
+            owner = '{0}-{1}'.format(pid, n)
+        return owner
+
+    def lock_filename(self, owner: str) -> str:
+        return os.path.join(self._journal_dir, 'votes_{0}.lock'.format(owner))
+
+    def hold_lock(self, owner: str) -> bool:
+        # True if we now hold owner's lock
+        fd = os.open(self.lock_filename(owner), os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+        self._lock_files.append(fd)
+        return True
+
+    def open_segment(self) -> None:
+        if self._segment is not None:
+            self._segment.closed = True
+            self.retire(self._segment)
+        if self._fp is not None:
+            self._fp.close()
+        self._segment_no += 1
+        path = os.path.join(self._journal_dir, 'votes_{0}_{1}.journal'.format(self._owner, self._segment_no))
+        self._segment = JournalSegment(path)
+        self._fp = open(path, 'a', encoding='utf-8')
+
+    def retire(self, segment: JournalSegment) -> None:
+        if segment.closed and segment.outstanding == 0:
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+
+    def append(self, client_user_id: str, ii_user_id: str, votes: list, gu_id=None) -> str:
+        # journal a ballot that's already been validated, once this
+        # returns the ballot survives the process dying
+        if not self.is_started():
+            self.start()
+
+        entry = JournalEntry(guid=photomgr.PhotoGameMgr().new_group_guid(), client_user_id=client_user_id,
+                             ii_user_id=ii_user_id, votes=votes, gu_id=gu_id)
+        line = entry.to_json() + '\n'
+        with self._lock:
+            if self._fp.tell() > self._segment_bytes:
+                self.open_segment()
+            self._fp.write(line)
+            self._fp.flush()
+            if self._fsync:
+                os.fsync(self._fp.fileno())
+            entry.segment = self._segment
+            self._segment.outstanding += 1
+            self._pending.append(entry)
+            self.accepted += 1
+            if len(self._pending) >= self._batch_size:
+                self._wakeup.set()
+        return entry.guid
+
+    def recover(self) -> None:
+        # adopt the segments of workers that are gone (including an
+        # earlier process that happened to have our owner name)
+        segments = {}
+        for fn in os.listdir(self._journal_dir):
+            if not fn.startswith('votes_') or not fn.endswith('.journal'):
+                continue
+            owner = fn.split('_')[1]
+            segments.setdefault(owner, []).append(fn)
+
+        for owner, fns in segments.items():
+            if owner != self._owner:
+                if not self.hold_lock(owner):
+                    continue  # still alive (or another worker got there first)
+                self._adopted.append(owner)
+            fns = sorted(fns, key=lambda f: int(f.split('_')[2].split('.')[0]))
+            if owner == self._owner:
+                self._segment_no = int(fns[-1].split('_')[2].split('.')[0])
+            for fn in fns:
+                segment = JournalSegment(os.path.join(self._journal_dir, fn), closed=True)
+                with open(segment.path, 'r', encoding='utf-8') as fp:
+                    for line in fp:
+                        try:
+                            d = json.loads(line)
+                        except ValueError:
+                            continue  # torn write at the end of the segment
+                        entry = JournalEntry(guid=d['guid'], client_user_id=d['client_user_id'],
+                                             ii_user_id=d['ii_user_id'], votes=d['votes'], gu_id=d.get('gu_id', None),
+                                             segment=segment)
+                        segment.outstanding += 1
+                        with self._lock:
+                            self._pending.append(entry)
+                            self.replayed += 1
+                self.retire(segment)
+        self._wakeup.set()
+
+    def flusher(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if self._backoff:
+                    # give the ballot that failed some time before its next attempt
+                    self._stop.wait(self._flush_interval)
+            except Exception as e:
+                # DB is unavailable, the ballots stay pending and we try again
+                with self._lock:
+                    self.failures += 1
+                logger.exception(msg='[votejournal] flush failed, will retry')
+                time.sleep(min(5.0, self._flush_interval * 10))
+
+    def flush(self) -> int:
+        # write everything pending, a batch at a time. A batch that had to
+        # be written ballot by ballot ends the pass, a ballot that failed
+        # is only tried again on the next one (see reject())
+        total = 0
+        self._backoff = False
+        while True:
+            with self._lock:
+                batch = self._pending[:self._batch_size]
+            if len(batch) == 0:
+                return total
+            whole = self.write_batch(batch)
+            total += len(batch)
+            if not whole:
+                self._backoff = True
+                return total
+
+    def committed(self, entries: list) -> None:
+        with self._lock:
+            done = set(id(e) for e in entries)
+            self._pending = [e for e in self._pending if id(e) not in done]
+            for entry in entries:
+                entry.segment.outstanding -= 1
+                self.retire(entry.segment)
+
+    def already_written(self, session, entries: list) -> set:
+        guids = [e.guid for e in entries]
+        q = session.query(photogame.PhotoGameResult.group_guid).\
+            filter(photogame.PhotoGameResult.group_guid.in_(guids)).distinct()
+        return set(row[0] for row in q.all())
+
+    def write_entries(self, session, entries: list) -> int:
+        pm = photomgr.PhotoGameMgr()
+        written = self.already_written(session, entries)
+        rows = []
+        for entry in entries:
+            if entry.guid in written:
+                continue
+            gu_id = entry.gu_id
+            if gu_id is None:
+                gu_id = pm.resolve_user(session, entry.client_user_id, entry.ii_user_id, entry.votes[0]['asset_id'])
+            rows.extend(pm.vote_rows(entry.guid, gu_id, entry.votes))
+        pm.insert_votes(session, rows)
+        return len(written)
+
+    def write_batch(self, batch: list) -> bool:
+        # False if the batch had to be written one ballot at a time
+        session = dbsetup.Session()
+        try:
+            duplicates = self.write_entries(session, batch)
+            session.commit()
+            with self._lock:
+                self.flushed += len(batch) - duplicates
+                self.duplicates += duplicates
+            self.committed(batch)
+            return True
+        except exc.IntegrityError:
+            session.rollback()
+        except exc.DBAPIError:
+            session.rollback()
+            raise  # the DB is in trouble, not the ballots
+        except Exception:
+            session.rollback()
+        finally:
+            session.close()
+
+        # something in the batch is bad (e.g. an asset was deleted since it
+        # was validated), write them one at a time to find out which
+        for entry in batch:
+            session = dbsetup.Session()
+            try:
+                duplicates = self.write_entries(session, [entry])
+                session.commit()
+                with self._lock:
+                    self.flushed += 1 - duplicates
+                    self.duplicates += duplicates
+                self.committed([entry])
+            except exc.DBAPIError as e:
+                session.rollback()
+                if not isinstance(e, exc.IntegrityError):
+                    raise
+                self.reject(entry)
+            except Exception:
+                session.rollback()
+                self.reject(entry)
+            finally:
+                session.close()
+        return False
+
+    def reject(self, entry: JournalEntry) -> None:
+        # a ballot that keeps failing on its own is logged and dropped,
+        # until then it goes to the back of the queue so the ballots
+        # behind it aren't held up by its next attempts
+        entry.attempts += 1
+        if entry.attempts >= self._max_attempts:
+            logger.error(msg='[votejournal] dropping ballot {0}: {1}'.format(entry.guid, entry.to_json()))
+            with self._lock:
+                self.rejected += 1
+            self.committed([entry])
+            return
+        with self._lock:
+            self._pending = [e for e in self._pending if e is not entry] + [entry]
+
+    def stop(self, timeout=5.0) -> None:
+        # last chance to flush, anything left stays in the journal
+        # and is replayed by whoever starts next
+        if not self.is_started():
+            return
+        self._stop.set()
+        self._wakeup.set()
+        self._flusher.join(timeout=timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            pass
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+            if self._segment is not None:
+                self._segment.closed = True
+                self.retire(self._segment)
+            if len(self._pending) == 0:
+                # nothing left in any segment we own, so the locks can go
+                for owner in [self._owner] + self._adopted:
+                    try:
+                        os.remove(self.lock_filename(owner))
+                    except OSError:
+                        pass
+            for fd in self._lock_files:
+                os.close(fd)
+            self._lock_files = []
+            self._adopted = []
+        self._flusher = None
+
+
+def write_behind_enabled() -> bool:
+    return os.environ.get('VOTE_WRITE_BEHIND', '0') == '1'
+
+
+vote_journal = VoteJournal()
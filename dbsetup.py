@@ -3,11 +3,17 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm    import sessionmaker
 from enum import Enum
 import os
-from flask import request
+from flask import request, g
+from werkzeug.local import LocalProxy
 from sqlalchemy import exc
 from sqlalchemy import event
-from sqlalchemy import select
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.ext.compiler import compiles
+import threading
 import warnings
+import metrics
+import time
 
 
 class ImageType(Enum):
@@ -29,6 +35,45 @@ class EnvironmentType(Enum):
 
 class Configuration():
     UPLOAD_CATEGORY_PICS = 4
+    ASSET_INDEX_MAX_AGE = 300  # seconds before a campaign's asset index is re-read
+    CAMPAIGN_CACHE_TTL = 60  # seconds a campaign's active window is trusted
+    CAMPAIGN_CACHE_NEGATIVE_TTL = 30  # seconds an unknown campaign id stays unknown
+    CAMPAIGN_CACHE_MAX_ENTRIES = 10000
+    ASSET_CACHE_BYTES = int(os.environ.get('ASSET_CACHE_BYTES', 64 * 1024 * 1024))  # per worker
+    ASSET_CACHE_MAX_ITEM_BYTES = int(os.environ.get('ASSET_CACHE_MAX_ITEM_BYTES', 8 * 1024 * 1024))
+    DERIVATIVE_SIZE_STEP = 40  # resize requests are rounded up to a multiple of this
+    DERIVATIVE_MAX_DIMENSION = 1920
+    DERIVATIVE_JPEG_QUALITY = 85
+    RANKING_REFRESH = 30  # seconds between incremental updates of a campaign's ranking
+    RANKING_REBUILD = 3600  # seconds before a campaign's ranking is refitted from scratch
+    GAME_USER_CACHE_MAX_ENTRIES = 100000  # per worker
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))  # per worker
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # seconds to wait for a connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600))
+    DB_PRE_PING = os.environ.get('DB_PRE_PING', 'idle')  # always, idle or never
+    DB_PRE_PING_IDLE = float(os.environ.get('DB_PRE_PING_IDLE', 10))  # seconds idle before 'idle' pings
+    MAX_PREFETCH_BALLOTS = 20  # most ballots one /photogame?ballots=N request can ask for
+    BALLOT_TOKEN_MAX_AGE = 24 * 3600  # seconds a prefetched ballot can still be voted on
+    ADAPTIVE_PAIRING = os.environ.get('ADAPTIVE_PAIRING', '0') == '1'  # ballots favour under-sampled assets
+    ADAPTIVE_PAIRING_CANDIDATES = 4  # assets considered for each partner slot
+    ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))  # widget_async's aiomysql pool, per process
+    ASYNC_EXECUTOR_THREADS = int(os.environ.get('ASYNC_EXECUTOR_THREADS', 16))  # for Pillow and file reads
+    BULK_INGEST_WORKERS = 16  # threads writing image files, see controllers/bulkingest.py
+    BULK_INGEST_BATCH = 1000  # pgasset rows per INSERT (and per resume checkpoint)
+
+
+PRE_PING_POLICIES = ('always', 'idle', 'never')
+
+
+def check_pre_ping_policy(policy: str) -> str:
+    # a typo would otherwise quietly ping on every checkout
+    if policy not in PRE_PING_POLICIES:
+        raise ValueError('DB_PRE_PING must be one of {0}, not {1!r}'.format(', '.join(PRE_PING_POLICIES), policy))
+    return policy
+
+
+check_pre_ping_policy(Configuration.DB_PRE_PING)
 
 
 def determine_environment(hostname):
@@ -55,6 +100,10 @@ def determine_environment(hostname):
 
 
 def connection_string(environment):
+    # WIDGET_DB_URL points us at some other database (e.g. a SQLite file
+    # for tests/benchmark), whatever host we're on
+    if 'WIDGET_DB_URL' in os.environ:
+        return os.environ['WIDGET_DB_URL']
 
     if environment is None:
         environment = determine_environment(None)
@@ -139,7 +188,116 @@ def is_gunicorn():
     _is_gunicorn = "gunicorn" in os.environ.get("SERVER_SOFTWARE", "")
     return _is_gunicorn
 
-engine = create_engine(connection_string(None), echo=False, pool_recycle=3600)
+class InstrumentedQueuePool(QueuePool):
+    # QueuePool that keeps track of how long checkouts wait for a
+    # connection, so pools can be sized against the number of workers
+    def __init__(self, creator, **kwargs):
+        super().__init__(creator, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.waits = 0          # checkouts that had to wait for a connection
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.invalidations = 0
+        self.pings = 0
+        self.ping_failures = 0
+
+    def _do_get(self):
+        # every checkout's time (including opening a new connection) goes
+        # into the db_pool_checkout histogram, the waits/wait_seconds
+        # counters only cover checkouts that found the pool exhausted
+        exhausted = self._max_overflow > -1 and self._overflow >= self._max_overflow and self._pool.empty()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.registry.observe('db_pool_checkout', elapsed)
+            if exhausted:
+                with self._stats_lock:
+                    self.waits += 1
+                    self.wait_seconds += elapsed
+                    self.max_wait_seconds = max(self.max_wait_seconds, elapsed)
+
+    def recreate(self):
+        # keep our counters across a pool reset (e.g. after a disconnect)
+        pool = super().recreate()
+        for k in ('waits', 'wait_seconds', 'max_wait_seconds', 'timeouts', 'invalidations', 'pings', 'ping_failures'):
+            setattr(pool, k, getattr(self, k))
+        return pool
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {'size': self.size(), 'checked_out': self.checkedout(), 'checked_in': self.checkedin(),
+                    'overflow': max(self.overflow(), 0), 'max_overflow': self._max_overflow,
+                    'waits': self.waits, 'wait_seconds': round(self.wait_seconds, 6),
+                    'max_wait_seconds': round(self.max_wait_seconds, 6), 'timeouts': self.timeouts,
+                    'invalidations': self.invalidations, 'pings': self.pings, 'ping_failures': self.ping_failures}
+
+
+def is_sqlite(url: str) -> bool:
+    return url is not None and url.startswith('sqlite')
+
+
+def engine_options(url: str) -> dict:
+    # SQLite (a local stand-in, see WIDGET_DB_URL) picks its own pool,
+    # a queue of connections to a file buys us nothing
+    if is_sqlite(url):
+        return {}
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': Configuration.DB_POOL_SIZE,
+            'max_overflow': Configuration.DB_MAX_OVERFLOW,
+            'pool_timeout': Configuration.DB_POOL_TIMEOUT,
+            'pool_recycle': Configuration.DB_POOL_RECYCLE}
+
+
+class CurrentTimestampOnUpdate(ColumnElement):
+    # server_default for last_updated columns: MySQL keeps them current
+    # with ON UPDATE, elsewhere they're just set when the row is created
+    pass
+
+
+@compiles(CurrentTimestampOnUpdate)
+def compile_current_timestamp(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(CurrentTimestampOnUpdate, 'mysql')
+def compile_current_timestamp_on_update(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'
+
+
+_url = connection_string(None)
+engine = create_engine(_url, echo=False, **engine_options(_url))
+
+
+#
+# SQLite
+#
+# Foreign keys are off unless asked for (MySQL's FK errors are how /vote
+# spots a bad asset id), and pysqlite's own transaction handling breaks
+# SAVEPOINTs (find_client_user() and the tallies rely on them), so we
+# turn that off and issue BEGIN ourselves. These have to be in place
+# before anything connects, an in-memory database keeps its first
+# connection forever.
+#
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, "connect")
+    def sqlite_connection_opened(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def sqlite_begin(conn):
+        conn.execute("BEGIN")
+
+
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 metadata = Base.metadata
@@ -147,40 +305,110 @@ metadata.create_all(bind=engine, checkfirst=True)
 _DEBUG = False
 
 
-@event.listens_for(engine, "engine_connect")
-def ping_connection(connection, branch):
-    if branch:
-        # "branch" refers to a sub-connection of a connection,
-        # we don't want to bother pinging on these.
-        return
+def pool_stats() -> dict:
+    pool = engine.pool
+    if not hasattr(pool, 'stats'):
+        return {}
+    return pool.stats()
+
+
+def count_pool_event(name: str) -> None:
+    pool = engine.pool
+    if hasattr(pool, 'stats'):
+        with pool._stats_lock:
+            setattr(pool, name, getattr(pool, name) + 1)
 
-    # turn off "close with result".  This flag is only used with
-    # "connectionless" execution, otherwise will be False in any case
-    save_should_close_with_result = connection.should_close_with_result
-    connection.should_close_with_result = False
 
+#
+# Request sessions
+#
+# Handlers use db_session rather than building their own Session(): it's
+# created the first time the request touches it and kept on flask.g, so a
+# request answered from our caches never gets one (and never checks out a
+# connection). end_request_session() runs at teardown, whatever happened
+# in the handler; it commits whatever is left if the request finished
+# without an exception, rolls back if it didn't, and always closes the
+# session, which returns its connection to the pool. Handlers that need to
+# know their writes made it (/vote) still commit before they answer.
+#
+def request_session():
+    session = g.get('db_session', None)
+    if session is None:
+        session = g.db_session = Session()
+    return session
+
+
+db_session = LocalProxy(request_session)
+
+
+def end_request_session(exception=None) -> None:
+    session = g.pop('db_session', None)
+    if session is None:
+        return
+    start = time.perf_counter()
+    failed = exception is not None
     try:
-        # run a SELECT 1.   use a core select() so that
-        # the SELECT of a scalar value without a table is
-        # appropriately formatted for the backend
-        connection.scalar(select([1]))
-    except exc.DBAPIError as err:
-        # catch SQLAlchemy's DBAPIError, which is a wrapper
-        # for the DBAPI's exception.  It includes a .connection_invalidated
-        # attribute which specifies if this connection is a "disconnect"
-        # condition, which is based on inspection of the original exception
-        # by the dialect in use.
-        if err.connection_invalidated:
-            # run the same SELECT again - the connection will re-validate
-            # itself and establish a new connection.  The disconnect detection
-            # here also causes the whole connection pool to be invalidated
-            # so that all stale connections are discarded.
-            connection.scalar(select([1]))
+        if exception is None:
+            session.commit()
         else:
-            raise
+            session.rollback()
+    except Exception as e:
+        # the response has already been built, all we can do is make
+        # sure the connection goes back clean (and count it)
+        failed = True
+        session.rollback()
     finally:
-        # restore "close with result"
-        connection.should_close_with_result = save_should_close_with_result
+        session.close()
+        metrics.registry.observe('request_session_end', time.perf_counter() - start, error=failed)
+
+
+#
+# Liveness checks
+#
+# Rather than a SELECT 1 every time a connection is handed out, we ping
+# (COM_PING for PyMySQL) only when the connection has been sitting idle
+# for more than DB_PRE_PING_IDLE seconds (DB_PRE_PING=idle, the default),
+# on every checkout (always) or not at all (never). A connection that
+# fails the ping raises DisconnectionError, which makes the pool throw it
+# away and hand out a fresh one.
+#
+@event.listens_for(engine, "connect")
+def connection_opened(dbapi_connection, connection_record):
+    connection_record.info['last_used'] = time.time()
+
+
+@event.listens_for(engine, "checkin")
+def connection_returned(dbapi_connection, connection_record):
+    if connection_record is not None:
+        connection_record.info['last_used'] = time.time()
+
+
+@event.listens_for(engine, "invalidate")
+def connection_invalidated(dbapi_connection, connection_record, exception):
+    count_pool_event('invalidations')
+
+
+@event.listens_for(engine, "checkout")
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    policy = Configuration.DB_PRE_PING
+    if policy == 'never':
+        return
+    if policy == 'idle' and time.time() - connection_record.info.get('last_used', 0) < Configuration.DB_PRE_PING_IDLE:
+        return
+
+    count_pool_event('pings')
+    try:
+        if hasattr(dbapi_connection, 'ping'):
+            dbapi_connection.ping(False)
+        else:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+    except Exception as e:
+        count_pool_event('ping_failures')
+        raise exc.DisconnectionError() from e
 
 
 # just for fun
@@ -0,0 +1,15 @@
+import metrics
+
+#
+# gunicorn settings shared by both entry points:
+#
+#   gunicorn -c gunicorn.conf.py widget_main:app
+#   gunicorn -c gunicorn.conf.py widget_async:app --worker-class aiohttp.GunicornWebWorker
+#
+# Hooks run in the master process.
+#
+
+
+def child_exit(server, worker):
+    # keep a dead worker's timings in the METRICS_DIR totals
+    metrics.registry.mark_process_dead(worker.pid)
@@ -2,6 +2,13 @@ import dbsetup
 from models import sql_logging
 import logging
 import traceback
+import threading
+import queue
+import atexit
+import time
+import sys
+import os
+from datetime import datetime
 
 
 class SQLAlchemyHandler(logging.Handler):
@@ -24,3 +31,172 @@ class SQLAlchemyHandler(logging.Handler):
             session.commit()
         finally:
             session.close()
+
+
+class QueuedSQLAlchemyHandler(logging.Handler):
+    # Same rows as SQLAlchemyHandler, but emit() only drops the record
+    # on a bounded queue. A background thread writes the queue to the
+    # logs table in batches so the request thread never waits on MySQL.
+    DROP_NEWEST = 'drop_newest'   # queue full: discard the record being logged
+    DROP_OLDEST = 'drop_oldest'   # queue full: discard the oldest queued record
+    BLOCK = 'block'               # queue full: wait up to _block_timeout, then discard
+
+    _SENTINEL = None
+
+    def __init__(self, level=logging.NOTSET, **kwargs):
+        super().__init__(level)
+        self._max_queue = kwargs.get('max_queue', 10000)
+        self._batch_size = kwargs.get('batch_size', 200)
+        self._flush_interval = kwargs.get('flush_interval', 1.0)
+        self._overflow = kwargs.get('overflow', self.DROP_NEWEST)
+        self._block_timeout = kwargs.get('block_timeout', 0.05)
+        self._counter_lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        try:
+            self._host = str.upper(os.uname()[1])
+        except Exception as e:
+            self._host = str.upper(os.environ['COMPUTERNAME'])
+        atexit.register(self.close)
+
+    def count(self, counter: str, n=1) -> None:
+        with self._counter_lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            return {'queued': self.queued, 'dropped': self.dropped, 'written': self.written,
+                    'failed': self.failed, 'pending': self._queue.qsize() if self._queue is not None else 0}
+
+    def start(self) -> None:
+        # the writer is started on first use, and again if we find ourselves
+        # in a forked child (gunicorn workers don't inherit the thread)
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self._max_queue)
+        self._writer = threading.Thread(target=self.writer, name='sql-log-writer', daemon=True)
+        self._writer.start()
+
+    def make_row(self, record) -> dict:
+        trace = None
+        if record.exc_info:
+            trace = ''.join(traceback.format_exception(*record.exc_info))
+            if len(trace) > 2000:
+                trace = trace[0:1999]
+
+        msg = record.__dict__['msg']
+        if msg is not None:
+            msg = str(msg)[0:500]
+
+        return {'host': self._host,
+                'logger': record.__dict__['name'],
+                'level': record.__dict__['levelname'],
+                'trace': trace,
+                'msg': msg,
+                'created_date': datetime.fromtimestamp(record.created)}
+
+    def emit(self, record):
+        try:
+            if self._writer is None or self._pid != os.getpid():
+                with self._counter_lock:
+                    if self._writer is None or self._pid != os.getpid():
+                        self.start()
+            row = self.make_row(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            if self._overflow == self.BLOCK:
+                self._queue.put(row, timeout=self._block_timeout)
+            else:
+                self._queue.put_nowait(row)
+            self.count('queued')
+            return
+        except queue.Full:
+            pass
+
+        if self._overflow == self.DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self.count('dropped')
+                self._queue.put_nowait(row)
+                self.count('queued')
+                return
+            except (queue.Empty, queue.Full):
+                pass
+        self.count('dropped')
+
+    def writer(self) -> None:
+        q = self._queue
+        while True:
+            try:
+                row = q.get(timeout=self._flush_interval)
+            except queue.Empty:
+                continue
+
+            rows = []
+            done = row is self._SENTINEL
+            if not done:
+                rows.append(row)
+            while not done and len(rows) < self._batch_size:
+                try:
+                    row = q.get_nowait()
+                except queue.Empty:
+                    break
+                if row is self._SENTINEL:
+                    done = True
+                else:
+                    rows.append(row)
+
+            self.write_rows(rows)
+            for i in range(len(rows) + (1 if done else 0)):
+                q.task_done()
+            if done:
+                return
+
+    def write_rows(self, rows: list) -> None:
+        if len(rows) == 0:
+            return
+        try:
+            with dbsetup.engine.begin() as conn:
+                conn.execute(sql_logging.Log.__table__.insert(), rows)
+            self.count('written', len(rows))
+        except Exception as e:
+            # can't log this through ourselves, so it goes to stderr
+            self.count('failed', len(rows))
+            sys.stderr.write('QueuedSQLAlchemyHandler: failed to write {0} log rows: {1}\n'.format(len(rows), e))
+
+    def flush(self, timeout=5.0) -> None:
+        # wait (a bounded amount of time) for the writer to catch up
+        if self._writer is None or self._pid != os.getpid():
+            return
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks > 0 and time.time() < deadline and self._writer.is_alive():
+            time.sleep(0.01)
+
+    def close(self):
+        if self._writer is not None and self._pid == os.getpid() and self._writer.is_alive():
+            try:
+                self._queue.put(self._SENTINEL, timeout=1.0)
+                self._writer.join(timeout=5.0)
+            except queue.Full:
+                pass
+
+            # whatever the writer didn't get to, write it ourselves
+            rows = []
+            while True:
+                try:
+                    row = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is not self._SENTINEL:
+                    rows.append(row)
+            self.write_rows(rows)
+        self._writer = None
+        super().close()
@@ -2,7 +2,9 @@ import logging
 from handlers import sql_handler
 from models import sql_logging
 from dbsetup import _DEBUG
+import metrics
 import time
+import os
 from functools import wraps
 
 
@@ -17,7 +19,7 @@ else:
     client_logger.setLevel(logging.INFO)
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-hndlr = sql_handler.SQLAlchemyHandler()
+hndlr = sql_handler.QueuedSQLAlchemyHandler()  # rows are written by a background thread
 if _DEBUG:
     hndlr.setLevel(logging.DEBUG)
 else:
@@ -27,14 +29,28 @@ hndlr.setFormatter(formatter)
 logger.addHandler(hndlr)
 client_logger.addHandler(hndlr)
 
+# timings go to the in-memory histograms (see /metrics), set TIMER_LOG=1
+# to also get the old TIMER:<fn>:<seconds> rows in the logs table
+_TIMER_LOG = os.environ.get('TIMER_LOG', '0') == '1'
+
+
 def timeit():
     def wrapper(fn):
         @wraps(fn)
         def decorator(*args, **kwargs):
-            ts = time.time()
-            result = fn(*args, **kwargs)
-            te = time.time()
-            logger.info( msg='TIMER:{0}:{1}'.format(fn.__name__, te - ts))
+            ts = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                metrics.registry.observe(fn.__name__, time.perf_counter() - ts, error=True)
+                raise
+            te = time.perf_counter()
+
+            # views catch their own exceptions, so a 5xx response counts as an error
+            error = getattr(result, 'status_code', 200) >= 500
+            metrics.registry.observe(fn.__name__, te - ts, error)
+            if _TIMER_LOG:
+                logger.info( msg='TIMER:{0}:{1}'.format(fn.__name__, te - ts))
             return result
         return decorator
     return wrapper
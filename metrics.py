@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds (seconds) of our latency buckets, roughly 1.5x apart
+# from 0.5ms to 60s. Fixed buckets mean recording a timing is just a
+# bisect and an increment, and histograms from different gunicorn
+# workers can be added together bucket by bucket.
+BUCKETS = (0.0005, 0.00075, 0.001, 0.0015, 0.0025, 0.004, 0.006, 0.01, 0.015, 0.025,
+           0.04, 0.06, 0.1, 0.15, 0.25, 0.4, 0.6, 1.0, 1.5, 2.5, 4.0, 6.0, 10.0,
+           15.0, 25.0, 40.0, 60.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram():
+    counts = None   # one per bucket, plus the overflow (> 60s) bucket
+    count = 0
+    sum = 0.0
+    errors = 0
+
+    def __init__(self, **kwargs):
+        self.counts = kwargs.get('counts', [0] * (len(BUCKETS) + 1))
+        self.count = kwargs.get('count', 0)
+        self.sum = kwargs.get('sum', 0.0)
+        self.errors = kwargs.get('errors', 0)
+
+    def observe(self, seconds: float, error=False) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def merge(self, other) -> None:
+        for idx, n in enumerate(other.counts):
+            self.counts[idx] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.errors += other.errors
+
+    def percentile(self, q: float) -> float:
+        # linear interpolation inside the bucket holding the q'th timing
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            if n == 0:
+                continue
+            if seen + n >= target:
+                lower = BUCKETS[idx - 1] if idx > 0 else 0.0
+                upper = BUCKETS[idx] if idx < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (target - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+    def to_dict(self) -> dict:
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'errors': self.errors}
+
+
+class MetricsRegistry():
+    # One histogram per timed function/endpoint for this process.
+    # If _metrics_dir is set (METRICS_DIR in the environment) every
+    # process also keeps a snapshot file there, so /metrics served by
+    # any gunicorn worker can report the totals for all of them.
+    # Snapshots of workers that have exited are folded into an archive
+    # by gunicorn.conf.py's child_exit hook.
+    _histograms = None
+    _lock = None
+    _dump_lock = None   # one dump at a time, they share the temp file
+    _metrics_dir = None
+    _dump_interval = None
+    _last_dump = 0.0
+
+    def __init__(self, **kwargs):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._metrics_dir = kwargs.get('metrics_dir', os.environ.get('METRICS_DIR', None))
+        self._dump_interval = kwargs.get('dump_interval', 5.0)
+
+    def observe(self, name: str, seconds: float, error=False) -> None:
+        with self._lock:
+            h = self._histograms.get(name, None)
+            if h is None:
+                h = Histogram()
+                self._histograms[name] = h
+            h.observe(seconds, error)
+
+            # only the thread that notices first does the periodic dump
+            dump_due = self._metrics_dir is not None and time.time() - self._last_dump > self._dump_interval
+            if dump_due:
+                self._last_dump = time.time()
+
+        if dump_due:
+            self.dump()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: Histogram(**h.to_dict()) for name, h in self._histograms.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot_filename(self, pid: int) -> str:
+        return os.path.join(self._metrics_dir, 'metrics_{0}.json'.format(pid))
+
+    def dump(self) -> None:
+        # write to a temp file and rename, so readers never see half a file
+        with self._dump_lock:
+            self._last_dump = time.time()
+            snap = {name: h.to_dict() for name, h in self.snapshot().items()}
+            fn = self.snapshot_filename(os.getpid())
+            try:
+                with open(fn + '.tmp', 'w') as f:
+                    json.dump(snap, f)
+                os.replace(fn + '.tmp', fn)
+            except OSError:
+                pass  # metrics are best effort
+
+    def load(self, fn: str) -> dict:
+        try:
+            with open(fn, 'r') as f:
+                return {name: Histogram(**d) for name, d in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def aggregate(self) -> dict:
+        # totals across every process sharing _metrics_dir (or just us)
+        if self._metrics_dir is None:
+            return self.snapshot()
+
+        self.dump()
+        totals = {}
+        for fn in os.listdir(self._metrics_dir):
+            if not fn.startswith('metrics_') or not fn.endswith('.json'):
+                continue
+            for name, h in self.load(os.path.join(self._metrics_dir, fn)).items():
+                if name in totals:
+                    totals[name].merge(h)
+                else:
+                    totals[name] = h
+        return totals
+
+    def mark_process_dead(self, pid: int) -> None:
+        # called by gunicorn's child_exit hook (gunicorn.conf.py) in the
+        # master: fold the dead worker's snapshot into the archive so
+        # totals never go backwards
+        if self._metrics_dir is None:
+            return
+        dead = self.load(self.snapshot_filename(pid))
+        archive_fn = os.path.join(self._metrics_dir, 'metrics_archive.json')
+        archive = self.load(archive_fn)
+        for name, h in dead.items():
+            if name in archive:
+                archive[name].merge(h)
+            else:
+                archive[name] = h
+        try:
+            with open(archive_fn + '.tmp', 'w') as f:
+                json.dump({name: h.to_dict() for name, h in archive.items()}, f)
+            os.replace(archive_fn + '.tmp', archive_fn)
+            os.remove(self.snapshot_filename(pid))
+        except OSError:
+            pass
+
+
+def format_prometheus(histograms: dict, prefix='widget_timer') -> str:
+    # Prometheus text exposition format (version 0.0.4)
+    lines = ['# HELP {0}_seconds time spent in timed functions/endpoints'.format(prefix),
+             '# TYPE {0}_seconds histogram'.format(prefix)]
+    for name in sorted(histograms):
+        h = histograms[name]
+        cumulative = 0
+        for idx, bound in enumerate(BUCKETS):
+            cumulative += h.counts[idx]
+            lines.append('{0}_seconds_bucket{{fn="{1}",le="{2}"}} {3}'.format(prefix, name, bound, cumulative))
+        lines.append('{0}_seconds_bucket{{fn="{1}",le="+Inf"}} {2}'.format(prefix, name, h.count))
+        lines.append('{0}_seconds_sum{{fn="{1}"}} {2:.6f}'.format(prefix, name, h.sum))
+        lines.append('{0}_seconds_count{{fn="{1}"}} {2}'.format(prefix, name, h.count))
+
+    lines.append('# HELP {0}_seconds_quantile estimated from the histogram buckets'.format(prefix))
+    lines.append('# TYPE {0}_seconds_quantile gauge'.format(prefix))
+    for name in sorted(histograms):
+        for q in QUANTILES:
+            lines.append('{0}_seconds_quantile{{fn="{1}",quantile="{2}"}} {3:.6f}'.format(prefix, name, q, histograms[name].percentile(q)))
+
+    lines.append('# HELP {0}_errors_total calls that raised or returned a 5xx'.format(prefix))
+    lines.append('# TYPE {0}_errors_total counter'.format(prefix))
+    for name in sorted(histograms):
+        lines.append('{0}_errors_total{{fn="{1}"}} {2}'.format(prefix, name, histograms[name].errors))
+    return '\n'.join(lines) + '\n'
+
+
+def format_gauges(prefix: str, values: dict) -> str:
+    lines = []
+    for k in sorted(values):
+        lines.append('# TYPE {0}_{1} gauge'.format(prefix, k))
+        lines.append('{0}_{1} {2}'.format(prefix, k, values[k]))
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(histograms: dict) -> dict:
+    summary = {}
+    for name, h in histograms.items():
+        summary[name] = {'count': h.count, 'errors': h.errors,
+                         'mean': h.sum / h.count if h.count > 0 else 0.0,
+                         'p50': h.percentile(0.5), 'p95': h.percentile(0.95), 'p99': h.percentile(0.99)}
+    return summary
+
+
+registry = MetricsRegistry()
@@ -1,13 +1,16 @@
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, DateTime, text, ForeignKey, exc
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, text, ForeignKey, Index, UniqueConstraint, exc, event, select
+from sqlalchemy.orm import relationship, object_session
 import dbsetup
 from datetime import datetime
 import uuid
+import hashlib
 import os, os.path, errno
 from retrying import retry
 from logsetup import logger, timeit
 import string
+import threading
+import time
 
 
 class Client(dbsetup.Base):
@@ -20,7 +23,7 @@ class Client(dbsetup.Base):
     active = Column(Integer, nullable=False, default=1)  # if =0, then ignore the photo as if it didn't exist
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
-    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP') )
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
 
     def __init__(self, **kwargs):
         self.name = kwargs.get('name', None)
@@ -50,7 +53,7 @@ class Campaign(dbsetup.Base):
     sqlalchemy.UniqueConstraint('name', 'client_id', name='uix_campaign_name_client_id')
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
-    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
 
     def __init__(self, **kwargs):
         self.client_id = kwargs.get('client_id', None)
@@ -61,18 +64,282 @@ class Campaign(dbsetup.Base):
 
     @staticmethod
     def find_campaign(session, campaign_id: int) -> object:
+        # returns the cached CampaignWindow if the campaign is
+        # active right now, otherwise None
         try:
-            dt_now = datetime.now()
-            q = session.query(Campaign).\
-                filter(Campaign.id == campaign_id).\
-                filter(Campaign.active == 1).\
-                filter(Campaign.start_date <= dt_now).\
-                filter(Campaign.end_date >= dt_now)
-            c = q.one_or_none()
-            return c
+            cw = campaign_cache.lookup(session, campaign_id)
+            if cw is None or not cw.is_active(datetime.now()):
+                return None
+            return cw
+        except Exception as e:
+            raise
+
+
+class CampaignWindow():
+    # The parts of a campaign row we need to decide if it's running,
+    # kept in memory so a ballot request doesn't have to ask MySQL
+    id = None
+    client_id = None
+    active = None
+    start_date = None
+    end_date = None
+
+    def __init__(self, **kwargs):
+        c = kwargs.get('campaign', None)
+        if c is not None:
+            self.id = c.id
+            self.client_id = c.client_id
+            self.active = c.active
+            self.start_date = c.start_date
+            self.end_date = c.end_date
+
+    def is_active(self, dt_now: datetime) -> bool:
+        return self.active == 1 and self.start_date <= dt_now <= self.end_date
+
+
+class CampaignCache():
+    # campaign_id -> (expires, CampaignWindow). Unknown ids are cached
+    # as None (for a shorter time) so bogus campaign ids don't turn
+    # into a query per request.
+    _entries = None
+    _lock = None
+    _ttl = None
+    _negative_ttl = None
+    _max_entries = None
+
+    def __init__(self, **kwargs):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._ttl = kwargs.get('ttl', dbsetup.Configuration.CAMPAIGN_CACHE_TTL)
+        self._negative_ttl = kwargs.get('negative_ttl', dbsetup.Configuration.CAMPAIGN_CACHE_NEGATIVE_TTL)
+        self._max_entries = kwargs.get('max_entries', dbsetup.Configuration.CAMPAIGN_CACHE_MAX_ENTRIES)
+
+    def get(self, campaign_id: int) -> tuple:
+        # the unexpired (expires, CampaignWindow) entry, None on a miss
+        entry = self._entries.get(campaign_id, None)
+        if entry is not None and entry[0] > time.time():
+            return entry
+        return None
+
+    def lookup(self, session, campaign_id: int) -> CampaignWindow:
+        entry = self.get(campaign_id)
+        if entry is not None:
+            return entry[1]
+
+        try:
+            c = session.query(Campaign).get(campaign_id)
         except Exception as e:
             raise
 
+        cw = CampaignWindow(campaign=c) if c is not None else None
+        self.store(campaign_id, cw)
+        return cw
+
+    def store(self, campaign_id: int, cw: CampaignWindow) -> None:
+        ttl = self._ttl if cw is not None else self._negative_ttl
+        with self._lock:
+            if len(self._entries) >= self._max_entries and campaign_id not in self._entries:
+                self.purge_expired()
+                if len(self._entries) >= self._max_entries:
+                    self._entries.clear()  # scraper flood, just start over
+            self._entries[campaign_id] = (time.time() + ttl, cw)
+
+    def purge_expired(self) -> None:
+        now = time.time()
+        for campaign_id in [k for k, v in self._entries.items() if v[0] <= now]:
+            del self._entries[campaign_id]
+
+    def invalidate(self, campaign_id=None) -> None:
+        with self._lock:
+            if campaign_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(campaign_id, None)
+
+
+campaign_cache = CampaignCache()
+
+
+# Any change to a campaign we make drops it from the cache, once the
+# transaction commits; dropping it at flush time would let another
+# request cache the old row again before the change is visible. A
+# rollback drops it too, our own session may have cached its uncommitted
+# version in the meantime.
+@event.listens_for(Campaign, 'after_insert')
+@event.listens_for(Campaign, 'after_update')
+@event.listens_for(Campaign, 'after_delete')
+def track_campaign_change(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        campaign_cache.invalidate(target.id)
+        return
+    session.info.setdefault('changed_campaigns', set()).add(target.id)
+
+
+@event.listens_for(dbsetup.Session, 'after_commit')
+@event.listens_for(dbsetup.Session, 'after_rollback')
+def invalidate_changed_campaigns(session):
+    for campaign_id in session.info.pop('changed_campaigns', ()):
+        campaign_cache.invalidate(campaign_id)
+
+
+# Content-addressed image storage
+#
+# An uploaded image is stored once per distinct content, at
+# <mnt>/blobs/ab/cd/<sha256>.<ext> (ab and cd being the hash's first two
+# byte pairs), and every pgasset row holding that image points at the
+# same pgblob row. refcount is the number of those rows; the file is
+# deleted once the transaction dropping the last one commits. Both ends
+# take the blob's row lock, so a blob can't be deleted while someone else
+# is taking a reference to it.
+#
+# Assets created before this (blob_id NULL) keep their uuid named files.
+#
+CANONICAL_EXTENSIONS = {'JPEG': 'JPG', 'TIFF': 'TIF'}
+
+
+class PhotoGameBlob(dbsetup.Base):
+
+    __tablename__ = 'pgblob'
+    __table_args__ = {'extend_existing': True}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    sha256 = Column(String(64), nullable=False, unique=True)  # hex digest of the file's content
+    filepath = Column(String(500), nullable=False)          # e.g. '/mnt/images/blobs/9f/86'
+    filename = Column(String(100), nullable=False)          # e.g. '9f86d081884c7d65...0f00a08.JPG'
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)   # pgasset rows referencing the blob
+
+    created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
+
+    created = False  # not a column, acquire() inserted the row in this transaction
+
+    def __init__(self, **kwargs):
+        self.sha256 = kwargs.get('sha256', None)
+        self.filepath = kwargs.get('filepath', None)
+        self.filename = kwargs.get('filename', None)
+        self.size = kwargs.get('size', None)
+        self.refcount = kwargs.get('refcount', 0)
+
+    def path_and_name(self) -> str:
+        return os.path.normpath(self.filepath + '/' + self.filename)
+
+    @staticmethod
+    def content_hash(img: bytes) -> str:
+        return hashlib.sha256(img).hexdigest()
+
+    @staticmethod
+    def location(sha256: str, extension: str, mnt_point=None) -> (str, str):
+        # (filepath, filename) the blob with this hash is stored at
+        if mnt_point is None:
+            mnt_point = dbsetup.image_store(dbsetup.determine_environment(None))
+        extension = extension.upper()
+        extension = CANONICAL_EXTENSIONS.get(extension, extension)
+        return '{0}/blobs/{1}/{2}'.format(mnt_point, sha256[0:2], sha256[2:4]), sha256 + '.' + extension
+
+    @staticmethod
+    def acquire(session, sha256: str, extension: str, size: int, mnt_point=None) -> object:
+        # the blob for this content with one more reference, created (but
+        # not written, see PhotoGameAsset.store_blob_file()) if it's new.
+        # The row stays locked until the caller commits. A created blob's
+        # file is removed again if the transaction rolls back.
+        q = session.query(PhotoGameBlob).filter(PhotoGameBlob.sha256 == sha256)
+        blob = q.with_for_update().one_or_none()
+        if blob is None:
+            filepath, filename = PhotoGameBlob.location(sha256, extension, mnt_point)
+            try:
+                with session.begin_nested():
+                    blob = PhotoGameBlob(sha256=sha256, filepath=filepath, filename=filename, size=size, refcount=1)
+                    session.add(blob)
+                    session.flush()
+                blob.created = True
+                session.info.setdefault('created_blobs', []).append((blob.sha256, blob.path_and_name()))
+                return blob
+            except exc.IntegrityError:
+                # someone stored the same content just now, use theirs
+                blob = q.with_for_update().one()
+
+        blob.refcount = PhotoGameBlob.refcount + 1
+        session.flush()
+        return blob
+
+    @staticmethod
+    def release(session, blob_id: int) -> None:
+        # drop a reference, the last one deletes the row (and, once that
+        # commits, the file). Resized derivatives are left alone, they're
+        # only ever derived from this content so they stay valid if it
+        # comes back.
+        blob = session.query(PhotoGameBlob).filter(PhotoGameBlob.id == blob_id).with_for_update().one_or_none()
+        if blob is None:
+            return
+        if blob.refcount > 1:
+            blob.refcount = PhotoGameBlob.refcount - 1
+            session.flush()
+            return
+
+        session.info.setdefault('released_blobs', []).append((blob.sha256, blob.path_and_name()))
+        session.delete(blob)
+        session.flush()
+
+
+def in_savepoint(session) -> bool:
+    # after_commit/after_rollback also fire when a savepoint is released
+    # or rolled back, the transaction itself carries on
+    t = session.transaction
+    while t is not None:
+        if t.nested:
+            return True
+        t = t.parent
+    return False
+
+
+def remove_blob_files(session, blobs: list) -> None:
+    # deletes the files of blobs [(sha256, path_and_name)] that have no
+    # pgblob row. The locking read waits for a transaction that has just
+    # inserted the same content to finish (and then keeps its file), and
+    # its gap locks hold off a new insert of it until the files are gone;
+    # acquire()'s caller writes the file after such an insert.
+    tbl = PhotoGameBlob.__table__
+    try:
+        with session.get_bind().connect() as conn:
+            with conn.begin():
+                q = select([tbl.c.sha256]).where(tbl.c.sha256.in_([sha256 for sha256, path_and_name in blobs]))
+                stored = set(r[0] for r in conn.execute(q.with_for_update()))
+                for sha256, path_and_name in blobs:
+                    if sha256 in stored:
+                        continue
+                    try:
+                        os.remove(path_and_name)
+                    except FileNotFoundError:
+                        pass
+    except Exception as e:
+        logger.exception(msg="[pgblob] error removing blob files!")
+
+
+@event.listens_for(dbsetup.Session, 'after_commit')
+def remove_released_blobs(session):
+    # the files of blobs whose last reference just went, unless the same
+    # content has been stored again since (its new row reuses the path)
+    if in_savepoint(session):
+        return
+    session.info.pop('created_blobs', None)
+    released = session.info.pop('released_blobs', None)
+    if released is not None:
+        remove_blob_files(session, released)
+
+
+@event.listens_for(dbsetup.Session, 'after_rollback')
+def remove_created_blobs(session):
+    # the files written for blobs the transaction created, the released
+    # ones are still referenced
+    if in_savepoint(session):
+        return
+    session.info.pop('released_blobs', None)
+    created = session.info.pop('created_blobs', None)
+    if created is not None:
+        remove_blob_files(session, created)
+
 
 # PhotoGame
 # This is the photo "library"
@@ -86,26 +353,52 @@ class PhotoGameAsset(dbsetup.Base):
     filepath = Column(String(500), nullable=False)         # e.g. '/mnt/images/49269d/394f9/d431'
     filename = Column(String(100), nullable=False)         # e.g. '970797dfd9f149269d394f9d43179d64.jpeg'
     active = Column(Integer, nullable=False, default=1)  # if =0, then ignore the photo as if it didn't exist
+    blob_id = Column(Integer, ForeignKey("pgblob.id", name="fk_pgasset_blob_id"), nullable=True, index=True)  # NULL for uuid named files
     sqlalchemy.UniqueConstraint('filename', 'campaign_id', name='uix_pgasset_filename_campaign_id')
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
-    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP') )
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
 
-    def create_asset(self, campaign_id: int, img: bytes, extension='JPG'):
-        # first create asset name
+    def create_asset(self, campaign_id: int, img: bytes, extension='JPG', session=None):
+        # with a session the image is stored content-addressed (shared with
+        # any other asset that has the same image), the caller commits;
+        # without one there's nowhere to count references, so it gets a
+        # file of its own
         self.campaign_id = campaign_id
-        asset_uuid = uuid.uuid1()
-        self.filename = str(asset_uuid).upper().translate({ord(c): None for c in '-'}) + '.' + extension
-        mnt_point = dbsetup.image_store(dbsetup.determine_environment(None)) # get the mount point
-        self.filepath = mnt_point + '/' + self.create_sub_path(asset_uuid)
+        if session is not None:
+            blob = PhotoGameBlob.acquire(session, PhotoGameBlob.content_hash(img), extension, len(img))
+            self.blob_id = blob.id
+            self.filepath = blob.filepath
+            self.filename = blob.filename
+            self.store_blob_file(blob.path_and_name(), img, replace=blob.created)
+            return
 
-        # now compose the filename
-        full_fn = self.filepath + '/' + self.filename
+        # first create asset name
+        full_fn = self.assign_location(extension)
 
         # finally write the file to longterm storage
         self.safe_write_file(path_and_name=full_fn, img=img)
         return
 
+    def delete_asset(self, session) -> None:
+        # the caller commits. Assets that have been voted on can't be
+        # deleted (pgresult refers to them), the flush fails before the
+        # blob is touched; deactivate those instead.
+        blob_id = self.blob_id
+        session.delete(self)
+        session.flush()
+        if blob_id is not None:
+            PhotoGameBlob.release(session, blob_id)
+
+    def assign_location(self, extension='JPG', mnt_point=None) -> str:
+        # picks a new filepath/filename for the asset, returns the two joined
+        asset_uuid = uuid.uuid1()
+        self.filename = str(asset_uuid).upper().translate({ord(c): None for c in '-'}) + '.' + extension
+        if mnt_point is None:
+            mnt_point = dbsetup.image_store(dbsetup.determine_environment(None)) # get the mount point
+        self.filepath = mnt_point + '/' + self.create_sub_path(asset_uuid)
+        return self.filepath + '/' + self.filename
+
     def create_sub_path(self, asset_uuid) -> str:
         # paths are generated from filenames
         # paths are designed to hold no more 1000 entries,
@@ -157,6 +450,18 @@ class PhotoGameAsset(dbsetup.Base):
         fp.close()
         return
 
+    def store_blob_file(self, path_and_name: str, img: bytes, replace=False) -> None:
+        # content-addressed files are written once; the write goes to a
+        # temp name first so nobody ever sees half a blob under its hash.
+        # replace writes it anyway, for a blob row we've just created: a
+        # file already there may belong to a released row whose commit is
+        # about to delete it.
+        if not replace and os.path.exists(path_and_name):
+            return
+        tmp_name = '{0}.{1}.{2}.tmp'.format(path_and_name, os.getpid(), threading.get_ident())
+        self.safe_write_file(path_and_name=tmp_name, img=img)
+        os.replace(tmp_name, path_and_name)
+
     @retry(wait_exponential_multiplier=100, wait_exponential_max=1000, stop_max_attempt_number=10)
     def safe_write_file(self, path_and_name: str, img: bytes) -> None:
         # the path may not be created, so we try to write the file
@@ -182,7 +487,9 @@ class PhotoGameAsset(dbsetup.Base):
 
 class GameUser(dbsetup.Base):
     __tablename__ = 'gameuser'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (UniqueConstraint('client_id', 'client_userid', name='uq_gameuser_client_id_client_userid'),
+                      Index('ix_gameuser_ii_userid', 'ii_userid'),
+                      {'extend_existing': True})
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     client_id = Column(Integer, ForeignKey("client.id", name="fk_gameuser_client_id"), nullable=True, index=True)
@@ -190,11 +497,11 @@ class GameUser(dbsetup.Base):
     ii_userid = Column(String(48), nullable=False)
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
-    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP') )
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
 
     def __init__(self, **kwargs):
         self.client_id = kwargs.get('client_id', None)
-        self.client_user_id = kwargs.get('client_user_id', None)
+        self.client_userid = kwargs.get('client_user_id', None)
         self.ii_userid = kwargs.get('ii_user_id', str(uuid.uuid1()))
 
 class PhotoGameResult(dbsetup.Base):
@@ -209,7 +516,7 @@ class PhotoGameResult(dbsetup.Base):
     rank = Column(Integer, nullable=False)
 
     created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
-    last_updated = Column(DateTime, nullable=True, server_default=text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
 
 
     def __init__(self, **kwargs):
@@ -217,4 +524,82 @@ class PhotoGameResult(dbsetup.Base):
         self.group_guid = kwargs.get('group_guid', None)
         self.rank = kwargs.get('rank', None)
         self.user_id = kwargs.get('user_id', None)
+
+
+# PhotoGameTally
+# Running per-asset totals, kept up to date as votes are tallied so
+# rankings don't have to scan pgresult. The (campaign_id, wins) index
+# makes a campaign's top-N an index range scan.
+class PhotoGameTally(dbsetup.Base):
+
+    __tablename__ = 'pgtally'
+    __table_args__ = (Index('ix_pgtally_campaign_id_wins', 'campaign_id', 'wins'),
+                      {'extend_existing': True})
+
+    asset_id = Column(Integer, ForeignKey("pgasset.id", name="fk_pgtally_asset_id"), primary_key=True, autoincrement=False)
+    campaign_id = Column(Integer, ForeignKey("campaign.id", name="fk_pgtally_campaign_id"), nullable=False)
+    appearances = Column(Integer, nullable=False, default=0)  # ballots the asset was on
+    wins = Column(Integer, nullable=False, default=0)         # ballots where it was ranked 1
+    rank_sum = Column(Integer, nullable=False, default=0)     # sum of its ranks, for the average rank
+
+    created_date = Column(DateTime, server_default=text('CURRENT_TIMESTAMP'), nullable=False)
+    last_updated = Column(DateTime, nullable=True, server_default=dbsetup.CurrentTimestampOnUpdate())
+
+    def __init__(self, **kwargs):
+        self.asset_id = kwargs.get('asset_id', None)
+        self.campaign_id = kwargs.get('campaign_id', None)
+        self.appearances = kwargs.get('appearances', 0)
+        self.wins = kwargs.get('wins', 0)
+        self.rank_sum = kwargs.get('rank_sum', 0)
+
+    @staticmethod
+    def vote_totals(vote_rows: list) -> dict:
+        # asset_id -> [appearances, wins, rank_sum] for pgresult rows (asset_id, rank)
+        totals = {}
+        for row in vote_rows:
+            t = totals.setdefault(row['asset_id'], [0, 0, 0])
+            t[0] += 1
+            t[1] += 1 if row['rank'] == 1 else 0
+            t[2] += row['rank']
+        return totals
+
+    @staticmethod
+    def increment(asset_id: int, appearances: int, wins: int, rank_sum: int):
+        # UPDATE adding to an asset's tally, matches no rows if it has none yet
+        tbl = PhotoGameTally.__table__
+        return tbl.update().where(tbl.c.asset_id == asset_id).\
+            values(appearances=tbl.c.appearances + appearances, wins=tbl.c.wins + wins, rank_sum=tbl.c.rank_sum + rank_sum)
+
+    @staticmethod
+    def record_votes(session, vote_rows: list, campaign_for_asset) -> None:
+        # vote_rows are pgresult rows (asset_id, rank), campaign_for_asset(asset_id)
+        # is only needed the first time an asset is tallied
+        totals = PhotoGameTally.vote_totals(vote_rows)
+        tbl = PhotoGameTally.__table__
+        for asset_id in sorted(totals):  # same lock order everywhere, no deadlocks
+            appearances, wins, rank_sum = totals[asset_id]
+            upd = PhotoGameTally.increment(asset_id, appearances, wins, rank_sum)
+            if session.execute(upd).rowcount > 0:
+                continue
+
+            # first votes for this asset, someone else may be inserting it too
+            try:
+                with session.begin_nested():
+                    session.execute(tbl.insert().values(asset_id=asset_id, campaign_id=campaign_for_asset(asset_id),
+                                                        appearances=appearances, wins=wins, rank_sum=rank_sum))
+            except exc.IntegrityError:
+                session.execute(upd)
+
+    @staticmethod
+    def top_assets(session, campaign_id: int, n: int) -> list:
+        try:
+            q = session.query(PhotoGameTally).\
+                join(PhotoGameAsset, PhotoGameAsset.id == PhotoGameTally.asset_id).\
+                filter(PhotoGameTally.campaign_id == campaign_id).\
+                filter(PhotoGameAsset.active == 1).\
+                order_by(PhotoGameTally.wins.desc()).\
+                limit(n)
+            return q.all()
+        except Exception as e:
+            raise
 # ======================================================================================================
@@ -9,8 +9,10 @@ BEGIN
   set @start_date = NOW();
   set @end_date = DATE_ADD(@start_date, INTERVAL 30 DAY);
 
+  DELETE FROM pgtally;
   DELETE FROM pgresult;
   DELETE FROM pgasset;
+  DELETE FROM pgblob;
   DELETE FROM campaign;
   DELETE FROM gameuser;
   DELETE FROM `client`;
@@ -0,0 +1,12 @@
+use widget;
+
+-- Index the columns votes look users up by. (client_id, client_userid)
+-- is unique so concurrent first votes from the same client user can't
+-- create two gameuser rows.
+--
+-- Until now GameUser never stored client_userid (it was always NULL), so
+-- there are no duplicates to clean up before adding the unique key.
+
+ALTER TABLE gameuser
+    ADD UNIQUE KEY uq_gameuser_client_id_client_userid (client_id, client_userid),
+    ADD KEY ix_gameuser_ii_userid (ii_userid);
@@ -0,0 +1,32 @@
+use widget;
+
+-- Content-addressed image storage. pgblob holds one row per distinct
+-- image (by sha256), stored at <mnt>/blobs/ab/cd/<sha256>.<ext>, and
+-- pgasset rows point at it through blob_id. refcount is the number of
+-- pgasset rows referencing the blob, the file is deleted when it drops
+-- to zero.
+--
+-- Existing assets keep their uuid named files (blob_id NULL).
+--
+-- Assets sharing a blob share its filename, including two uploads of
+-- the same image to one campaign. If this database has a unique key on
+-- pgasset (filename, campaign_id) (uix_pgasset_filename_campaign_id,
+-- the model never created one) drop it first.
+
+CREATE TABLE pgblob (
+    id INTEGER NOT NULL AUTO_INCREMENT,
+    sha256 VARCHAR(64) NOT NULL,
+    filepath VARCHAR(500) NOT NULL,
+    filename VARCHAR(100) NOT NULL,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL,
+    created_date DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_updated DATETIME NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (id),
+    UNIQUE (sha256)
+);
+
+ALTER TABLE pgasset
+    ADD COLUMN blob_id INTEGER NULL,
+    ADD KEY ix_pgasset_blob_id (blob_id),
+    ADD CONSTRAINT fk_pgasset_blob_id FOREIGN KEY (blob_id) REFERENCES pgblob (id);
@@ -0,0 +1,17 @@
+use widget;
+
+-- Build the per-asset tallies (pgtally) from the votes already in
+-- pgresult. Run once after the pgtally table is created, new votes
+-- keep it up to date from then on.
+
+START TRANSACTION;
+
+    DELETE FROM pgtally;
+
+    INSERT INTO pgtally (asset_id, campaign_id, appearances, wins, rank_sum)
+    SELECT r.asset_id, a.campaign_id, COUNT(*), SUM(CASE WHEN r.rank = 1 THEN 1 ELSE 0 END), SUM(r.rank)
+      FROM pgresult r
+      JOIN pgasset a ON a.id = r.asset_id
+     GROUP BY r.asset_id, a.campaign_id;
+
+COMMIT;
@@ -55,3 +55,36 @@ class DatabaseTest(TestCase):
         super(DatabaseTest, cls).tearDownClass()
         teardown_module()
 
+
+
+class SQLiteTest(TestCase):
+    # Tests that need tables run against a throwaway in-memory database
+    # (WIDGET_DB_URL=sqlite://), the schema is created for every test and
+    # dropped after it. Anywhere else they're skipped, so they can never
+    # touch a real database. The process-wide caches are emptied too, ids
+    # are reused from one test to the next.
+    def setUp(self):
+        import dbsetup
+        if dbsetup.engine.dialect.name != 'sqlite' or dbsetup.engine.url.database not in (None, '', ':memory:'):
+            self.skipTest('needs WIDGET_DB_URL=sqlite://')
+        invalidate_caches()
+        Base.metadata.create_all(dbsetup.engine)
+        self.session = Session()
+
+    def tearDown(self):
+        import dbsetup
+        self.session.close()
+        Base.metadata.drop_all(dbsetup.engine)
+        invalidate_caches()
+
+
+def invalidate_caches():
+    from models import photogame
+    from controllers.assetcache import asset_cache
+    from controllers.assetindex import asset_index
+    from controllers.assetlookup import asset_locations
+    from controllers.gameusers import game_user_cache
+    from controllers.pairing import pairing_index
+    from controllers.ranking import ranking_cache
+    for cache in (photogame.campaign_cache, asset_cache, asset_index, asset_locations, game_user_cache, pairing_index, ranking_cache):
+        cache.invalidate()
@@ -0,0 +1,238 @@
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+#
+# Widget load benchmark
+#
+# Drives the ballot -> asset -> vote flow through the Flask app (with its
+# test client, so no server or network is involved) against synthetic
+# campaigns from syntheticdata.py, and reports per endpoint throughput
+# and latency percentiles. Data is generated on the first run at a given
+# scale and reused after that.
+#
+#   python tests/benchmark/bench_widget.py --assets 100000 --votes 1000000 --flows 5000
+#   python tests/benchmark/bench_widget.py --save before.json
+#   python tests/benchmark/bench_widget.py --baseline before.json   # exits 1 on a regression
+#
+# WIDGET_DB_URL picks the database (default: a SQLite file in --data-dir),
+# it has to be set before dbsetup is imported, which is why everything
+# from the widget is imported inside main().
+#
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PERCENTILES = (50, 90, 99)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the widget API against synthetic campaigns')
+    parser.add_argument('--data-dir', default='/tmp/widget_bench', help='SQLite file, images and manifest go here')
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--campaigns', type=int, default=2, help='per client')
+    parser.add_argument('--assets', type=int, default=1000, help='in total')
+    parser.add_argument('--users', type=int, default=1000, help='per client')
+    parser.add_argument('--votes', type=int, default=10000, help='ballots cast before the run')
+    parser.add_argument('--images', type=int, default=16, help='distinct image files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true', help='generate the data even if we have it')
+    parser.add_argument('--flows', type=int, default=2000, help='ballot/asset/vote flows to time')
+    parser.add_argument('--warmup', type=int, default=200, help='untimed flows first, to fill the caches')
+    parser.add_argument('--size', default=None, help='WxH, fetch assets resized (e.g. 320x320)')
+    parser.add_argument('--prefetch', type=int, default=0, help='get ballots N at a time with ?ballots=N')
+    parser.add_argument('--client-users', type=float, default=0.5, help='fraction of votes sent with a client user_id')
+    parser.add_argument('--save', default=None, help='write the results here (json)')
+    parser.add_argument('--baseline', default=None, help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50/p99 slowdown vs the baseline')
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_samples: list, q: float) -> float:
+    # nearest rank on already sorted samples
+    if len(sorted_samples) == 0:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, max(0, int(round(q / 100.0 * len(sorted_samples))) - 1))
+    return sorted_samples[idx]
+
+
+class Timings():
+    # every request's latency by endpoint, kept whole so percentiles are exact
+    _samples = None
+    _errors = None
+
+    def __init__(self):
+        self._samples = {}
+        self._errors = {}
+
+    def time(self, endpoint: str, fn):
+        ts = time.perf_counter()
+        rsp = fn()
+        self._samples.setdefault(endpoint, []).append(time.perf_counter() - ts)
+        if rsp.status_code >= 400:
+            self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+        return rsp
+
+    def summary(self, wall_seconds: float, flows: int) -> dict:
+        endpoints = {}
+        for endpoint, samples in sorted(self._samples.items()):
+            samples = sorted(samples)
+            stats = {'requests': len(samples),
+                     'errors': self._errors.get(endpoint, 0),
+                     'per_second': round(len(samples) / sum(samples), 1) if sum(samples) > 0 else 0.0,
+                     'mean_ms': round(1000 * sum(samples) / len(samples), 3),
+                     'max_ms': round(1000 * samples[-1], 3)}
+            for q in PERCENTILES:
+                stats['p{0}_ms'.format(q)] = round(1000 * percentile(samples, q), 3)
+            endpoints[endpoint] = stats
+        return {'flows': flows, 'seconds': round(wall_seconds, 3),
+                'flows_per_second': round(flows / wall_seconds, 1) if wall_seconds > 0 else 0.0,
+                'endpoints': endpoints}
+
+
+class WidgetFlow():
+    # one simulated voter session at a time: get a ballot (or a prefetched
+    # one), fetch its images, vote on them
+    _client = None
+    _campaigns = None
+    _weights = None
+    _args = None
+    _rng = None
+    _tokens = None
+    _prefetched = None
+
+    def __init__(self, client, manifest: dict, args):
+        self._client = client
+        self._campaigns = manifest['campaigns']
+        self._weights = [c['assets'] for c in self._campaigns]
+        self._args = args
+        self._rng = random.Random(args.seed + 1)
+        self._tokens = {}
+        self._prefetched = {}
+
+    def headers(self, user: str) -> dict:
+        token = self._tokens.get(user, None)
+        return {'Cookie': 'ii_token=' + token} if token is not None else {}
+
+    def keep_token(self, user: str, rsp) -> None:
+        for header in rsp.headers.getlist('Set-Cookie'):
+            if header.startswith('ii_token='):
+                self._tokens[user] = header.split(';')[0][len('ii_token='):]
+
+    def ballot(self, timings: Timings, campaign: dict, user: str) -> (list, str):
+        # (asset ids, ballot token or None)
+        if self._args.prefetch <= 0:
+            rsp = timings.time('GET /photogame', lambda: self._client.get('/photogame/{0}'.format(campaign['id']), headers=self.headers(user)))
+            self.keep_token(user, rsp)
+            return (json.loads(rsp.data.decode('utf-8')), None) if rsp.status_code == 200 else ([], None)
+
+        queue = self._prefetched.setdefault(campaign['id'], [])  # ballot tokens aren't tied to a user
+        if len(queue) == 0:
+            url = '/photogame/{0}?ballots={1}'.format(campaign['id'], self._args.prefetch)
+            rsp = timings.time('GET /photogame?ballots', lambda: self._client.get(url, headers=self.headers(user)))
+            self.keep_token(user, rsp)
+            if rsp.status_code != 200:
+                return [], None
+            queue.extend(json.loads(rsp.data.decode('utf-8'))['ballots'])
+        b = queue.pop(0)
+        return [asset['asset_id'] for asset in b['assets']], b['token']
+
+    def run(self, timings: Timings) -> None:
+        rng = self._rng
+        campaign = rng.choices(self._campaigns, weights=self._weights)[0]
+        client_user_id = None
+        if rng.random() < self._args.client_users:
+            client_user_id = 'user-{0}'.format(rng.randrange(int(self._args.users * 1.1)))  # ~10% are new
+        user = client_user_id or 'ii-{0}'.format(rng.randrange(self._args.users))
+
+        asset_ids, ballot_token = self.ballot(timings, campaign, user)
+        if len(asset_ids) < 2:
+            return
+
+        query = ''
+        if self._args.size is not None:
+            w, h = self._args.size.lower().split('x')
+            query = '?w={0}&h={1}'.format(w, h)
+        for asset_id in asset_ids:
+            timings.time('GET /asset', lambda: self._client.get('/asset/{0}{1}'.format(asset_id, query)))
+
+        rng.shuffle(asset_ids)
+        body = {'votes': [{'asset_id': asset_id, 'rank': rank + 1} for rank, asset_id in enumerate(asset_ids)]}
+        if client_user_id is not None:
+            body['user_id'] = client_user_id
+        if ballot_token is not None:
+            body['ballot'] = ballot_token
+        rsp = timings.time('POST /vote', lambda: self._client.post('/vote', data=json.dumps(body), content_type='application/json',
+                                                                  headers=self.headers(user)))
+        self.keep_token(user, rsp)
+
+
+def print_summary(summary: dict) -> None:
+    print('{0} flows in {1}s, {2} flows/s'.format(summary['flows'], summary['seconds'], summary['flows_per_second']))
+    columns = ['requests', 'errors', 'per_second', 'mean_ms'] + ['p{0}_ms'.format(q) for q in PERCENTILES] + ['max_ms']
+    print('{0:24}'.format('endpoint') + ''.join('{0:>11}'.format(c) for c in columns))
+    for endpoint, stats in summary['endpoints'].items():
+        print('{0:24}'.format(endpoint) + ''.join('{0:>11}'.format(stats[c]) for c in columns))
+
+
+def regressions(summary: dict, baseline: dict, tolerance: float) -> list:
+    # endpoints whose p50 or p99 got more than tolerance slower
+    found = []
+    for endpoint, stats in summary['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint, None)
+        if before is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if before[key] > 0 and stats[key] > before[key] * (1.0 + tolerance):
+                found.append('{0} {1}: {2} -> {3}'.format(endpoint, key, before[key], stats[key]))
+    return found
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    os.makedirs(args.data_dir, exist_ok=True)
+    os.environ.setdefault('WIDGET_DB_URL', 'sqlite:///' + os.path.join(args.data_dir, 'widget.db'))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import widget_main
+    from syntheticdata import Scale, SyntheticData
+
+    scale = Scale(clients=args.clients, campaigns=args.campaigns, assets=args.assets, users=args.users,
+                  votes=args.votes, images=args.images, seed=args.seed)
+    data = SyntheticData(scale=scale, data_dir=args.data_dir)
+    manifest = None if args.regenerate else data.load_manifest()
+    if manifest is None:
+        print('generating {0} ...'.format(scale.to_dict()))
+        manifest = data.generate()
+        print('generated in {0}s'.format(manifest['seconds']))
+
+    flow = WidgetFlow(widget_main.app.test_client(use_cookies=False), manifest, args)
+    for i in range(args.warmup):
+        flow.run(Timings())
+
+    timings = Timings()
+    ts = time.perf_counter()
+    for i in range(args.flows):
+        flow.run(timings)
+    summary = timings.summary(time.perf_counter() - ts, args.flows)
+    summary['scale'] = scale.to_dict()
+    print_summary(summary)
+
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fp:
+            found = regressions(summary, json.load(fp), args.tolerance)
+        for regression in found:
+            print('REGRESSION ' + regression)
+        return 1 if len(found) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
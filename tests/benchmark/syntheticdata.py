@@ -0,0 +1,229 @@
+import dbsetup
+from models import photogame
+from models import sql_logging
+from sqlalchemy import select
+from datetime import datetime, timedelta
+from PIL import Image
+import random
+import math
+import json
+import time
+import os
+
+#
+# Synthetic campaigns for the benchmarks
+#
+# Fills whatever dbsetup.engine points at (see WIDGET_DB_URL) with
+# clients, campaigns, assets, game users and already cast votes, all drawn
+# from one seed so two runs at the same scale see the same data. Rows go in
+# as batched core INSERTs, so a million assets or a few million votes
+# take minutes rather than hours. The assets share a handful of generated
+# JPEGs: what's in the file doesn't matter to the widget, only that there
+# is one to stream or resize.
+#
+
+CHUNK_ROWS = 10000  # rows per executemany
+
+
+class Scale():
+    clients = 2
+    campaigns = 2       # per client
+    assets = 1000       # in total, spread over the campaigns
+    users = 1000        # client users per client, plus as many ii users
+    votes = 10000       # ballots already cast, 2 pgresult rows each
+    images = 16         # distinct image files the assets point at
+    seed = 1
+
+    def __init__(self, **kwargs):
+        self.clients = kwargs.get('clients', Scale.clients)
+        self.campaigns = kwargs.get('campaigns', Scale.campaigns)
+        self.assets = kwargs.get('assets', Scale.assets)
+        self.users = kwargs.get('users', Scale.users)
+        self.votes = kwargs.get('votes', Scale.votes)
+        self.images = kwargs.get('images', Scale.images)
+        self.seed = kwargs.get('seed', Scale.seed)
+
+    def to_dict(self) -> dict:
+        return {'clients': self.clients, 'campaigns': self.campaigns, 'assets': self.assets,
+                'users': self.users, 'votes': self.votes, 'images': self.images, 'seed': self.seed}
+
+
+def client_userid(n: int) -> str:
+    # the benchmark's client users are user-0 .. user-<users-1> at every client
+    return 'user-{0}'.format(n)
+
+
+def create_schema(engine) -> None:
+    dbsetup.metadata.create_all(bind=engine, checkfirst=True)
+
+
+def make_images(image_dir: str, n: int, rng: random.Random) -> list:
+    # n noisy JPEGs (noise doesn't compress, so they're a realistic size)
+    os.makedirs(image_dir, exist_ok=True)
+    filenames = []
+    for i in range(n):
+        filename = 'BENCH{0:04d}.JPG'.format(i)
+        path_and_name = os.path.join(image_dir, filename)
+        if not os.path.exists(path_and_name):
+            size = (rng.choice((640, 800, 1024, 1600)), rng.choice((480, 600, 768, 1200)))
+            img = Image.merge('RGB', [Image.effect_noise(size, rng.uniform(20, 80)) for band in range(3)])
+            img.save(path_and_name, 'JPEG', quality=85)
+        filenames.append(filename)
+    return filenames
+
+
+def insert_chunked(conn, tbl, rows) -> int:
+    # rows can be any iterable (a generator for the big tables)
+    chunk = []
+    count = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_ROWS:
+            conn.execute(tbl.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        conn.execute(tbl.insert(), chunk)
+        count += len(chunk)
+    return count
+
+
+class SyntheticData():
+    _engine = None
+    _scale = None
+    _data_dir = None
+    _rng = None
+
+    def __init__(self, **kwargs):
+        self._engine = kwargs.get('engine', dbsetup.engine)
+        self._scale = kwargs.get('scale', Scale())
+        self._data_dir = kwargs.get('data_dir', '/tmp/widget_bench')
+        self._rng = random.Random(self._scale.seed)
+
+    def manifest_filename(self) -> str:
+        return os.path.join(self._data_dir, 'manifest.json')
+
+    def load_manifest(self) -> dict:
+        # the manifest of data already generated at this scale, None if there isn't one
+        try:
+            with open(self.manifest_filename(), 'r') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('scale', None) != self._scale.to_dict() or manifest.get('url', None) != str(self._engine.url):
+            return None
+
+        # ... and its campaigns are still in the database
+        c = photogame.Campaign.__table__
+        campaign_ids = [campaign['id'] for campaign in manifest['campaigns']]
+        try:
+            with self._engine.connect() as conn:
+                found = conn.execute(select([c.c.id]).where(c.c.id.in_(campaign_ids))).fetchall()
+        except Exception as e:
+            return None
+        return manifest if len(found) == len(campaign_ids) else None
+
+    def generate(self) -> dict:
+        ts = time.perf_counter()
+        create_schema(self._engine)
+        filenames = make_images(os.path.join(self._data_dir, 'images'), self._scale.images, self._rng)
+
+        with self._engine.begin() as conn:
+            campaigns = self.insert_campaigns(conn)
+            assets = self.insert_assets(conn, campaigns, filenames)
+            self.insert_users(conn, campaigns)
+            self.insert_votes(conn, campaigns, assets)
+
+        manifest = {'scale': self._scale.to_dict(),
+                    'url': str(self._engine.url),
+                    'campaigns': [{'id': c['id'], 'client_id': c['client_id'], 'assets': len(assets[c['id']])} for c in campaigns],
+                    'seconds': round(time.perf_counter() - ts, 1)}
+        with open(self.manifest_filename(), 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+        return manifest
+
+    def insert_campaigns(self, conn) -> list:
+        now = datetime.now()
+        campaigns = []
+        for c in range(self._scale.clients):
+            result = conn.execute(photogame.Client.__table__.insert().values(name='bench client {0}'.format(c), active=1))
+            client_id = result.inserted_primary_key[0]
+            for n in range(self._scale.campaigns):
+                result = conn.execute(photogame.Campaign.__table__.insert().values(
+                    client_id=client_id, name='bench campaign {0}.{1}'.format(c, n), active=1,
+                    start_date=now - timedelta(days=1), end_date=now + timedelta(days=365)))
+                campaigns.append({'id': result.inserted_primary_key[0], 'client_id': client_id})
+        return campaigns
+
+    def insert_assets(self, conn, campaigns: list, filenames: list) -> dict:
+        # campaign_id -> [(asset_id, quality)]; campaign sizes are skewed
+        # (a few big campaigns, a long tail), qualities are hidden scores
+        # the seeded votes follow
+        rng = self._rng
+        weights = [1.0 / (rank + 1) for rank in range(len(campaigns))]
+        sizes = [max(2, int(self._scale.assets * w / sum(weights))) for w in weights]
+        image_dir = os.path.join(self._data_dir, 'images')
+
+        def rows():
+            for campaign, size in zip(campaigns, sizes):
+                for i in range(size):
+                    yield {'campaign_id': campaign['id'], 'filepath': image_dir,
+                           'filename': rng.choice(filenames), 'active': 1}
+        insert_chunked(conn, photogame.PhotoGameAsset.__table__, rows())
+
+        a = photogame.PhotoGameAsset.__table__
+        assets = {campaign['id']: [] for campaign in campaigns}
+        q = select([a.c.id, a.c.campaign_id]).where(a.c.campaign_id.in_(list(assets))).order_by(a.c.id)
+        for asset_id, campaign_id in conn.execute(q):
+            assets[campaign_id].append((asset_id, rng.gauss(0.0, 1.0)))
+        return assets
+
+    def insert_users(self, conn, campaigns: list) -> None:
+        client_ids = sorted(set(c['client_id'] for c in campaigns))
+        rng = self._rng
+
+        def rows():
+            for client_id in client_ids:
+                for n in range(self._scale.users):
+                    yield {'client_id': client_id, 'client_userid': client_userid(n),
+                           'ii_userid': '{0:032x}'.format(rng.getrandbits(128))}
+            for n in range(self._scale.users):
+                yield {'client_id': None, 'client_userid': None, 'ii_userid': '{0:032x}'.format(rng.getrandbits(128))}
+        insert_chunked(conn, photogame.GameUser.__table__, rows())
+
+    def insert_votes(self, conn, campaigns: list, assets: dict) -> None:
+        # ballots of 2 from campaigns in proportion to their size, the
+        # winner picked Bradley-Terry style from the hidden qualities
+        rng = self._rng
+        g = photogame.GameUser.__table__
+        user_ids = [row[0] for row in conn.execute(select([g.c.id]))]
+        campaign_ids = [c['id'] for c in campaigns]
+        cum_weights = []
+        total = 0
+        for campaign_id in campaign_ids:
+            total += len(assets[campaign_id])
+            cum_weights.append(total)
+        tallies = {}
+
+        def tally(asset_id, campaign_id, rank):
+            t = tallies.setdefault(asset_id, [campaign_id, 0, 0, 0])
+            t[1] += 1
+            t[2] += 1 if rank == 1 else 0
+            t[3] += rank
+
+        def rows():
+            for v in range(self._scale.votes):
+                campaign_id = rng.choices(campaign_ids, cum_weights=cum_weights)[0]
+                (a1, q1), (a2, q2) = rng.sample(assets[campaign_id], 2)
+                if rng.random() >= 1.0 / (1.0 + math.exp(q2 - q1)):
+                    a1, a2 = a2, a1
+                group_guid = '{0:032X}'.format(rng.getrandbits(128))
+                user_id = rng.choice(user_ids)
+                for asset_id, rank in ((a1, 1), (a2, 2)):
+                    tally(asset_id, campaign_id, rank)
+                    yield {'asset_id': asset_id, 'user_id': user_id, 'group_guid': group_guid, 'rank': rank}
+        insert_chunked(conn, photogame.PhotoGameResult.__table__, rows())
+
+        insert_chunked(conn, photogame.PhotoGameTally.__table__,
+                       ({'asset_id': asset_id, 'campaign_id': t[0], 'appearances': t[1], 'wins': t[2], 'rank_sum': t[3]}
+                        for asset_id, t in sorted(tallies.items())))
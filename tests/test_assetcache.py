@@ -0,0 +1,54 @@
+import unittest
+from controllers.assetcache import AssetByteCache, CachedAsset, cache_key
+from controllers.assetlookup import AssetLocation
+
+
+class TestAssetByteCache(unittest.TestCase):
+
+    def test_budget(self):
+        bc = AssetByteCache(max_bytes=100, max_item_bytes=50)
+        for asset_id in range(10):
+            bc.put(asset_id, CachedAsset(data=b'x' * 30))
+        stats = bc.stats()
+        assert(stats['bytes'] <= 100)
+        assert(stats['entries'] == 3)
+        assert(stats['evictions'] == 7)
+
+        bc.put(99, CachedAsset(data=b'x' * 60))  # too big to cache
+        assert(bc.get(99) is None)
+
+    def test_hot_assets_survive_scan(self):
+        bc = AssetByteCache(max_bytes=100, max_item_bytes=50)
+        bc.put(1, CachedAsset(data=b'x' * 30))
+        assert(bc.get(1) is not None)  # promoted to protected
+        for asset_id in range(100, 120):
+            bc.put(asset_id, CachedAsset(data=b'y' * 30))
+        assert(bc.get(1) is not None)
+
+    def test_invalidate(self):
+        bc = AssetByteCache(max_bytes=100, max_item_bytes=50)
+        bc.put(1, CachedAsset(data=b'x' * 30))
+        bc.invalidate(1)
+        assert(bc.get(1) is None)
+        stats = bc.stats()
+        assert(stats['invalidations'] == 1)
+        assert(stats['bytes'] == 0)
+
+    def test_admit_on_second_miss(self):
+        bc = AssetByteCache(max_bytes=100, max_item_bytes=50)
+        assert(not bc.should_load(5))
+        assert(bc.should_load(5))
+
+    def test_cache_key_shared_by_blob(self):
+        # two assets stored as the same blob share an entry
+        a = AssetLocation('/mnt/photos/blobs/ab/cd', 'abcd.JPG', True, 1, 0, None)
+        b = AssetLocation('/mnt/photos/blobs/ab/cd', 'abcd.JPG', True, 2, 0, None)
+        assert(cache_key(a) == cache_key(b) == '/mnt/photos/blobs/ab/cd/abcd.JPG')
+        assert(cache_key(a, (120, 80)) == ('/mnt/photos/blobs/ab/cd/abcd.JPG', 120, 80))
+
+        bc = AssetByteCache(max_bytes=100, max_item_bytes=50)
+        bc.put(cache_key(a), CachedAsset(data=b'x' * 30))
+        bc.put(cache_key(a, (120, 80)), CachedAsset(data=b'y' * 10))
+        assert(bc.get(cache_key(b)) is not None)
+        bc.invalidate(cache_key(a))  # takes the derivative with it
+        assert(bc.get(cache_key(b, (120, 80))) is None)
@@ -0,0 +1,62 @@
+import unittest
+from controllers.assetindex import CampaignAssets, AssetIndex
+
+
+class TestCampaignAssets(unittest.TestCase):
+
+    def test_add_remove(self):
+        ca = CampaignAssets([10, 11, 12, 13])
+        assert(len(ca) == 4)
+        ca.add(11)  # duplicates are ignored
+        assert(len(ca) == 4)
+
+        ca.remove(10)
+        assert(len(ca) == 3)
+        assert(10 not in ca)
+        for asset_id in (11, 12, 13):
+            assert(asset_id in ca)
+
+        ca.remove(99)  # unknown ids are ignored
+        assert(len(ca) == 3)
+
+    def test_sample(self):
+        ca = CampaignAssets(range(1000))
+        for i in range(100):
+            ballot = ca.sample(2)
+            assert(len(ballot) == 2)
+            assert(ballot[0] != ballot[1])
+            for asset_id in ballot:
+                assert(asset_id in ca)
+
+    def test_sample_ballots(self):
+        ca = CampaignAssets(range(100))
+        ballots = ca.sample_ballots(2, 10)
+        assert(len(ballots) == 10)
+        seen = [asset_id for ballot in ballots for asset_id in ballot]
+        assert(len(set(seen)) == 20)  # no repeats within the batch
+
+        # more ballots than the campaign can fill without repeating
+        ca = CampaignAssets(range(5))
+        ballots = ca.sample_ballots(2, 4)
+        assert(len(ballots) == 4)
+        for ballot in ballots:
+            assert(ballot[0] != ballot[1])
+
+    def test_sample_too_small(self):
+        ca = CampaignAssets([1])
+        with self.assertRaises(AssertionError):
+            ca.sample(2)
+
+    def test_asset_changed(self):
+        ai = AssetIndex()
+        ai.asset_changed(1, 100, True)  # campaign not loaded, nothing to do
+        assert(1 not in ai._campaigns)
+
+        ai._campaigns[1] = CampaignAssets([100, 101])
+        ai.asset_changed(1, 100, False)
+        ai.asset_changed(1, 102, True)
+        assert(100 not in ai._campaigns[1])
+        assert(102 in ai._campaigns[1])
+
+        ai.invalidate(1)
+        assert(1 not in ai._campaigns)
@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+import os
+from datetime import datetime, timedelta
+from models import photogame
+from controllers.assetlookup import AssetLocations, asset_locations, path_and_name
+from tests import SQLiteTest
+
+PHOTOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
+
+
+class TestAssetLocations(unittest.TestCase):
+
+    def test_store_get(self):
+        locations = AssetLocations(max_age=None)
+        assert(locations.get(1) is None)
+        loc = locations.store(1, '/mnt/photos/ab', 'X.JPG', True, 7)
+        assert(locations.get(1) is loc)
+        assert((loc.filepath, loc.filename, loc.active, loc.campaign_id) == ('/mnt/photos/ab', 'X.JPG', True, 7))
+        assert(path_and_name(loc) == '/mnt/photos/ab/X.JPG')
+
+        # directory names are shared by many assets, only kept once
+        other = locations.store(2, ''.join(['/mnt/photos/', 'ab']), 'Y.JPG', True, 7)
+        assert(other.filepath is loc.filepath)
+
+    def test_max_age(self):
+        locations = AssetLocations(max_age=60)
+        with mock.patch('controllers.assetlookup.time.time', return_value=1000.0):
+            locations.store(1, '/mnt', 'X.JPG', True, 7)
+        with mock.patch('controllers.assetlookup.time.time', return_value=1059.0):
+            assert(locations.get(1) is not None)
+        with mock.patch('controllers.assetlookup.time.time', return_value=1061.0):
+            assert(locations.get(1) is None)  # another worker may have changed it
+
+    def test_warm_campaign(self):
+        locations = AssetLocations(max_age=None)
+        locations.warm_campaign(7, [(1, '/mnt/a', 'X.JPG'), (2, '/mnt/b', 'Y.JPG')])
+        assert(len(locations) == 2)
+        loc = locations.get(2)
+        assert(loc.campaign_id == 7 and loc.active and loc.filename == 'Y.JPG')
+
+    def test_asset_changed(self):
+        locations = AssetLocations(max_age=None)
+        locations.store(1, '/mnt', 'X.JPG', True, 7)
+        locations.asset_changed(7, 1, False)
+        assert(not locations.get(1).active)
+        locations.asset_changed(7, 1, True)
+        assert(locations.get(1).active)
+
+        locations.asset_changed(7, 2, False)  # not one of ours, nothing to do
+        assert(locations.get(2) is None)
+
+    def test_dimensions(self):
+        locations = AssetLocations(max_age=None)
+        loc = locations.store(1, PHOTOS, 'TEST4.JPG', True, 7)
+        size = locations.dimensions(1, loc)
+        assert(len(size) == 2 and size[0] > 0 and size[1] > 0)
+        assert(locations.get(1).dimensions == size)  # kept in the entry
+
+        with mock.patch('controllers.assetlookup.Image.open') as image_open:
+            assert(locations.dimensions(1, locations.get(1)) == size)
+            locations.asset_changed(7, 1, False)
+            locations.store(1, PHOTOS, 'TEST4.JPG', True, 7)  # re-read, same file
+            assert(locations.get(1).dimensions == size)
+            assert(image_open.call_count == 0)
+
+        # a different file, or the entry going, takes the dimensions with it
+        locations.store(1, PHOTOS, 'TEST5.JPG', True, 7)
+        assert(locations.get(1).dimensions is None)
+        locations.dimensions(1, locations.get(1))
+        locations.invalidate(1)
+        locations.store(1, PHOTOS, 'TEST5.JPG', True, 7)
+        assert(locations.get(1).dimensions is None)
+
+        assert(locations.dimensions(2, locations.store(2, PHOTOS, 'missing.JPG', True, 7)) is None)
+
+    def test_invalidate(self):
+        locations = AssetLocations(max_age=None)
+        locations.store(1, '/mnt', 'X.JPG', True, 7)
+        locations.store(2, '/mnt', 'Y.JPG', True, 7)
+        locations.invalidate(1)
+        assert(locations.get(1) is None and locations.get(2) is not None)
+        locations.invalidate()
+        assert(len(locations) == 0)
+
+
+class TestAssetLookup(SQLiteTest):
+
+    def setUp(self):
+        super().setUp()
+        client = photogame.Client(name='lookup client')
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='lookup campaign', start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.campaign_id = campaign.id
+
+        pga = photogame.PhotoGameAsset(campaign_id=campaign.id)
+        pga.filepath = '/mnt/photos/ab'
+        pga.filename = 'X.JPG'
+        self.session.add(pga)
+        self.session.commit()
+        self.asset_id = pga.id
+
+    def test_lookup(self):
+        with mock.patch.object(self.session, 'query', wraps=self.session.query) as query:
+            loc = asset_locations.lookup(self.session, self.asset_id)
+            assert(path_and_name(loc) == '/mnt/photos/ab/X.JPG')
+            assert(loc.active and loc.campaign_id == self.campaign_id)
+            assert(asset_locations.lookup(self.session, self.asset_id) is loc)
+            assert(query.call_count == 1)
+
+        assert(asset_locations.lookup(self.session, 424242) is None)
+
+    def test_deactivated_on_commit(self):
+        asset_locations.lookup(self.session, self.asset_id)
+        pga = self.session.query(photogame.PhotoGameAsset).get(self.asset_id)
+        pga.active = 0
+        self.session.flush()
+        assert(asset_locations.get(self.asset_id).active)  # not until it commits
+
+        self.session.commit()
+        assert(not asset_locations.get(self.asset_id).active)
@@ -0,0 +1,221 @@
+import unittest
+from unittest import mock
+import tempfile
+import shutil
+import os
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Query
+from models import photogame
+from models.photogame import PhotoGameBlob, PhotoGameAsset
+from tests import SQLiteTest
+
+PHOTOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
+
+
+class TestBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_location(self):
+        sha256 = PhotoGameBlob.content_hash(b'some image')
+        assert(len(sha256) == 64)
+        filepath, filename = PhotoGameBlob.location(sha256, 'jpeg', '/mnt/photos')
+        assert(filepath == '/mnt/photos/blobs/{0}/{1}'.format(sha256[0:2], sha256[2:4]))
+        assert(filename == sha256 + '.JPG')
+        assert(PhotoGameBlob.location(sha256, 'JPG', '/mnt/photos') == (filepath, filename))
+
+    def test_store_blob_file(self):
+        filepath, filename = PhotoGameBlob.location(PhotoGameBlob.content_hash(b'abc'), 'JPG', self.tmp)
+        path_and_name = os.path.join(filepath, filename)
+        pga = PhotoGameAsset()
+        pga.store_blob_file(path_and_name, b'abc')
+        pga.store_blob_file(path_and_name, b'abc')  # already there, not written again
+        assert(os.listdir(filepath) == [filename])
+        with open(path_and_name, 'rb') as fp:
+            assert(fp.read() == b'abc')
+
+        # a blob row we've just created always gets its file written
+        os.utime(path_and_name, (0, 0))
+        pga.store_blob_file(path_and_name, b'abc', replace=True)
+        assert(os.path.getmtime(path_and_name) > 0)
+        assert(os.listdir(filepath) == [filename])
+
+
+class TestBlobReferences(SQLiteTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch('dbsetup.image_store', return_value=self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        client = photogame.Client(name='blob client')
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='blob campaign', start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.campaign_id = campaign.id
+        with open(os.path.join(PHOTOS, 'TEST4.JPG'), 'rb') as fp:
+            self.img = fp.read()
+
+    def stored_blob(self) -> PhotoGameBlob:
+        # a committed blob with one reference and its file written
+        blob = PhotoGameBlob.acquire(self.session, PhotoGameBlob.content_hash(self.img), 'JPG', len(self.img))
+        PhotoGameAsset().store_blob_file(blob.path_and_name(), self.img)
+        self.session.commit()
+        return blob
+
+    def refcount(self, blob_id: int) -> int:
+        row = self.session.query(PhotoGameBlob.refcount).filter(PhotoGameBlob.id == blob_id).one_or_none()
+        return row[0] if row is not None else None
+
+    def test_acquire_new(self):
+        sha256 = PhotoGameBlob.content_hash(self.img)
+        blob = PhotoGameBlob.acquire(self.session, sha256, 'jpeg', len(self.img))
+        self.session.commit()
+        assert(blob.id is not None)
+        assert(self.refcount(blob.id) == 1)
+        assert((blob.filepath, blob.filename) == PhotoGameBlob.location(sha256, 'JPG', self.tmp))
+        assert(blob.size == len(self.img))
+
+    def test_acquire_existing(self):
+        blob = self.stored_blob()
+        again = PhotoGameBlob.acquire(self.session, blob.sha256, 'PNG', len(self.img))
+        self.session.commit()
+        assert(again.id == blob.id)
+        assert(again.filename == blob.filename)  # stored location wins over the new extension
+        assert(self.refcount(blob.id) == 2)
+        assert(self.session.query(PhotoGameBlob).count() == 1)
+
+    def test_acquire_race(self):
+        # another uploader's row isn't visible to our first read, our
+        # insert fails on the unique sha256 and we use their row
+        blob = self.stored_blob()
+        blob_id = blob.id
+        one_or_none = Query.one_or_none
+        reads = []
+
+        def first_read_misses(query):
+            reads.append(query)
+            return None if len(reads) == 1 else one_or_none(query)
+
+        with mock.patch.object(Query, 'one_or_none', first_read_misses):
+            again = PhotoGameBlob.acquire(self.session, blob.sha256, 'JPG', len(self.img))
+        assert(len(reads) == 2)  # the miss, then the locking re-read after the failed insert
+        self.session.commit()
+        assert(again.id == blob_id)
+        assert(self.refcount(blob_id) == 2)
+
+    def test_release_shared(self):
+        blob = self.stored_blob()
+        PhotoGameBlob.acquire(self.session, blob.sha256, 'JPG', len(self.img))
+        self.session.commit()
+
+        PhotoGameBlob.release(self.session, blob.id)
+        self.session.commit()
+        assert(self.refcount(blob.id) == 1)
+        assert(os.path.exists(blob.path_and_name()))
+
+    def test_last_release_on_commit(self):
+        blob = self.stored_blob()
+        blob_id, path_and_name = blob.id, blob.path_and_name()
+        PhotoGameBlob.release(self.session, blob_id)
+        assert(self.refcount(blob_id) is None)
+        assert(os.path.exists(path_and_name))  # not until the commit
+        self.session.commit()
+        assert(not os.path.exists(path_and_name))
+
+    def test_last_release_rolled_back(self):
+        blob = self.stored_blob()
+        blob_id, path_and_name = blob.id, blob.path_and_name()
+        PhotoGameBlob.release(self.session, blob_id)
+        self.session.rollback()
+        assert(self.refcount(blob_id) == 1)
+        assert(os.path.exists(path_and_name))
+
+        self.session.commit()  # nothing left queued from the rolled back release
+        assert(os.path.exists(path_and_name))
+
+    def test_create_asset_shares_blob(self):
+        assets = []
+        for i in range(2):
+            pga = PhotoGameAsset()
+            pga.create_asset(self.campaign_id, self.img, session=self.session)
+            self.session.add(pga)
+            self.session.commit()
+            assets.append(pga)
+        assert(assets[0].blob_id is not None and assets[0].blob_id == assets[1].blob_id)
+        assert((assets[0].filepath, assets[0].filename) == (assets[1].filepath, assets[1].filename))
+        assert(self.refcount(assets[0].blob_id) == 2)
+        path_and_name = os.path.join(assets[0].filepath, assets[0].filename)
+        assert(os.listdir(assets[0].filepath) == [assets[0].filename])
+
+        blob_id = assets[0].blob_id
+        assets[0].delete_asset(self.session)
+        self.session.commit()
+        assert(self.refcount(blob_id) == 1)
+        assert(os.path.exists(path_and_name))
+
+        assets[1].delete_asset(self.session)
+        self.session.commit()
+        assert(self.refcount(blob_id) is None)
+        assert(not os.path.exists(path_and_name))
+
+    def test_create_asset_without_session(self):
+        pga = PhotoGameAsset()
+        pga.create_asset(self.campaign_id, self.img)
+        assert(pga.blob_id is None)
+        assert(not pga.filename.startswith(PhotoGameBlob.content_hash(self.img)))
+        assert(os.path.exists(os.path.join(pga.filepath, pga.filename)))
+
+    def test_create_asset_rolled_back(self):
+        pga = PhotoGameAsset()
+        pga.create_asset(self.campaign_id, self.img, session=self.session)
+        path_and_name = os.path.join(pga.filepath, pga.filename)
+        assert(os.path.exists(path_and_name))
+        self.session.rollback()
+        assert(not os.path.exists(path_and_name))  # no pgblob row, nobody would ever clean it up
+
+        # a shared blob's file stays, it's still referenced
+        blob = self.stored_blob()
+        pga = PhotoGameAsset()
+        pga.create_asset(self.campaign_id, self.img, session=self.session)
+        self.session.rollback()
+        assert(self.refcount(blob.id) == 1)
+        assert(os.path.exists(blob.path_and_name()))
+
+    def test_create_asset_replaces_released_file(self):
+        # our new row reuses the path of a released blob whose file is
+        # (about to be) deleted, so we write the file regardless
+        blob = self.stored_blob()
+        path_and_name = blob.path_and_name()
+        PhotoGameBlob.release(self.session, blob.id)
+        self.session.commit()
+        with open(path_and_name, 'wb') as fp:
+            fp.write(b'stale')
+
+        pga = PhotoGameAsset()
+        pga.create_asset(self.campaign_id, self.img, session=self.session)
+        self.session.add(pga)
+        self.session.commit()
+        with open(path_and_name, 'rb') as fp:
+            assert(fp.read() == self.img)
+
+    def test_savepoint_isnt_the_commit(self):
+        # releasing a savepoint fires after_commit too, the file goes with the real commit
+        blob = self.stored_blob()
+        path_and_name = blob.path_and_name()
+        PhotoGameBlob.release(self.session, blob.id)
+        with self.session.begin_nested():
+            self.session.add(photogame.Client(name='another client'))
+        assert(os.path.exists(path_and_name))
+        self.session.commit()
+        assert(not os.path.exists(path_and_name))
@@ -0,0 +1,171 @@
+import unittest
+import tempfile
+import shutil
+import os
+from datetime import datetime, timedelta
+from models import photogame
+from controllers.bulkingest import list_sources, source_extension, IngestState, BulkIngest
+from tests import SQLiteTest
+
+PHOTOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
+
+
+class TestBulkIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_list_sources(self):
+        sources = list_sources(PHOTOS)
+        assert(len(sources) >= 2)
+        assert(sources == sorted(sources))
+
+        manifest = os.path.join(self.tmp, 'photos.manifest')
+        with open(manifest, 'w') as fp:
+            fp.write('# comment\n\n' + '\n'.join(sources) + '\n')
+        assert(list_sources(manifest) == sources)
+
+    def test_source_extension(self):
+        assert(source_extension('/a/b/IMG_0001.jpeg') == 'JPEG')
+        assert(source_extension('/a/b/IMG_0001') == 'JPG')
+
+    def test_state_resumes(self):
+        filename = os.path.join(self.tmp, 'ingest.state')
+        state = IngestState(filename)
+        assert(len(state) == 0)
+        state.begin([{'source': '/a/1.jpg', 'sha256': 'ab' * 32}], 0)
+        state.commit()
+        state.begin([{'source': '/a/2.jpg', 'sha256': 'cd' * 32}], 7)
+        with open(filename, 'a') as fp:
+            fp.write('{"commit')  # interrupted mid line
+
+        state = IngestState(filename)
+        assert(len(state) == 1)
+        assert('/a/1.jpg' in state)
+        assert('/a/2.jpg' not in state)
+        assert([row['sha256'] for row in state.unconfirmed()] == ['cd' * 32])
+        assert(state.after_id() == 7)
+
+        state.discard()
+        state = IngestState(filename)
+        assert(len(state) == 1)
+        assert(len(state.unconfirmed()) == 0)
+
+    def test_copy_file(self):
+        ingest = BulkIngest(campaign_id=1, mnt_point=self.tmp)
+        source = list_sources(PHOTOS)[0]
+        row = ingest.copy_file(source)
+        assert(row is not None)
+        assert(row['filepath'] == os.path.join(self.tmp, 'blobs', row['sha256'][0:2], row['sha256'][2:4]))
+        assert(row['filename'] == row['sha256'] + '.JPG')
+        with open(os.path.join(row['filepath'], row['filename']), 'rb') as fp:
+            assert(len(fp.read()) == row['size'] == os.path.getsize(source))
+
+        # the same image again is the same blob
+        copy = os.path.join(self.tmp, 'copy.jpeg')
+        shutil.copyfile(source, copy)
+        again = ingest.copy_file(copy)
+        assert((again['filepath'], again['filename']) == (row['filepath'], row['filename']))
+        assert(len(os.listdir(row['filepath'])) == 1)
+
+        assert(ingest.copy_file(os.path.join(self.tmp, 'missing.jpg')) is None)
+
+
+class TestBulkIngestRun(SQLiteTest):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        client = photogame.Client(name='ingest client')
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='ingest campaign', start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.campaign_id = campaign.id
+        self.session.commit()  # the ingest has the (only) connection to itself
+
+        # TEST4 twice (the second copy is the same blob) and TEST5
+        self.source = os.path.join(self.tmp, 'source')
+        os.mkdir(self.source)
+        for src, dst in (('TEST4.JPG', 'a.jpg'), ('TEST4.JPG', 'b.jpg'), ('TEST5.JPG', 'c.jpg')):
+            shutil.copyfile(os.path.join(PHOTOS, src), os.path.join(self.source, dst))
+        self.state_file = os.path.join(self.tmp, 'ingest.state')
+
+    def ingest(self, **kwargs) -> BulkIngest:
+        return BulkIngest(campaign_id=self.campaign_id, state=IngestState(self.state_file),
+                          mnt_point=os.path.join(self.tmp, 'store'), workers=2, **kwargs)
+
+    def refcounts(self) -> list:
+        rows = self.session.query(photogame.PhotoGameBlob.refcount).order_by(photogame.PhotoGameBlob.refcount).all()
+        self.session.commit()
+        return [row[0] for row in rows]
+
+    def assets(self) -> list:
+        rows = self.session.query(photogame.PhotoGameAsset.blob_id, photogame.PhotoGameAsset.filepath, photogame.PhotoGameAsset.filename).\
+            filter(photogame.PhotoGameAsset.campaign_id == self.campaign_id).\
+            order_by(photogame.PhotoGameAsset.id).all()
+        self.session.commit()
+        return rows
+
+    def test_run(self):
+        # a batch per image, b.jpg takes a second reference to a.jpg's blob
+        sources = list_sources(self.source)
+        stats = self.ingest(batch=1).run(sources)
+        assert(stats.files == 3 and stats.failed == 0 and stats.skipped == 0)
+        assert(self.refcounts() == [1, 2])
+
+        assets = self.assets()
+        assert(len(assets) == 3)
+        assert(assets[0] == assets[1] and assets[0] != assets[2])  # a.jpg and b.jpg share the blob
+        for blob_id, filepath, filename in assets:
+            assert(blob_id is not None and os.path.exists(os.path.join(filepath, filename)))
+        assert(len(IngestState(self.state_file)) == 3)
+
+        # run again from the same state file, nothing goes in twice
+        stats = self.ingest(batch=1).run(sources)
+        assert(stats.files == 0 and stats.skipped == 3)
+        assert(self.refcounts() == [1, 2])
+        assert(len(self.assets()) == 3)
+
+    def test_resolve_committed(self):
+        # interrupted after the INSERT committed but before the committed line
+        sources = list_sources(self.source)
+        self.ingest(batch=3).run(sources)
+        with open(self.state_file, 'r') as fp:
+            lines = fp.readlines()
+        assert(lines[-1].startswith('{"committed"'))
+        with open(self.state_file, 'w') as fp:
+            fp.writelines(lines[:-1])
+
+        state = IngestState(self.state_file)
+        assert(len(state) == 0 and len(state.unconfirmed()) == 3)
+        ingest = BulkIngest(campaign_id=self.campaign_id, state=state, mnt_point=os.path.join(self.tmp, 'store'))
+        ingest.resolve()
+        assert(len(state) == 3 and len(state.unconfirmed()) == 0)
+
+        stats = ingest.run(sources)
+        assert(stats.files == 0 and stats.skipped == 3)
+        assert(self.refcounts() == [1, 2])
+        assert(len(self.assets()) == 3)
+
+    def test_resolve_lost(self):
+        # interrupted before the INSERT committed: the batch is dropped and ingested again
+        sources = list_sources(self.source)
+        IngestState(self.state_file).begin([{'source': source, 'sha256': 'ab' * 32} for source in sources], 0)
+
+        state = IngestState(self.state_file)
+        ingest = BulkIngest(campaign_id=self.campaign_id, state=state, mnt_point=os.path.join(self.tmp, 'store'))
+        ingest.resolve()
+        assert(len(state) == 0 and len(state.unconfirmed()) == 0)
+        assert(len(IngestState(self.state_file).unconfirmed()) == 0)
+
+        stats = ingest.run(sources)
+        assert(stats.files == 3 and stats.skipped == 0)
+        assert(self.refcounts() == [1, 2])
+        assert(len(self.assets()) == 3)
@@ -0,0 +1,124 @@
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from models import photogame
+from models.photogame import CampaignCache, campaign_cache
+from tests import SQLiteTest
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCampaignCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('models.photogame.time.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = CampaignCache(ttl=60, negative_ttl=5, max_entries=3)
+
+    def session(self, campaign=None) -> mock.MagicMock:
+        # counts the lookups that reach the "database"
+        session = mock.MagicMock()
+        session.query.return_value.get.return_value = campaign
+        return session
+
+    def campaign(self, campaign_id: int) -> photogame.Campaign:
+        now = datetime.now()
+        return photogame.Campaign(id=campaign_id, client_id=1, name='c', start_date=now, end_date=now + timedelta(days=1))
+
+    def test_ttl(self):
+        session = self.session(self.campaign(1))
+        cw = self.cache.lookup(session, 1)
+        assert(cw is not None)
+        assert(self.cache.lookup(session, 1) is cw)
+        assert(session.query.call_count == 1)
+
+        self.clock.now += 61
+        assert(self.cache.get(1) is None)
+        assert(self.cache.lookup(session, 1) is not cw)
+        assert(session.query.call_count == 2)
+
+    def test_negative(self):
+        session = self.session(None)
+        assert(self.cache.lookup(session, 99) is None)
+        assert(self.cache.lookup(session, 99) is None)
+        assert(session.query.call_count == 1)
+
+        # unknown ids are forgotten sooner than real ones
+        self.clock.now += 6
+        self.cache.lookup(session, 99)
+        assert(session.query.call_count == 2)
+
+    def test_max_entries(self):
+        for campaign_id in (1, 2, 3):
+            self.cache.store(campaign_id, None)
+        self.clock.now += 6  # the three negative entries expire
+
+        self.cache.store(4, 'cw4')
+        assert(len(self.cache._entries) == 1)
+        self.cache.store(5, 'cw5')
+        self.cache.store(6, 'cw6')
+        assert(len(self.cache._entries) == 3)
+
+        # full of live entries, a new id starts over rather than grow
+        self.cache.store(7, 'cw7')
+        assert(len(self.cache._entries) == 1 and self.cache.get(7)[1] == 'cw7')
+
+        self.cache.store(7, 'cw7 again')  # replacing never evicts
+        assert(len(self.cache._entries) == 1)
+
+    def test_invalidate(self):
+        self.cache.store(1, 'cw1')
+        self.cache.store(2, 'cw2')
+        self.cache.invalidate(1)
+        assert(self.cache.get(1) is None and self.cache.get(2) is not None)
+        self.cache.invalidate()
+        assert(self.cache.get(2) is None)
+
+
+class TestCampaignInvalidation(SQLiteTest):
+
+    def setUp(self):
+        super().setUp()
+        client = photogame.Client(name='cache client')
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='cache campaign', start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.campaign_id = campaign.id
+
+    def cached_end(self) -> datetime:
+        entry = campaign_cache.get(self.campaign_id)
+        return entry[1].end_date if entry is not None else None
+
+    def end_now(self) -> datetime:
+        c = self.session.query(photogame.Campaign).get(self.campaign_id)
+        c.end_date = datetime.now().replace(microsecond=0)
+        self.session.flush()
+        return c.end_date
+
+    def test_invalidated_on_commit(self):
+        running_until = campaign_cache.lookup(self.session, self.campaign_id).end_date
+        end_date = self.end_now()
+        assert(self.cached_end() == running_until)  # not visible to anyone else yet
+
+        self.session.commit()
+        assert(campaign_cache.get(self.campaign_id) is None)
+        assert(campaign_cache.lookup(self.session, self.campaign_id).end_date == end_date)
+
+    def test_invalidated_on_rollback(self):
+        running_until = self.session.query(photogame.Campaign).get(self.campaign_id).end_date
+        self.end_now()
+        campaign_cache.lookup(self.session, self.campaign_id)  # our own uncommitted change
+        self.session.rollback()
+        assert(campaign_cache.get(self.campaign_id) is None)
+        assert(campaign_cache.lookup(self.session, self.campaign_id).end_date == running_until)
@@ -0,0 +1,140 @@
+import unittest
+from unittest import mock
+import threading
+import sqlite3
+import time
+from sqlalchemy import create_engine, event, exc, text
+import dbsetup
+from dbsetup import InstrumentedQueuePool
+
+
+class PingableConnection():
+    # a sqlite3 connection with PyMySQL's ping(), the "server" can make
+    # the next few pings fail
+    def __init__(self, server):
+        self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._server = server
+
+    def ping(self, reconnect=False):
+        self._server.pings += 1
+        if self._server.fail_pings > 0:
+            self._server.fail_pings -= 1
+            raise OSError('MySQL server has gone away')
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class Server():
+    def __init__(self):
+        self.fail_pings = 0
+        self.pings = 0
+        self.connections = 0
+
+    def connect(self) -> PingableConnection:
+        self.connections += 1
+        return PingableConnection(self)
+
+
+class TestInstrumentedPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        self.engine = create_engine('sqlite://', creator=self.server.connect, poolclass=InstrumentedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.2)
+        # the hooks dbsetup puts on its own engine
+        for name, fn in (('connect', dbsetup.connection_opened), ('checkin', dbsetup.connection_returned),
+                         ('invalidate', dbsetup.connection_invalidated), ('checkout', dbsetup.ping_connection)):
+            event.listen(self.engine, name, fn)
+        for patcher in (mock.patch.object(dbsetup, 'engine', self.engine),
+                        mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING', 'idle'),
+                        mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING_IDLE', 1000.0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkout_checkin(self):
+        conn = self.engine.connect()
+        stats = dbsetup.pool_stats()
+        assert(stats['checked_out'] == 1 and stats['checked_in'] == 0)
+        conn.close()
+        stats = dbsetup.pool_stats()
+        assert(stats['checked_out'] == 0 and stats['checked_in'] == 1)
+        assert(stats['waits'] == 0 and stats['timeouts'] == 0)
+
+    def test_wait(self):
+        conn = self.engine.connect()
+        threading.Timer(0.05, conn.close).start()
+        other = self.engine.connect()  # waits for the pool's only connection
+        other.close()
+        stats = dbsetup.pool_stats()
+        assert(stats['waits'] == 1 and stats['timeouts'] == 0)
+        assert(stats['wait_seconds'] >= 0.04 and stats['max_wait_seconds'] == stats['wait_seconds'])
+
+    def test_timeout(self):
+        conn = self.engine.connect()
+        try:
+            with self.assertRaises(exc.TimeoutError):
+                self.engine.connect()
+        finally:
+            conn.close()
+        stats = dbsetup.pool_stats()
+        assert(stats['timeouts'] == 1 and stats['waits'] == 1)
+
+    def test_invalidation(self):
+        conn = self.engine.connect()
+        conn.invalidate()
+        conn.close()
+        assert(dbsetup.pool_stats()['invalidations'] == 1)
+
+        # the pool opens a new connection next time, the counters survive a recreate
+        self.engine.connect().close()
+        assert(self.server.connections == 2)
+        pool = self.engine.pool.recreate()
+        assert(pool.stats()['invalidations'] == 1)
+        pool.dispose()
+
+    def test_idle_ping(self):
+        self.engine.connect().close()
+        self.engine.connect().close()
+        assert(self.server.pings == 0)  # used moments ago, no ping
+
+        with mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING_IDLE', 0.0):
+            time.sleep(0.01)
+            self.engine.connect().close()
+        assert(self.server.pings == 1)
+        assert(dbsetup.pool_stats()['pings'] == 1)
+
+    def test_ping_policies(self):
+        with mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING', 'always'):
+            for i in range(3):
+                self.engine.connect().close()
+        assert(self.server.pings == 3)
+
+        with mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING', 'never'), \
+                mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING_IDLE', 0.0):
+            self.engine.connect().close()
+        assert(self.server.pings == 3)
+
+    def test_disconnect_retried(self):
+        # a connection that fails its ping is thrown away and the
+        # checkout retried on a fresh one, the caller never notices
+        self.engine.connect().close()
+        assert(self.server.connections == 1)
+
+        self.server.fail_pings = 1
+        with mock.patch.object(dbsetup.Configuration, 'DB_PRE_PING', 'always'):
+            with self.engine.connect() as conn:
+                assert(conn.execute(text('SELECT 1')).scalar() == 1)
+
+        stats = dbsetup.pool_stats()
+        assert(self.server.connections == 2 and self.server.pings == 2)
+        assert(stats['pings'] == 2 and stats['ping_failures'] == 1 and stats['invalidations'] == 1)
+
+    def test_unknown_policy(self):
+        for policy in dbsetup.PRE_PING_POLICIES:
+            assert(dbsetup.check_pre_ping_policy(policy) == policy)
+        with self.assertRaises(ValueError):
+            dbsetup.check_pre_ping_policy('idel')
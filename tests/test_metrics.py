@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+import threading
+import tempfile
+import shutil
+import runpy
+import os
+import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = metrics.Histogram()
+        for i in range(1, 101):
+            h.observe(i / 1000.0)  # 1ms .. 100ms
+        assert(h.count == 100)
+        assert(h.errors == 0)
+        assert(0.04 <= h.percentile(0.5) <= 0.06)
+        assert(0.06 <= h.percentile(0.95) <= 0.1)
+        assert(h.percentile(0.99) <= 0.1)
+
+    def test_merge(self):
+        h1 = metrics.Histogram()
+        h2 = metrics.Histogram()
+        h1.observe(0.01)
+        h2.observe(0.02, error=True)
+        h1.merge(h2)
+        assert(h1.count == 2)
+        assert(h1.errors == 1)
+        assert(sum(h1.counts) == 2)
+
+    def test_prometheus_format(self):
+        reg = metrics.MetricsRegistry(metrics_dir=None)
+        reg.observe('get_images', 0.003)
+        body = metrics.format_prometheus(reg.aggregate())
+        assert('widget_timer_seconds_count{fn="get_images"} 1' in body)
+        assert('widget_timer_seconds_bucket{fn="get_images",le="+Inf"} 1' in body)
+
+
+class TestMetricsDir(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_concurrent_dumps(self):
+        reg = metrics.MetricsRegistry(metrics_dir=self.dir, dump_interval=0.0)
+        errors = []
+
+        def worker():
+            try:
+                for i in range(200):
+                    reg.observe('get_images', 0.001)
+                    reg.dump()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert(errors == [])
+        assert(os.listdir(self.dir) == ['metrics_{0}.json'.format(os.getpid())])
+
+        reg.dump()
+        assert(reg.load(reg.snapshot_filename(os.getpid()))['get_images'].count == 1600)
+
+    def test_dead_worker_archived(self):
+        # a worker's timings outlive it, via gunicorn's child_exit hook
+        dead = metrics.MetricsRegistry(metrics_dir=self.dir)
+        dead.observe('campaign_vote', 0.01)
+        dead.dump()
+        os.rename(dead.snapshot_filename(os.getpid()), dead.snapshot_filename(999999))
+
+        reg = metrics.MetricsRegistry(metrics_dir=self.dir)
+        reg.observe('campaign_vote', 0.02)
+
+        class Worker():
+            pid = 999999
+
+        conf = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py'))
+        with mock.patch.object(metrics, 'registry', reg):
+            conf['child_exit'](None, Worker())
+        assert(not os.path.exists(reg.snapshot_filename(999999)))
+        assert(reg.aggregate()['campaign_vote'].count == 2)
+
+        reg.mark_process_dead(999999)  # already gone, nothing changes
+        assert(reg.aggregate()['campaign_vote'].count == 2)
@@ -0,0 +1,51 @@
+import unittest
+import random
+from controllers.pairing import FenwickTree, CampaignPairing
+
+
+class TestFenwickTree(unittest.TestCase):
+
+    def test_prefix_and_find(self):
+        weights = [random.random() for i in range(200)]
+        ft = FenwickTree(weights[:100])
+        for w in weights[100:]:
+            ft.append(w)
+        assert(abs(ft.total() - sum(weights)) < 1e-9)
+
+        ft.set(10, 3.0)
+        weights[10] = 3.0
+        for i in range(500):
+            u = random.random() * ft.total()
+            idx = ft.find(u)
+            assert(sum(weights[:idx]) <= u + 1e-9)
+            assert(u <= sum(weights[:idx + 1]) + 1e-9)
+
+
+class TestCampaignPairing(unittest.TestCase):
+
+    def test_sample(self):
+        cp = CampaignPairing([(asset_id, 10, 5) for asset_id in range(50)])
+        for i in range(100):
+            ballot = cp.sample(2, 4)
+            assert(len(ballot) == 2)
+            assert(ballot[0] != ballot[1])
+
+        cp.remove(7)
+        assert(len(cp) == 49)
+        for i in range(200):
+            assert(7 not in cp.sample(2, 4))
+        cp.add(7)
+        cp.add(50)
+        assert(len(cp) == 51)
+
+    def test_favours_undersampled(self):
+        # 90 well known assets and 10 new ones
+        cp = CampaignPairing([(asset_id, 100 if asset_id < 90 else 0, 50 if asset_id < 90 else 0) for asset_id in range(100)])
+        shown = [0] * 100
+        for i in range(1000):
+            ballot = cp.sample(2, 4)
+            for asset_id in ballot:
+                shown[asset_id] += 1
+            cp.record(ballot[0], True)
+            cp.record(ballot[1], False)
+        assert(sum(shown[90:]) / 10 > sum(shown[:90]) / 90)
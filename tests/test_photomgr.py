@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event
+import dbsetup
+from models import photogame
+from controllers.photomgr import PhotoGameMgr
+from controllers.usertoken import UserToken
+from tests import SQLiteTest
+
+
+class TestTallyResults(SQLiteTest):
+
+    def setUp(self):
+        super().setUp()
+        client = photogame.Client(name='tally client')
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='tally campaign', start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.asset_ids = []
+        for i in range(3):
+            pga = photogame.PhotoGameAsset(campaign_id=campaign.id)
+            pga.filepath = '/mnt/photos/ab'
+            pga.filename = '{0}.JPG'.format(i)
+            self.session.add(pga)
+            self.session.commit()
+            self.asset_ids.append(pga.id)
+
+        # every statement (and whether it was an executemany) and every commit
+        self.statements = []
+        self.commits = 0
+        event.listen(dbsetup.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(dbsetup.engine, 'commit', self.commit)
+
+    def tearDown(self):
+        event.remove(dbsetup.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(dbsetup.engine, 'commit', self.commit)
+        super().tearDown()
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement.split()[0].upper(), statement, executemany))
+
+    def commit(self, conn):
+        self.commits += 1
+
+    def votes(self) -> list:
+        return [{'asset_id': asset_id, 'rank': rank} for rank, asset_id in enumerate(self.asset_ids, 1)]
+
+    def result_inserts(self) -> list:
+        return [executemany for verb, statement, executemany in self.statements
+                if verb == 'INSERT' and 'pgresult' in statement]
+
+    def test_one_insert_no_commit(self):
+        pm = PhotoGameMgr()
+        gu_id = pm.tally_results(self.session, 'client-user', 'ii-1', self.votes())
+        assert(gu_id is not None)
+        assert(self.result_inserts() == [True])  # the whole ballot in one executemany
+        assert(self.commits == 0)  # the new gameuser is only in a savepoint
+        assert([verb for verb, statement, executemany in self.statements].count('INSERT') >= 2)
+
+        self.session.commit()
+        assert(self.commits == 1)
+        assert(self.session.query(photogame.PhotoGameResult).filter(photogame.PhotoGameResult.user_id == gu_id).count() == 3)
+        tally = self.session.query(photogame.PhotoGameTally).filter(photogame.PhotoGameTally.asset_id == self.asset_ids[0]).one()
+        assert(tally.appearances == 1 and tally.wins == 1)
+
+    def test_token_skips_user_lookup(self):
+        pm = PhotoGameMgr()
+        gu_id = pm.tally_results(self.session, 'client-user', 'ii-1', self.votes())
+        self.session.commit()
+        token = pm.user_token(self.session, UserToken(ii_user_id='ii-1'), 'client-user', self.asset_ids[0], gu_id)
+
+        del self.statements[:]
+        assert(pm.tally_results(self.session, 'client-user', 'ii-1', self.votes(), token=token) == gu_id)
+        assert(not any('gameuser' in statement for verb, statement, executemany in self.statements))
+        assert(self.result_inserts() == [True])
+        self.session.rollback()
@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+import threading
+import time
+import numpy as np
+from controllers import ranking
+from controllers.ranking import RankingModel, RankingCache, ballots_to_pairs
+
+
+def pairs(rows: list) -> list:
+    # rows of (ballot, asset id, rank) -> sorted (winner, loser) pairs
+    groups, asset_ids, ranks = (np.array(col, dtype=np.int64) for col in zip(*rows))
+    winners, losers = ballots_to_pairs(groups, asset_ids, ranks)
+    return sorted(zip(winners.tolist(), losers.tolist()))
+
+
+def model_of(games: list, **kwargs) -> RankingModel:
+    model = RankingModel(**kwargs)
+    model.add_pairs(np.array([w for w, l in games], dtype=np.int64), np.array([l for w, l in games], dtype=np.int64))
+    return model
+
+
+class TestBallotsToPairs(unittest.TestCase):
+
+    def test_winner_beats_the_rest(self):
+        # rows in any order, the first place asset beats everyone else on its ballot
+        assert(pairs([(0, 12, 3), (0, 10, 1), (0, 11, 2)]) == [(10, 11), (10, 12)])
+        assert(pairs([(0, 10, 1), (1, 11, 2), (0, 11, 2), (1, 10, 1)]) == [(10, 11), (10, 11)])
+
+    def test_ties(self):
+        # tied with the winner is no preference, the first listed wins the tie
+        assert(pairs([(0, 11, 1), (0, 10, 1), (0, 12, 2)]) == [(11, 12)])
+        assert(pairs([(0, 10, 1), (0, 11, 1)]) == [])
+
+    def test_empty(self):
+        winners, losers = ballots_to_pairs(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        assert(len(winners) == 0 and len(losers) == 0)
+
+
+class TestRankingModel(unittest.TestCase):
+
+    def test_bradley_terry_two_assets(self):
+        # 3 wins to 1 without a prior: p(10)/p(11) = 3, geometric mean 1
+        model = model_of([(10, 11)] * 3 + [(11, 10)], prior=0.0, tol=1e-10)
+        iterations = model.fit_bradley_terry()
+        assert(iterations < 500)
+        strength = dict(zip(model.asset_ids.tolist(), model.strength.tolist()))
+        assert(abs(strength[10] - np.sqrt(3.0)) < 1e-6)
+        assert(abs(strength[11] - 1.0 / np.sqrt(3.0)) < 1e-6)
+
+    def test_bradley_terry_prior(self):
+        # an asset that never lost still gets a finite strength
+        model = model_of([(10, 11)] * 5)
+        model.fit_bradley_terry()
+        assert(np.all(np.isfinite(model.strength)))
+        assert(model.strength[0] > model.strength[1])
+
+    def test_bradley_terry_order(self):
+        # 10 > 11 > 12, with 12 beating 10 once
+        games = [(10, 11)] * 4 + [(11, 12)] * 4 + [(10, 12)] * 4 + [(11, 10), (12, 11), (12, 10)]
+        model = model_of(games)
+        model.fit()
+        assert([entry['asset_id'] for entry in model.top(3)] == [10, 11, 12])
+        assert([entry['comparisons'] for entry in model.top(3)] == [10, 10, 10])
+        assert([entry['asset_id'] for entry in model.top(3, method='elo')] == [10, 11, 12])
+
+    def test_warm_start(self):
+        games = [(10, 11)] * 6 + [(11, 10)] * 2 + [(11, 12)] * 3 + [(12, 11)]
+        cold = model_of(games, tol=1e-9)
+        cold_iterations = cold.fit_bradley_terry()
+        warm = model_of(games, tol=1e-9)
+        warm.strength = cold.strength.copy()
+        assert(warm.fit_bradley_terry() < cold_iterations)
+        assert(np.allclose(warm.strength, cold.strength))
+
+    def test_elo(self):
+        # one game from 1500 each: expected 0.5, so +/- K/2
+        model = model_of([(10, 11)], elo_k=32.0)
+        model.fit_elo(epochs=1)
+        assert(np.allclose(model.scores('elo'), [1516.0, 1484.0]))
+
+        # a second epoch starts from 1516/1484: expected 1 / (1 + 10^(-32/400))
+        expected = 1.0 / (1.0 + 10.0 ** (-32.0 / 400.0))
+        model.fit_elo(epochs=1)
+        step = 32.0 * (1.0 - expected)
+        assert(np.allclose(model.scores('elo'), [1516.0 + step, 1484.0 - step]))
+
+    def test_new_assets(self):
+        model = model_of([(10, 11)])
+        model.fit()
+        model.add_pairs(np.array([12], dtype=np.int64), np.array([10], dtype=np.int64))
+        assert(model.asset_ids.tolist() == [10, 11, 12])
+        assert(len(model.strength) == 3 and len(model.elo) == 3)
+        assert(model.winners.tolist() == [0, 2] and model.losers.tolist() == [1, 0])
+
+
+class TestRankingCache(unittest.TestCase):
+
+    def test_refresh(self):
+        cache = RankingCache(refresh=60, rebuild=3600)
+        with mock.patch.object(ranking, 'update_model') as update:
+            model = cache.model(None, 1)
+            assert(cache.model(None, 1) is model)
+            assert(update.call_count == 1)
+
+            cache.invalidate(1)
+            assert(cache.model(None, 1) is not model)
+            assert(update.call_count == 2)
+
+    def test_campaigns_update_independently(self):
+        # a slow update of one campaign doesn't hold up another, and
+        # everyone asking for the slow one waits for the same update
+        cache = RankingCache(refresh=60, rebuild=3600)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def update_model(session, model, campaign_id, max_iter=None):
+            calls.append(campaign_id)
+            if campaign_id == 1:
+                started.set()
+                release.wait(5.0)
+
+        with mock.patch.object(ranking, 'update_model', update_model):
+            models = []
+            threads = [threading.Thread(target=lambda: models.append(cache.model(None, 1))) for i in range(3)]
+            for t in threads:
+                t.start()
+            assert(started.wait(5.0))
+
+            ts = time.time()
+            cache.model(None, 2)
+            assert(time.time() - ts < 1.0)
+
+            release.set()
+            for t in threads:
+                t.join()
+        assert(sorted(calls) == [1, 2])
+        assert(len(models) == 3 and models[0] is models[1] is models[2])
@@ -0,0 +1,18 @@
+import unittest
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.dialects import mysql, sqlite
+from models import photogame
+
+
+class TestPortableSchema(unittest.TestCase):
+
+    def test_last_updated_mysql(self):
+        ddl = str(CreateTable(photogame.PhotoGameAsset.__table__).compile(dialect=mysql.dialect()))
+        assert('DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP' in ddl)
+
+    def test_last_updated_sqlite(self):
+        for tbl in (photogame.Client.__table__, photogame.Campaign.__table__, photogame.PhotoGameAsset.__table__,
+                    photogame.GameUser.__table__, photogame.PhotoGameResult.__table__, photogame.PhotoGameTally.__table__):
+            ddl = str(CreateTable(tbl).compile(dialect=sqlite.dialect()))
+            assert('ON UPDATE' not in ddl)
+            assert('DEFAULT CURRENT_TIMESTAMP' in ddl)
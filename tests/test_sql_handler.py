@@ -0,0 +1,181 @@
+import unittest
+import logging
+import threading
+import time
+import json
+import sys
+import os
+from handlers.sql_handler import QueuedSQLAlchemyHandler
+from models import sql_logging
+from tests import SQLiteTest
+
+
+class GatedHandler(QueuedSQLAlchemyHandler):
+    # the writer waits for the gate before it touches the queue, and
+    # "writes" rows to a list
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.gate = threading.Event()
+        self.rows = []
+
+    def writer(self) -> None:
+        self.gate.wait()
+        super().writer()
+
+    def write_rows(self, rows: list) -> None:
+        if len(rows) == 0:
+            return
+        self.rows.extend(rows)
+        self.count('written', len(rows))
+
+
+def record(msg: str, level=logging.INFO) -> logging.LogRecord:
+    return logging.LogRecord('test', level, __file__, 1, msg, None, None)
+
+
+class TestQueuedSQLAlchemyHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.gate.set()
+            handler.close()
+
+    def handler(self, **kwargs) -> GatedHandler:
+        handler = GatedHandler(flush_interval=0.01, **kwargs)
+        self.handlers.append(handler)
+        return handler
+
+    def emit(self, handler: GatedHandler, msgs: list) -> None:
+        for msg in msgs:
+            handler.emit(record(msg))
+
+    def written(self, handler: GatedHandler) -> list:
+        return [row['msg'] for row in handler.rows]
+
+    def test_written_in_order(self):
+        handler = self.handler(batch_size=3)
+        self.emit(handler, ['m{0}'.format(i) for i in range(10)])
+        handler.gate.set()
+        handler.flush()
+        assert(self.written(handler) == ['m{0}'.format(i) for i in range(10)])
+        stats = handler.stats()
+        assert(stats['queued'] == 10 and stats['written'] == 10 and stats['dropped'] == 0 and stats['pending'] == 0)
+
+    def test_row(self):
+        handler = self.handler()
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            rec = logging.LogRecord('test', logging.ERROR, __file__, 1, 'x' * 600, None, sys.exc_info())
+        handler.emit(rec)
+        handler.gate.set()
+        handler.flush()
+        row = handler.rows[0]
+        assert(row['logger'] == 'test' and row['level'] == 'ERROR')
+        assert(len(row['msg']) == 500)
+        assert('ValueError: boom' in row['trace'])
+
+    def test_drop_newest(self):
+        handler = self.handler(max_queue=2, overflow=QueuedSQLAlchemyHandler.DROP_NEWEST)
+        self.emit(handler, ['m1', 'm2', 'm3', 'm4'])
+        handler.gate.set()
+        handler.flush()
+        assert(self.written(handler) == ['m1', 'm2'])
+        stats = handler.stats()
+        assert(stats['queued'] == 2 and stats['dropped'] == 2 and stats['written'] == 2)
+
+    def test_drop_oldest(self):
+        handler = self.handler(max_queue=2, overflow=QueuedSQLAlchemyHandler.DROP_OLDEST)
+        self.emit(handler, ['m1', 'm2', 'm3', 'm4'])
+        handler.gate.set()
+        handler.flush()
+        assert(self.written(handler) == ['m3', 'm4'])
+        stats = handler.stats()
+        assert(stats['queued'] == 4 and stats['dropped'] == 2 and stats['written'] == 2)
+
+    def test_block(self):
+        handler = self.handler(max_queue=2, overflow=QueuedSQLAlchemyHandler.BLOCK, block_timeout=0.05)
+        self.emit(handler, ['m1', 'm2'])
+        ts = time.time()
+        handler.emit(record('m3'))  # nobody makes room, dropped after the timeout
+        assert(time.time() - ts >= 0.05)
+        assert(handler.stats()['dropped'] == 1)
+
+        # the writer makes room while we wait
+        handler._block_timeout = 5.0
+        threading.Timer(0.05, handler.gate.set).start()
+        handler.emit(record('m4'))
+        handler.flush()
+        assert(self.written(handler) == ['m1', 'm2', 'm4'])
+        stats = handler.stats()
+        assert(stats['queued'] == 3 and stats['dropped'] == 1)
+
+    def test_flush_timeout(self):
+        handler = self.handler()
+        self.emit(handler, ['m1'])
+        ts = time.time()
+        handler.flush(timeout=0.05)  # the writer is stuck, we don't wait forever
+        assert(0.05 <= time.time() - ts < 1.0)
+        assert(handler.stats()['pending'] == 1)
+
+    def test_close(self):
+        handler = self.handler()
+        self.emit(handler, ['m1', 'm2'])
+        handler.gate.set()
+        writer = handler._writer
+        handler.close()
+        assert(not writer.is_alive())
+        assert(self.written(handler) == ['m1', 'm2'])
+        handler.close()  # again is harmless
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'needs fork()')
+    def test_restart_after_fork(self):
+        handler = self.handler()
+        self.emit(handler, ['parent'])
+        handler.gate.set()
+        handler.flush()
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child doesn't inherit the writer thread, the next emit starts one
+            try:
+                parent_writer = handler._writer
+                handler.emit(record('child'))
+                handler.flush()
+                os.write(w, json.dumps({'restarted': handler._writer is not parent_writer and handler._writer.is_alive(),
+                                        'written': self.written(handler)}).encode('utf-8'))
+            finally:
+                os._exit(0)
+
+        os.close(w)
+        with os.fdopen(r, 'rb') as fp:
+            result = json.loads(fp.read().decode('utf-8'))
+        os.waitpid(pid, 0)
+        assert(result['restarted'])
+        assert(result['written'] == ['parent', 'child'])
+        assert(self.written(handler) == ['parent'])
+
+
+class TestWriteRows(SQLiteTest):
+
+    def test_write_rows(self):
+        handler = QueuedSQLAlchemyHandler()
+        try:
+            handler.write_rows([handler.make_row(record('one')), handler.make_row(record('two', logging.WARNING))])
+            assert(handler.stats()['written'] == 2)
+            rows = self.session.query(sql_logging.Log).order_by(sql_logging.Log.id).all()
+            assert([(log.msg, log.level) for log in rows] == [('one', 'INFO'), ('two', 'WARNING')])
+        finally:
+            handler.close()
+
+    def test_write_failure_counted(self):
+        handler = QueuedSQLAlchemyHandler()
+        try:
+            handler.write_rows([{'bogus': 1}])
+            assert(handler.stats()['failed'] == 1 and handler.stats()['written'] == 0)
+        finally:
+            handler.close()
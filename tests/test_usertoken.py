@@ -0,0 +1,62 @@
+import unittest
+import tempfile
+import shutil
+import os
+from controllers.usertoken import UserTokens, UserToken, TOKEN_COOKIE, LEGACY_COOKIE
+
+
+class TestUserTokens(unittest.TestCase):
+
+    def test_round_trip(self):
+        ut = UserTokens(secret='test-secret')
+        token = ut.for_user(UserToken(ii_user_id='ii-1234'), 42, 7, 'client-user')
+        value = ut.issue(token)
+        t = ut.verify(value)
+        assert(t is not None)
+        assert(t.ii_user_id == 'ii-1234')
+        assert(t.gu_id == 42 and t.client_id == 7)
+        assert(t.vouches_for('client-user', 7))
+        assert(not t.vouches_for('someone-else', 7))
+        assert(not t.vouches_for('client-user', 8))
+        assert(not t.vouches_for(None, 7))
+
+    def test_tampered(self):
+        ut = UserTokens(secret='test-secret')
+        value = ut.issue(UserToken(ii_user_id='ii-1234', gu_id=42))
+        assert(ut.verify(value.replace('.42.', '.43.')) is None)
+        assert(UserTokens(secret='other-secret').verify(value) is None)
+        assert(ut.verify('garbage') is None)
+
+    def test_from_cookies(self):
+        ut = UserTokens(secret='test-secret')
+        t = ut.from_cookies({LEGACY_COOKIE: 'legacy-uuid'})
+        assert(t.ii_user_id == 'legacy-uuid' and t.gu_id is None)
+
+        value = ut.issue(UserToken(ii_user_id='ii-1234', gu_id=42))
+        t = ut.from_cookies({TOKEN_COOKIE: value, LEGACY_COOKIE: 'legacy-uuid'})
+        assert(t.ii_user_id == 'ii-1234' and t.gu_id == 42)
+
+        t = ut.from_cookies({})
+        assert(t.ii_user_id is not None and t.gu_id is None)
+
+    def test_generated_secret(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'token-secret')
+            ut = UserTokens(secret_file=fn)
+            value = ut.issue(UserToken(ii_user_id='ii-1234', gu_id=42))
+            assert(os.stat(fn).st_mode & 0o077 == 0)
+            assert(os.listdir(tmpdir) == ['token-secret'])
+
+            # every worker on the host uses the same one
+            t = UserTokens(secret_file=fn).verify(value)
+            assert(t is not None and t.gu_id == 42)
+            assert(UserTokens(secret_file=os.path.join(tmpdir, 'elsewhere')).verify(value) is None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_insecure_secret(self):
+        with self.assertRaises(ValueError):
+            UserTokens(secret='iiwebwidget3177e39')
+        with self.assertRaises(ValueError):
+            UserTokens(secret='')
@@ -0,0 +1,199 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+from sqlalchemy import exc
+from controllers import votejournal
+from controllers.votejournal import VoteJournal, JournalEntry
+
+BAD_ASSET = 666
+
+
+class StubJournal(VoteJournal):
+    # pgresult is a dict of guid -> votes, ballots voting on BAD_ASSET
+    # fail like a foreign key violation would. The flusher thread idles,
+    # the tests flush() themselves.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.table = {}
+        self.batches = []
+
+    def flusher(self) -> None:
+        self._stop.wait()
+
+    def write_entries(self, session, entries: list) -> int:
+        self.batches.append([e.guid for e in entries])
+        new = [e for e in entries if e.guid not in self.table]
+        for entry in new:
+            if any(vote['asset_id'] == BAD_ASSET for vote in entry.votes):
+                raise exc.IntegrityError('INSERT INTO pgresult', {}, Exception('foreign key'))
+        for entry in new:
+            self.table[entry.guid] = entry.votes
+        return len(entries) - len(new)
+
+
+def ballot(asset_id=1) -> list:
+    return [{'asset_id': asset_id, 'rank': 1}, {'asset_id': asset_id + 1, 'rank': 2}]
+
+
+class TestVoteJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journals = []
+
+    def tearDown(self):
+        for journal in self.journals:
+            journal.stop()
+            for fd in journal._lock_files:  # never started, only locked
+                os.close(fd)
+        shutil.rmtree(self.dir)
+
+    def journal(self, **kwargs) -> StubJournal:
+        journal = StubJournal(journal_dir=self.dir, **kwargs)
+        self.journals.append(journal)
+        return journal
+
+    def segments(self) -> list:
+        return sorted(fn for fn in os.listdir(self.dir) if fn.endswith('.journal'))
+
+    def dead_segment(self, owner: str, n: int, entries: list, torn=None) -> str:
+        # the segment a worker left behind when it died
+        path = os.path.join(self.dir, 'votes_{0}_{1}.journal'.format(owner, n))
+        with open(path, 'w') as fp:
+            for entry in entries:
+                fp.write(entry.to_json() + '\n')
+            if torn is not None:
+                fp.write(torn)
+        return path
+
+    def test_append(self):
+        journal = self.journal()
+        guid = journal.append('bob', 'ii-1', ballot(), gu_id=7)
+        assert(journal.stats()['accepted'] == 1)
+        assert(journal.stats()['pending'] == 1)
+
+        fns = self.segments()
+        assert(fns == ['votes_{0}_1.journal'.format(journal.owner())])
+        with open(os.path.join(self.dir, fns[0]), 'r') as fp:
+            d = json.loads(fp.readline())
+        assert(d['guid'] == guid and d['client_user_id'] == 'bob' and d['gu_id'] == 7 and d['votes'] == ballot())
+
+        assert(journal.flush() == 1)
+        assert(journal.table == {guid: ballot()})
+        stats = journal.stats()
+        assert(stats['pending'] == 0 and stats['flushed'] == 1)
+
+    def test_segment_rotation_and_retirement(self):
+        journal = self.journal(segment_bytes=1)  # a new segment for every ballot
+        for i in range(3):
+            journal.append(None, 'ii-{0}'.format(i), ballot())
+        assert(len(self.segments()) == 3)
+
+        # closed segments go once their ballots are committed, the open one stays
+        journal.flush()
+        assert(self.segments() == ['votes_{0}_3.journal'.format(journal.owner())])
+        assert(len(journal.table) == 3)
+
+    def test_recover_torn_last_line(self):
+        entries = [JournalEntry(guid='G{0}'.format(i), ii_user_id='ii', votes=ballot()) for i in range(2)]
+        path = self.dead_segment('999999', 1, entries, torn='{"guid":"G2","client_us')
+
+        journal = self.journal()
+        journal.start()
+        stats = journal.stats()
+        assert(stats['replayed'] == 2 and stats['pending'] == 2)
+
+        journal.flush()
+        assert(sorted(journal.table) == ['G0', 'G1'])
+        assert(not os.path.exists(path))
+
+    def test_replay_skips_written_guids(self):
+        entries = [JournalEntry(guid='G{0}'.format(i), ii_user_id='ii', votes=ballot()) for i in range(3)]
+        self.dead_segment('999999', 1, entries)
+
+        journal = self.journal()
+        journal.table['G1'] = ballot()  # committed just before the worker died
+        journal.start()
+        journal.flush()
+        stats = journal.stats()
+        assert(stats['duplicates'] == 1 and stats['flushed'] == 2)
+        assert(sorted(journal.table) == ['G0', 'G1', 'G2'])
+
+    def test_live_worker_not_adopted(self):
+        entries = [JournalEntry(guid='G0', ii_user_id='ii', votes=ballot())]
+        path = self.dead_segment('999999', 1, entries)
+        other = self.journal()
+        assert(other.hold_lock('999999'))  # a live worker owns it
+
+        journal = self.journal()
+        journal.start()
+        assert(journal.stats()['replayed'] == 0)
+        assert(os.path.exists(path))
+
+    def test_batch_then_entry_fallback(self):
+        journal = self.journal(max_attempts=1)
+        good = [journal.append(None, 'ii-{0}'.format(i), ballot()) for i in range(2)]
+        bad = journal.append(None, 'ii-bad', ballot(BAD_ASSET))
+        journal.flush()
+
+        # the whole batch first, then one ballot at a time
+        assert(journal.batches[0] == good + [bad])
+        assert(journal.batches[1:] == [[good[0]], [good[1]], [bad]])
+        assert(sorted(journal.table) == sorted(good))
+        stats = journal.stats()
+        assert(stats['flushed'] == 2 and stats['rejected'] == 1 and stats['pending'] == 0)
+
+    def test_rejected_ballot_retried(self):
+        journal = self.journal(max_attempts=2)
+        bad = journal.append(None, 'ii-bad', ballot(BAD_ASSET))
+        # each pass tries the batch, then the ballot on its own, and stops
+        journal.flush()
+        assert(journal.batches == [[bad]] * 2)
+        assert(journal.stats()['pending'] == 1 and journal.stats()['rejected'] == 0)
+        # dropped on the second pass
+        journal.flush()
+        assert(journal.batches == [[bad]] * 4)
+        assert(journal.stats()['pending'] == 0 and journal.stats()['rejected'] == 1)
+
+    def test_rejected_ballot_goes_to_the_back(self):
+        # the ballots queued behind a bad one don't wait for its attempts
+        journal = self.journal(batch_size=2)
+        bad = journal.append(None, 'ii-bad', ballot(BAD_ASSET))
+        good = [journal.append(None, 'ii-{0}'.format(i), ballot()) for i in range(3)]
+        journal.flush()
+        assert(journal.batches == [[bad, good[0]], [bad], [good[0]]])
+        assert(sorted(journal.table) == [good[0]])
+
+        journal.flush()
+        assert(journal.batches[3:] == [[good[1], good[2]], [bad], [bad]])
+        assert(sorted(journal.table) == sorted(good))
+        assert(journal.stats()['pending'] == 1)
+
+    def test_db_down_keeps_ballots(self):
+        journal = self.journal()
+        guid = journal.append(None, 'ii', ballot())
+
+        def db_down(session, entries):
+            raise exc.OperationalError('SELECT', {}, Exception('gone away'))
+
+        journal.write_entries = db_down
+        with self.assertRaises(exc.OperationalError):
+            journal.flush()
+        assert(journal.stats()['pending'] == 1)
+
+        del journal.write_entries
+        journal.flush()
+        assert(guid in journal.table)
+
+    @unittest.skipIf(votejournal.fcntl is None, 'needs flock()')
+    def test_pid_lock_taken(self):
+        # another worker adopted an earlier process with our pid
+        other = self.journal()
+        assert(other.hold_lock(str(os.getpid())))
+
+        journal = self.journal()
+        journal.append(None, 'ii', ballot())
+        assert(journal.owner() == '{0}-1'.format(os.getpid()))
+        assert(self.segments() == ['votes_{0}-1_1.journal'.format(os.getpid())])
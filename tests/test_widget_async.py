@@ -0,0 +1,265 @@
+from unittest import mock
+import tempfile
+import shutil
+import os
+from datetime import datetime, timedelta
+from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from sqlalchemy import exc
+import aiomysql
+import dbsetup
+import widget_async
+from models import photogame
+from controllers import usertoken
+from controllers.assetcache import asset_cache
+from tests import SQLiteTest
+
+PHOTOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photos')
+
+
+#
+# widget_async.py talks to MySQL through aiomysql.sa. These tests give it
+# an engine with the same interface on top of dbsetup.engine (the test's
+# in-memory SQLite), run on the event loop's thread like aiomysql would.
+#
+
+class SQLiteResult():
+    def __init__(self, result):
+        self.rowcount = result.rowcount
+        self.lastrowid = getattr(result, 'lastrowid', None)
+        self._rows = result.fetchall() if result.returns_rows else []
+
+    async def first(self):
+        return self._rows[0] if len(self._rows) > 0 else None
+
+    async def fetchall(self):
+        return self._rows
+
+
+class SQLiteTransaction():
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    async def commit(self):
+        self._transaction.commit()
+
+    async def rollback(self):
+        self._transaction.rollback()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        if not self._transaction.is_active:
+            return
+        if exc_type is None:
+            self._transaction.commit()
+        else:
+            self._transaction.rollback()
+
+
+class SQLiteConnection():
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, stmt, *args):
+        try:
+            return SQLiteResult(self._conn.execute(stmt, *args))
+        except exc.IntegrityError as e:
+            raise aiomysql.IntegrityError(str(e))
+
+    def begin(self) -> SQLiteTransaction:
+        return SQLiteTransaction(self._conn.begin())
+
+    async def begin_nested(self) -> SQLiteTransaction:
+        return SQLiteTransaction(self._conn.begin_nested())
+
+
+class SQLiteAcquire():
+    def __init__(self, engine):
+        self._engine = engine
+        self._conn = None
+
+    async def __aenter__(self):
+        self._engine.acquired += 1
+        self._conn = dbsetup.engine.connect()
+        return SQLiteConnection(self._conn)
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self._conn.close()
+
+
+class SQLiteEngine():
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self) -> SQLiteAcquire:
+        return SQLiteAcquire(self)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+async def create_engine(**kwargs):
+    return SQLiteEngine()
+
+
+class TestWidgetAsync(SQLiteTest, AioHTTPTestCase):
+
+    def setUp(self):
+        SQLiteTest.setUp(self)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        for patcher in (mock.patch('dbsetup.image_store', return_value=self.tmp),
+                        mock.patch('widget_async.create_engine', create_engine)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        client = photogame.Client(name='async client', active=1)
+        self.session.add(client)
+        self.session.commit()
+        now = datetime.now()
+        campaign = photogame.Campaign(client_id=client.id, name='async campaign', active=1,
+                                      start_date=now - timedelta(hours=1), end_date=now + timedelta(days=1))
+        self.session.add(campaign)
+        self.session.commit()
+        self.campaign_id = campaign.id
+        for fn in ('TEST4.JPG', 'TEST5.JPG'):
+            with open(os.path.join(PHOTOS, fn), 'rb') as fp:
+                pga = photogame.PhotoGameAsset()
+                pga.create_asset(campaign.id, fp.read(), session=self.session)
+            self.session.add(pga)
+        self.session.commit()
+        self.asset_ids = sorted(pga.id for pga in self.session.query(photogame.PhotoGameAsset).all())
+        AioHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        AioHTTPTestCase.tearDown(self)
+        SQLiteTest.tearDown(self)
+
+    async def get_application(self):
+        return widget_async.create_app()
+
+    @unittest_run_loop
+    async def test_get_images(self):
+        rsp = await self.client.get('/photogame/{0}'.format(self.campaign_id))
+        assert(rsp.status == 200)
+        assert(sorted(await rsp.json()) == self.asset_ids)
+        assert(rsp.cookies.get(usertoken.TOKEN_COOKIE) is not None)
+
+        rsp = await self.client.get('/photogame/424242')
+        assert(rsp.status == 204)
+
+    @unittest_run_loop
+    async def test_get_ballots(self):
+        rsp = await self.client.get('/photogame/{0}?ballots=3&w=120&h=120'.format(self.campaign_id))
+        assert(rsp.status == 200)
+        ballots = (await rsp.json())['ballots']
+        assert(len(ballots) == 3)
+        for ballot in ballots:
+            assert(ballot['token'] is not None)
+            assert(sorted(asset['asset_id'] for asset in ballot['assets']) == self.asset_ids)
+            for asset in ballot['assets']:
+                assert(asset['url'] == '/asset/{0}?w=120&h=120'.format(asset['asset_id']))
+
+        rsp = await self.client.get('/photogame/{0}?ballots=0'.format(self.campaign_id))
+        assert(rsp.status == 400)
+
+    @unittest_run_loop
+    async def test_download_asset(self):
+        asset_id = self.asset_ids[0]
+        blob = self.session.query(photogame.PhotoGameBlob).\
+            join(photogame.PhotoGameAsset, photogame.PhotoGameAsset.blob_id == photogame.PhotoGameBlob.id).\
+            filter(photogame.PhotoGameAsset.id == asset_id).one()
+        with open(blob.path_and_name(), 'rb') as fp:
+            img = fp.read()
+        url = '/asset/{0}'.format(asset_id)
+
+        rsp = await self.client.get(url)
+        assert(rsp.status == 200)
+        assert(await rsp.read() == img)
+        etag = rsp.headers['ETag']
+
+        rsp = await self.client.get(url, headers={'If-None-Match': etag})
+        assert(rsp.status == 304)
+
+        rsp = await self.client.get(url, headers={'Range': 'bytes=0-9'})
+        assert(rsp.status == 206)
+        assert(await rsp.read() == img[0:10])
+        assert(rsp.headers['Content-Range'] == 'bytes 0-9/{0}'.format(len(img)))
+
+        rsp = await self.client.get(url, headers={'Range': 'bytes=-5'})
+        assert(rsp.status == 206)
+        assert(await rsp.read() == img[-5:])
+
+        rsp = await self.client.get(url, headers={'Range': 'bytes={0}-'.format(len(img))})
+        assert(rsp.status == 416)
+        assert(rsp.headers['Content-Range'] == 'bytes */{0}'.format(len(img)))
+        assert(rsp.headers['Access-Control-Allow-Origin'] == '*')
+
+        # a stale If-Range gets the whole asset
+        rsp = await self.client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': etag})
+        assert(rsp.status == 206)
+        rsp = await self.client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        assert(rsp.status == 200)
+        assert(await rsp.read() == img)
+        rsp = await self.client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        assert(rsp.status == 200)
+
+        rsp = await self.client.get('/asset/424242')
+        assert(rsp.status == 404)
+
+    @unittest_run_loop
+    async def test_download_asset_from_file(self):
+        # not cached, sent by FileResponse
+        asset_id = self.asset_ids[0]
+        url = '/asset/{0}'.format(asset_id)
+        with mock.patch.object(asset_cache, 'should_load', return_value=False):
+            rsp = await self.client.get(url)
+            assert(rsp.status == 200)
+            img = await rsp.read()
+            etag = rsp.headers['ETag']
+
+            rsp = await self.client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': etag})
+            assert(rsp.status == 206)
+            assert(await rsp.read() == img[0:10])
+            rsp = await self.client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+            assert(rsp.status == 200)
+            assert(await rsp.read() == img)
+            assert(rsp.headers['Access-Control-Allow-Origin'] == '*')
+
+    @unittest_run_loop
+    async def test_vote(self):
+        votes = [{'asset_id': self.asset_ids[0], 'rank': 1}, {'asset_id': self.asset_ids[1], 'rank': 2}]
+        rsp = await self.client.post('/vote', json={'votes': votes, 'user_id': 'async-user'})
+        assert(rsp.status == 200)
+        assert(rsp.cookies.get(usertoken.TOKEN_COOKIE) is not None)
+
+        # same user the second time, whether the token or the lookup says so
+        rsp = await self.client.post('/vote', json={'votes': votes, 'user_id': 'async-user'})
+        assert(rsp.status == 200)
+        assert(self.session.query(photogame.GameUser).count() == 1)
+        assert(self.session.query(photogame.PhotoGameResult).count() == 4)
+        tally = self.session.query(photogame.PhotoGameTally).filter(photogame.PhotoGameTally.asset_id == self.asset_ids[0]).one()
+        assert(tally.appearances == 2 and tally.wins == 2)
+
+        rsp = await self.client.post('/vote', json={'votes': votes, 'ballot': 'bogus'})
+        assert(rsp.status == 400)
+        rsp = await self.client.post('/vote', data='not json')
+        assert(rsp.status == 400)
+        rsp = await self.client.post('/vote', json={'votes': [{'asset_id': 424242, 'rank': 1}]})
+        assert(rsp.status == 400)
+
+    @unittest_run_loop
+    async def test_spec(self):
+        rsp = await self.client.get('/spec/widget.json', headers={'Accept-Encoding': 'identity'})
+        assert(rsp.status == 200)
+        spec = await rsp.json()
+        assert('/vote' in spec['paths'] and '/photogame/{campaign_id}' in spec['paths'])
+        assert(spec['paths']['/photogame/{campaign_id}']['get']['responses']['200']['x-ballots-schema'] == {'$ref': '#/definitions/ballots'})
+        etag = rsp.headers['ETag']
+
+        rsp = await self.client.get('/spec/widget.json', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+        assert(rsp.status == 304)
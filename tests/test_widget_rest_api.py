@@ -9,6 +9,9 @@ import uuid
 from datetime import datetime, timedelta
 from sqlalchemy import text
 import json
+import io
+import gzip
+from PIL import Image
 
 
 class TestPhotoGameAPI(unittest.TestCase):
@@ -98,6 +101,114 @@ class TestPhotoGameAPI(unittest.TestCase):
             assert(rsp.status_code == 200)
             assert not self.has_cookie(rsp.headers)
 
+    def test_get_asset_range(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        assert(rsp.status_code == 200)
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        rsp = self.app.get(path='/asset/{0}'.format(data[0]))
+        assert(rsp.status_code == 200)
+        assert(rsp.headers['Content-Type'] == 'image/jpeg')
+        size = int(rsp.headers['Content-Length'])
+        assert(len(rsp.data) == size)
+
+        headers = Headers()
+        headers.add('Range', 'bytes=0-99')
+        rsp = self.app.get(path='/asset/{0}'.format(data[0]), headers=headers)
+        assert(rsp.status_code == 206)
+        assert(len(rsp.data) == 100)
+        assert(rsp.headers['Content-Range'] == 'bytes 0-99/{0}'.format(size))
+
+        headers = Headers()
+        headers.add('Range', 'bytes={0}-'.format(size + 10))
+        rsp = self.app.get(path='/asset/{0}'.format(data[0]), headers=headers)
+        assert(rsp.status_code == 416)
+
+    def test_get_asset_not_modified(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        rsp = self.app.get(path='/asset/{0}'.format(data[0]))
+        assert(rsp.status_code == 200)
+        assert('immutable' in rsp.headers['Cache-Control'])
+        etag = rsp.headers['ETag']
+        assert(etag is not None)
+
+        headers = Headers()
+        headers.add('If-None-Match', etag)
+        rsp = self.app.get(path='/asset/{0}'.format(data[0]), headers=headers)
+        assert(rsp.status_code == 304)
+        assert(len(rsp.data) == 0)
+
+    def test_get_asset_resized(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        rsp = self.app.get(path='/asset/{0}?w=120&h=120'.format(data[0]))
+        assert(rsp.status_code == 200)
+        img = Image.open(io.BytesIO(rsp.data))
+        assert(img.size[0] <= 120 and img.size[1] <= 120)
+
+        rsp = self.app.get(path='/asset/{0}?w=bogus'.format(data[0]))
+        assert(rsp.status_code == 400)
+
+    def test_get_ballots(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}?ballots=3&w=120&h=120'.format(campaign_id))
+        assert(rsp.status_code == 200)
+        assert self.has_cookie(rsp.headers)
+        ballots = json.loads(rsp.data.decode("utf-8"))['ballots']
+        assert(len(ballots) == 3)
+        for ballot in ballots:
+            assert(len(ballot['assets']) == 2)
+            for asset in ballot['assets']:
+                assert(asset['width'] <= 120 and asset['height'] <= 120)
+                rsp = self.app.get(path=asset['url'])
+                assert(rsp.status_code == 200)
+
+        # vote on a prefetched ballot
+        ballot = ballots[0]
+        votes = {'ballot': ballot['token'],
+                 'votes': [{'asset_id': ballot['assets'][0]['asset_id'], 'rank': 1},
+                           {'asset_id': ballot['assets'][1]['asset_id'], 'rank': 2}]}
+        headers = Headers()
+        headers.add('content-type', 'application/json')
+        rsp = self.app.post(path='/vote', data=json.dumps(votes), headers=headers)
+        assert(rsp.status_code == 200)
+
+        votes['ballot'] = ballot['token'][:-1]
+        rsp = self.app.post(path='/vote', data=json.dumps(votes), headers=headers)
+        assert(rsp.status_code == 400)
+
+        rsp = self.app.get(path='/photogame/{0}?ballots=0'.format(campaign_id))
+        assert(rsp.status_code == 400)
+
+    def test_spec(self):
+        rsp = self.app.get(path='/spec/widget.json')
+        assert(rsp.status_code == 200)
+        swag = json.loads(rsp.data.decode("utf-8"))
+        assert('/vote' in swag['paths'] and '/auth' in swag['paths'])
+        etag = rsp.headers['ETag']
+
+        headers = Headers()
+        headers.add('Accept-Encoding', 'gzip')
+        rsp = self.app.get(path='/spec/widget.json', headers=headers)
+        assert(rsp.headers['Content-Encoding'] == 'gzip')
+        assert(json.loads(gzip.decompress(rsp.data).decode("utf-8")) == swag)
+        assert(rsp.headers['ETag'] != etag)
+
+        headers = Headers()
+        headers.add('If-None-Match', etag)
+        rsp = self.app.get(path='/spec/widget.json', headers=headers)
+        assert(rsp.status_code == 304)
+
     def test_get_images_no_campaign(self):
         self.setUp()
 
@@ -161,6 +272,75 @@ class TestPhotoGameAPI(unittest.TestCase):
             assert(pgr.asset_id == data[0] or pgr.asset_id == data[1])
             assert(pgr.user_id is not None)
 
+    def test_cast_ballots_same_client_user(self):
+        # a client user voting again is the same gameuser
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        user_id = str(uuid.uuid1())
+        votes = {'user_id': user_id, 'votes': [{'asset_id':data[0], 'rank':1},{'asset_id':data[1], 'rank':2}]}
+        headers = Headers()
+        headers.add('content-type', 'application/json')
+        for i in range(2):
+            rsp = self.app.post(path='/vote', data=json.dumps(votes), headers=headers)
+            assert(rsp.status_code == 200)
+
+        q = self.session.query(photogame.GameUser).filter(photogame.GameUser.client_userid == user_id)
+        gu_list = q.all()
+        assert(len(gu_list) == 1)
+        assert(gu_list[0].client_id == client_id)
+        q = self.session.query(photogame.PhotoGameResult.user_id).distinct()
+        assert(q.all() == [(gu_list[0].id,)])
+
+    def test_campaign_leaders(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        headers = Headers()
+        headers.add('content-type', 'application/json')
+        votes = {'votes': [{'asset_id': data[0], 'rank': 1}, {'asset_id': data[1], 'rank': 2}]}
+        for i in range(3):
+            rsp = self.app.post(path='/vote', data=json.dumps(votes), headers=headers)
+            assert(rsp.status_code == 200)
+
+        rsp = self.app.get(path='/leaders/{0}?n=2'.format(campaign_id))
+        assert(rsp.status_code == 200)
+        leaders = json.loads(rsp.data.decode("utf-8"))
+        assert(len(leaders) == 2)
+        assert(leaders[0]['asset_id'] == data[0])
+        assert(leaders[0]['wins'] == 3)
+        assert(leaders[1]['wins'] == 0)
+        assert(leaders[1]['appearances'] == 3)
+
+    def test_campaign_ranking(self):
+        self.setUp()
+        client_id, campaign_id = self.create_client_and_campaign(self.session)
+        rsp = self.app.get(path='/photogame/{0}'.format(campaign_id))
+        data = json.loads(rsp.data.decode("utf-8"))
+
+        headers = Headers()
+        headers.add('content-type', 'application/json')
+        votes = {'votes': [{'asset_id': data[0], 'rank': 1}, {'asset_id': data[1], 'rank': 2}]}
+        for i in range(3):
+            rsp = self.app.post(path='/vote', data=json.dumps(votes), headers=headers)
+            assert(rsp.status_code == 200)
+
+        for method in ('bt', 'elo'):
+            rsp = self.app.get(path='/ranking/{0}?n=2&method={1}'.format(campaign_id, method))
+            assert(rsp.status_code == 200)
+            ranking = json.loads(rsp.data.decode("utf-8"))
+            assert(len(ranking) == 2)
+            assert(ranking[0]['asset_id'] == data[0])
+            assert(ranking[0]['score'] > ranking[1]['score'])
+            assert(ranking[0]['comparisons'] == 3)
+
+        rsp = self.app.get(path='/ranking/{0}?method=foo'.format(campaign_id))
+        assert(rsp.status_code == 400)
+
     def initialize_ii_assets(self):
         # This will initialize the assets for the default
         # Image Improv client/campaign
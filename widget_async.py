@@ -0,0 +1,314 @@
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from logsetup import logger
+import aiomysql
+import argparse
+import asyncio
+import time
+import os
+import apispec
+import dbsetup
+import metrics
+from controllers import assetcache, assetlookup, assetstream, derivatives, usertoken
+from controllers.asyncmgr import AsyncPhotoGameMgr, create_engine
+from controllers.assetcache import asset_cache
+from controllers.photomgr import PhotoGameMgr
+from controllers.usertoken import user_tokens
+from controllers.votejournal import vote_journal, write_behind_enabled
+
+#
+# asyncio entry point for the widget API
+#
+# Serves the same /photogame, /asset, /vote and /spec contract as
+# widget_main.py, but a slow image read or a MySQL stall only holds up the
+# request waiting on it, not a whole worker, so one process can keep
+# thousands of widget connections open. Queries go through an aiomysql
+# pool (ASYNC_DB_POOL_SIZE) against models.photogame's tables, files are
+# sent with sendfile by web.FileResponse, and the blocking bits we can't
+# avoid (Pillow, filling the asset byte cache, the vote journal) run on a
+# thread pool. Everything the Flask app caches in memory is shared, so a
+# warm process answers most requests without touching MySQL at all.
+#
+#   python widget_async.py --port 8082
+#   gunicorn -c gunicorn.conf.py widget_async:app --worker-class aiohttp.GunicornWebWorker
+#
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+
+def not_modified(request: web.Request, etag: str, last_modified) -> bool:
+    # see assetstream.not_modified(), If-None-Match wins over If-Modified-Since
+    if_none_match = request.headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or '"{0}"'.format(etag) in tags or 'W/"{0}"'.format(etag) in tags
+    if_modified_since = request.if_modified_since
+    if if_modified_since is not None:
+        return last_modified <= if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def range_allowed(request: web.Request, etag: str, last_modified) -> bool:
+    # see assetstream.requested_range(), a Range whose If-Range validator
+    # doesn't match the asset any more gets the whole asset
+    if_range = request.headers.get('If-Range', None)
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == '"{0}"'.format(etag)
+    return request.if_range is not None and request.if_range.replace(tzinfo=None) == last_modified
+
+
+class WholeFileResponse(web.FileResponse):
+    # a FileResponse that ignores the Range header (FileResponse only
+    # understands an If-Range date, not an ETag)
+    async def prepare(self, request: web.BaseRequest):
+        headers = request.headers.copy()
+        headers.popall('Range', None)
+        return await super().prepare(request.clone(headers=headers))
+
+
+def cache_headers(etag: str, last_modified) -> dict:
+    headers = {'ETag': '"{0}"'.format(etag),
+               'Last-Modified': last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+               'Cache-Control': assetstream.IMMUTABLE_CACHE_CONTROL}
+    headers.update(CORS_HEADERS)
+    return headers
+
+
+def send_bytes(request: web.Request, data: bytes, etag: str, last_modified, mimetype: str) -> web.Response:
+    # an asset we hold in memory, honouring conditional and single range requests
+    headers = cache_headers(etag, last_modified)
+    if not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+
+    headers['Accept-Ranges'] = 'bytes'
+    try:
+        rng = request.http_range
+    except ValueError:
+        rng = slice(None, None)
+    if (rng.start is None and rng.stop is None) or not range_allowed(request, etag, last_modified):
+        return web.Response(body=data, content_type=mimetype, headers=headers)
+
+    start, stop, step = rng.indices(len(data))  # 'bytes=-500' comes back as slice(-500, None)
+    if start >= stop:
+        headers = {'Content-Range': 'bytes */{0}'.format(len(data)), 'Accept-Ranges': 'bytes'}
+        headers.update(CORS_HEADERS)
+        return web.Response(status=416, headers=headers)
+    headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop - 1, len(data))
+    return web.Response(status=206, body=data[start:stop], content_type=mimetype, headers=headers)
+
+
+def set_token_cookie(rsp: web.Response, token: usertoken.UserToken) -> None:
+    rsp.set_cookie(usertoken.TOKEN_COOKIE, user_tokens.issue(token), path='/')
+
+
+@web.middleware
+async def timed(request: web.Request, handler):
+    # the same histograms @timeit() feeds for the Flask views, by route name
+    name = request.match_info.route.name or 'unknown'
+    ts = time.perf_counter()
+    try:
+        rsp = await handler(request)
+    except web.HTTPException as e:
+        metrics.registry.observe(name, time.perf_counter() - ts, error=e.status >= 500)
+        raise
+    except Exception:
+        metrics.registry.observe(name, time.perf_counter() - ts, error=True)
+        raise
+    metrics.registry.observe(name, time.perf_counter() - ts, error=rsp.status >= 500)
+    return rsp
+
+
+async def get_images(request: web.Request) -> web.Response:
+    campaign_id = int(request.match_info['campaign_id'])
+    if 'ballots' in request.query:
+        return await get_ballots(request, campaign_id)
+
+    try:
+        token = user_tokens.from_cookies(request.cookies)
+        asset_ids = await request.app['pm'].get_photogame_assets(campaign_id)
+        if len(asset_ids) == 0:
+            return web.Response(status=204, headers=CORS_HEADERS)
+
+        rsp = web.json_response(asset_ids, headers=CORS_HEADERS)
+        set_token_cookie(rsp, token)
+        return rsp
+    except Exception as e:
+        logger.exception(msg="[/photogame] error reading ballot!")
+
+    return web.Response(status=501, text="not implemented", headers=CORS_HEADERS)
+
+
+async def get_ballots(request: web.Request, campaign_id: int) -> web.Response:
+    # /photogame/<campaign_id>?ballots=N, see widget_main.get_ballots()
+    try:
+        n = int(request.query.get('ballots'))
+        size = derivatives.requested_size(request.query)
+    except (TypeError, ValueError):
+        n = 0
+    if n <= 0 or n > dbsetup.Configuration.MAX_PREFETCH_BALLOTS:
+        return web.json_response({'msg': 'ballots must be between 1 and {0}, w/h positive integers'.format(dbsetup.Configuration.MAX_PREFETCH_BALLOTS)},
+                                 status=400, headers=CORS_HEADERS)
+
+    try:
+        token = user_tokens.from_cookies(request.cookies)
+        ballots = await request.app['pm'].get_photogame_ballots(campaign_id, n, size)
+        if len(ballots) == 0:
+            return web.Response(status=204, headers=CORS_HEADERS)
+
+        asset_route = request.app.router['download_asset']
+        for ballot in ballots:
+            for asset in ballot['assets']:
+                url = asset_route.url_for(asset_id=str(asset['asset_id']))
+                if size is not None:
+                    url = url.with_query(w=size[0], h=size[1])
+                asset['url'] = str(url)
+
+        rsp = web.json_response({'ballots': ballots}, headers=CORS_HEADERS)
+        set_token_cookie(rsp, token)
+        return rsp
+    except Exception as e:
+        logger.exception(msg="[/photogame] error reading ballots!")
+
+    return web.Response(status=501, text="not implemented", headers=CORS_HEADERS)
+
+
+async def download_asset(request: web.Request) -> web.StreamResponse:
+    asset_id = int(request.match_info['asset_id'])
+    try:
+        size = derivatives.requested_size(request.query)
+    except ValueError:
+        return web.Response(status=400, text='invalid w/h', headers=CORS_HEADERS)
+
+    # location() is answered from memory for assets we've seen, and the
+    # bytes are cached by storage path (see assetcache.cache_key())
+    loop = asyncio.get_event_loop()
+    try:
+        loc = await request.app['pm'].location(asset_id)
+        if loc is not None and loc.active:
+            cache_key = assetcache.cache_key(loc, size)
+            ca = asset_cache.get(cache_key)
+            if ca is not None:
+                return send_bytes(request, ca.data, ca.etag, ca.last_modified, ca.mimetype)
+            if size is None:
+                path_and_name = assetlookup.path_and_name(loc)
+            else:
+                path_and_name = await loop.run_in_executor(None, derivatives.derivative, loc, size[0], size[1])
+            if asset_cache.should_load(cache_key):
+                ca = await loop.run_in_executor(None, asset_cache.load, cache_key, path_and_name)
+                if ca is not None:
+                    return send_bytes(request, ca.data, ca.etag, ca.last_modified, ca.mimetype)
+
+            st = await loop.run_in_executor(None, os.stat, path_and_name)
+            etag, last_modified = assetstream.file_validators(path_and_name, st)
+            if not_modified(request, etag, last_modified):
+                return web.Response(status=304, headers=cache_headers(etag, last_modified))
+            if not range_allowed(request, etag, last_modified):
+                return WholeFileResponse(path_and_name, headers=cache_headers(etag, last_modified))
+            return web.FileResponse(path_and_name, headers=cache_headers(etag, last_modified))
+    except Exception as e:
+        logger.exception(msg="[/asset] error reading asset!")
+
+    return web.Response(status=404, text='image not found', headers=CORS_HEADERS)
+
+
+async def campaign_vote(request: web.Request) -> web.Response:
+    if request.content_type != 'application/json':
+        return web.json_response({'msg': 'no json input arguments'}, status=400)
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({'msg': 'no json input arguments'}, status=400)
+
+    votes = body.get('votes', None) if isinstance(body, dict) else None
+    if votes is None:
+        return web.json_response({'msg': 'missing arguments'}, status=400)
+    client_user_id = body.get('user_id', None)
+    ballot_token = body.get('ballot', None)
+
+    pm = request.app['pm']
+    try:
+        token = user_tokens.from_cookies(request.cookies)
+        if ballot_token is not None and not PhotoGameMgr().ballot_matches(ballot_token, votes):
+            return web.Response(status=400, text="invalid or expired ballot")
+        if write_behind_enabled():
+            # journaled and written in the background, see controllers/votejournal.py
+            if not await pm.validate_votes(votes):
+                return web.Response(status=400, text="invalid campaign or client")
+            gu_id = await pm.token_user(token, client_user_id, votes[0]['asset_id'])
+            await asyncio.get_event_loop().run_in_executor(None, lambda: vote_journal.append(client_user_id, token.ii_user_id, votes, gu_id=gu_id))
+        else:
+            gu_id = await pm.tally_results(client_user_id, token.ii_user_id, votes, token=token)
+            token = await pm.user_token(token, client_user_id, votes[0]['asset_id'], gu_id)
+        rsp = web.Response(text="success")
+        set_token_cookie(rsp, token)
+        return rsp
+    except aiomysql.IntegrityError as e:
+        return web.Response(status=400, text="invalid campaign or client")
+    except Exception as e:
+        logger.exception(msg="[/vote] error recording votes!")
+
+    return web.json_response({'msg': 'not implemented'}, status=501)
+
+
+async def spec(request: web.Request) -> web.Response:
+    # see widget_main.spec(), the spec is built from the Flask views
+    import widget_main
+    etag, data, gzipped = apispec.cached_spec(widget_main.app, widget_main.__version__)
+    use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if use_gzip:
+        etag += '-gz'
+
+    headers = {'ETag': '"{0}"'.format(etag), 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache',
+               'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Headers': 'Content-Type',
+               'Access-Control-Allow-Methods': 'GET, POST'}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if '"{0}"'.format(etag) in [tag.strip() for tag in if_none_match.split(',')]:
+        return web.Response(status=304, headers=headers)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+    return web.Response(body=gzipped if use_gzip else data, content_type='application/json', headers=headers)
+
+
+async def start_resources(app: web.Application) -> None:
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(dbsetup.Configuration.ASYNC_EXECUTOR_THREADS))
+    app['db'] = await create_engine(loop=loop)
+    app['pm'] = AsyncPhotoGameMgr(engine=app['db'])
+    if write_behind_enabled():
+        vote_journal.start()
+
+
+async def stop_resources(app: web.Application) -> None:
+    app['db'].close()
+    await app['db'].wait_closed()
+    if vote_journal.is_started():
+        vote_journal.stop()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[timed])
+    app.router.add_get(r'/photogame/{campaign_id:\d+}', get_images, name='get_images')
+    app.router.add_get(r'/asset/{asset_id:\d+}', download_asset, name='download_asset')
+    app.router.add_post('/vote', campaign_vote, name='campaign_vote')
+    app.router.add_get('/spec/widget.json', spec, name='spec')
+    app.on_startup.append(start_resources)
+    app.on_cleanup.append(stop_resources)
+    return app
+
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve the widget API with asyncio')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8082)
+    args = parser.parse_args()
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()